@@ -0,0 +1,539 @@
+"""
+.. module:: NIF sync integration, asyncio engine
+    :platform: Unix
+    :synopsis: Integration of change messages, NIF (soap) API -> NLF (Eve) API, all workers in one event loop
+"""
+
+import asyncio
+import json
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import dateutil.parser
+from dateutil import tz
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from eve_api import EveJSONEncoder
+from nif_api import NifApiSynchronization
+from app_logger import AppLogger
+from checkpoints import SyncCheckpoints
+from metrics import NIF_CALL_SECONDS
+from sync import SyncState, prepare_changes, bulk_insert_retries
+from settings import (
+    API_HEADERS, API_URL,
+    NIF_POPULATE_INTERVAL,
+    NIF_CHANGES_SYNC_INTERVAL,
+    LOCAL_TIMEZONE,
+    NIF_REALM,
+    SYNC_LOG_FILE,
+    SYNC_CONNECTIONPOOL_SIZE,
+    NIF_SYNC_DELAY,
+    NIF_SYNC_MAX_ERRORS,
+    NIF_SYNC_BATCH_SIZE,
+    NIF_SYNC_JITTER
+)
+
+
+class AsyncSyncEngine(threading.Thread):
+    """Runs :py:class:`AsyncNifSync` workers as tasks in one asyncio event loop in one thread
+
+    Calls to the Lungo api are made with :py:mod:`aiohttp` over one connection pool. NIF GetChanges calls are made
+    with the synchronous zeep clients in :py:mod:`nif_api`, run in a pool of ``pool_size`` threads. An
+    :py:class:`asyncio.Semaphore` of ``pool_size`` slots replaces the BoundedSemaphore used by the thread model.
+
+    .. attention::
+        Requires :py:mod:`aiohttp`
+
+    :param stopper: a threading.Event flag to exit
+    :type stopper: threading.Event
+    :param pool_size: Slots in the connection pool. Defaults to SYNC_CONNECTIONPOOL_SIZE
+    :type pool_size: int
+
+    Usage::
+
+        from async_sync import AsyncSyncEngine, AsyncNifSync
+        engine = AsyncSyncEngine(stopper=threading.Event())
+        engine.add_worker(AsyncNifSync(org_id, username, password, created))
+        engine.start()  # engine is of threading.Thread
+    """
+
+    def __init__(self, stopper, pool_size=SYNC_CONNECTIONPOOL_SIZE):
+
+        if aiohttp is None:
+            raise Exception('The asyncio sync engine requires aiohttp')
+
+        super().__init__(name='sync-asyncio')
+
+        self.stopper = stopper
+        self.pool_size = pool_size
+
+        self.workers = []
+
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+        self.session = None
+        self.semaphore = None
+        self.stopping = None
+
+        self.log = AppLogger(name='sync-asyncio')
+
+    def add_worker(self, worker) -> None:
+        """Add a worker, workers added after :py:meth:`start` are started right away
+
+        :param worker: The worker
+        :type worker: AsyncNifSync
+        """
+
+        worker.engine = self
+        self.workers.append(worker)
+
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(worker.start)
+
+    def run(self) -> None:
+        """Run the event loop until :py:attr:`stopper` is set"""
+
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    async def _main(self) -> None:
+
+        self.semaphore = asyncio.Semaphore(self.pool_size)
+        self.stopping = asyncio.Event()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                             headers=API_HEADERS,
+                                             json_serialize=lambda o: json.dumps(o, cls=EveJSONEncoder))
+
+        self.log.info('Starting {} workers'.format(len(self.workers)))
+        for worker in self.workers:
+            worker.start()
+
+        # Propagate the threading stopper into the loop
+        while not self.stopper.is_set():
+            await asyncio.sleep(1)
+
+        self.log.info('Stopper is set, stopping workers')
+        self.stopping.set()
+
+        tasks = [w.task for w in self.workers if w.task is not None]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+        await self.session.close()
+
+    async def run_in_executor(self, func, *args):
+        """Run a blocking call in the NIF thread pool"""
+
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def sleep(self, seconds) -> bool:
+        """Sleep, returns early if stopping
+
+        :return: True if stopping
+        :rtype: bool
+        """
+
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.stopping.is_set()
+
+
+class AsyncNifSync:
+    """Populate and sync change messages from NIF api as a task in an :py:class:`AsyncSyncEngine`
+
+    Same flow as :py:class:`sync.NifSync`: on start :py:meth:`check` decides to :py:meth:`populate` or
+    :py:meth:`sync`, then :py:meth:`sync` runs every ``sync_interval`` minutes. Exposes the same attributes as
+    :py:class:`sync.NifSync` used by :py:class:`syncdaemon.PyroService`.
+
+    :param org_id: The integration user organization id, required
+    :type org_id: int
+    :param username: The full path integration username ('app_id/function_id/username'), required
+    :type username: str
+    :param password: Password, required
+    :type password: str
+    :param created: A datetime string representing creation date of org_id, required
+    :type created: str
+    :param restart: On True will reset all AppLogger handlers
+    :type restart: bool
+    :param initial_timedelta: The initial timedelta to use from last change message in ms
+    :type initial_timedelta: int
+    :param overlap_timedelta: A optional timedelta for overlap functions in hours
+    :type overlap_timedelta: int
+    :param sync_type: The sync type for this user, allowed ``changes``, ``competence``, ``license`` and
+        ``federation``. Defaults to ``changes``.
+    :type sync_type: str
+    :param sync_interval: The interval for the sync in minutes. Defaults to NIF_CHANGES_SYNC_INTERVAL
+    :type sync_interval: int
+    :param populate_interval: The interval for populating in hours. Defaults to NIF_POPULATE_INTERVAL
+    :type populate_interval: int
+    :param batch_size: Number of change messages in each bulk insert to the api. Defaults to NIF_SYNC_BATCH_SIZE
+    :type batch_size: int
+    :param checkpoints: The checkpoint store, if None creates a :py:class:`checkpoints.SyncCheckpoints`
+    :type checkpoints: checkpoints.SyncCheckpoints
+    """
+
+    def __init__(self,
+                 org_id,
+                 username,
+                 password,
+                 created,
+                 restart=False,
+                 initial_timedelta=0,
+                 overlap_timedelta=0,
+                 sync_type='changes',
+                 sync_interval=NIF_CHANGES_SYNC_INTERVAL,
+                 populate_interval=NIF_POPULATE_INTERVAL,
+                 batch_size=NIF_SYNC_BATCH_SIZE,
+                 checkpoints=None):
+
+        self.state = SyncState()
+
+        if sync_type in ['changes', 'license', 'competence', 'federation']:
+            self.sync_type = sync_type
+        else:
+            raise Exception('{} is not a valid sync type'.format(sync_type))
+
+        self.name = 'klubb-{0}'.format(org_id)
+        self.id = org_id
+        self.org_id = org_id
+        self.username = username
+        self.password = password
+
+        self.started = datetime.now()
+        self.sync_errors = 0
+        self.job_misfires = 0
+        self.messages = 0
+
+        self.sync_interval = sync_interval  # minutes
+        self.populate_interval = populate_interval  # hours
+        self.batch_size = max(1, batch_size)
+
+        self.initial_timedelta = initial_timedelta
+        self.overlap_timedelta = overlap_timedelta
+
+        self.initial_start = None
+        self.from_to = [None, None]
+        self.next_run_time = None
+
+        self.tz_local = tz.gettz(LOCAL_TIMEZONE)
+        self.tz_utc = tz.gettz('UTC')
+
+        self.log = AppLogger(name=self.name, stdout=False, last_logs=100, restart=restart)
+
+        self.api_integration_url = '%s/integration/changes' % API_URL
+        self.checkpoints = checkpoints if checkpoints is not None else SyncCheckpoints()
+
+        self.org_created = dateutil.parser.parse(created)
+        if self.org_created.tzinfo is None or self.org_created.tzinfo.utcoffset(self.org_created) is None:
+            """self.org_created is naive, no timezone we assume CET"""
+            self.org_created = self.org_created.replace(tzinfo=self.tz_local)
+
+        self.nif = None
+        self.engine = None
+        self.task = None
+
+        self.state.set_state(state='initialized')
+
+    @property
+    def uptime(self) -> (int, int):
+        """Calculate worker uptime
+
+        :returns uptime: integer tuple (days, seconds) since worker start
+        """
+
+        t = datetime.now() - self.started
+        return t.days, t.seconds
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def job_next_run_time(self):
+        return self.next_run_time
+
+    def is_alive(self) -> bool:
+        return self.running
+
+    def start(self) -> None:
+        """Create the worker task, must be called in the engine event loop. A worker that has ended is restarted."""
+
+        if self.task is None or self.task.done():
+            if self.task is not None:
+                self.sync_errors = 0
+
+            self.task = self.engine.loop.create_task(self.main())
+
+    def run(self) -> None:
+        """Start the worker from outside the event loop, conforms to :py:meth:`sync.NifSync.run`"""
+
+        self.engine.loop.call_soon_threadsafe(self.start)
+
+    async def main(self) -> None:
+        """Check, then populate or sync until the engine is stopping or too many errors"""
+
+        # Spread the workers
+        if await self.engine.sleep(random.uniform(0, NIF_SYNC_JITTER)):
+            return
+
+        try:
+            self.nif = await self.engine.run_in_executor(lambda: NifApiSynchronization(self.username,
+                                                                                       self.password,
+                                                                                       realm=NIF_REALM,
+                                                                                       log_file=SYNC_LOG_FILE,
+                                                                                       test_login=False))
+
+            if await self.check() is not True:
+                return
+
+            while self.sync_errors < NIF_SYNC_MAX_ERRORS:
+
+                delay = self.sync_interval * 60 + random.uniform(0, NIF_SYNC_JITTER)
+                self.next_run_time = datetime.now() + timedelta(seconds=delay)
+
+                if await self.engine.sleep(delay):
+                    break
+
+                self.next_run_time = None
+                await self.sync()
+
+            if self.sync_errors >= NIF_SYNC_MAX_ERRORS:
+                self.state.set_state(mode=self.state.mode, state='terminated', reason='too many errors')
+
+        except Exception:
+            self.log.exception('Exception in worker, terminating')
+            self.state.set_state(mode=self.state.mode, state='terminated', reason='exception')
+
+        self.next_run_time = None
+        self.log.warning('[TERMINATING]')
+
+    async def check(self) -> bool:
+        """Decide to populate or sync on startup, see :py:meth:`sync.NifSync._check`
+
+        :return: False on errors from the api
+        :rtype: bool
+        """
+
+        self.state.set_state(mode='check', state='running')
+
+        checkpoint = await self.engine.run_in_executor(self.checkpoints.get_checkpoint, self.org_id, self.sync_type)
+
+        if checkpoint is not None:
+            self.log.debug('Last checkpoint {0}'.format(checkpoint.astimezone(self.tz_local).isoformat()))
+            await self._resume(checkpoint)
+            return True
+
+        async with self.engine.session.get(self.api_integration_url,
+                                           params={'where': json.dumps({'_org_id': self.org_id,
+                                                                        '_realm': NIF_REALM}),
+                                                   'sort': '[("sequence_ordinal", -1)]',
+                                                   'max_results': 1}) as resp:
+            status = resp.status
+            r = await resp.json() if status == 200 else {}
+
+        if status != 200:
+            self.log.error('{0} from {1}, terminating'.format(status, self.api_integration_url))
+            return False
+
+        c = r.get('_items', [])
+
+        if len(c) == 0:
+            self.log.debug('No change records, populating')
+            await self.populate()
+
+        else:
+            sequential_ordinal = dateutil.parser.parse(c[0]['sequence_ordinal']).replace(tzinfo=self.tz_utc)
+
+            self.log.debug(
+                'Last change message recorded {0}'.format(sequential_ordinal.astimezone(self.tz_local).isoformat()))
+
+            await self._resume(sequential_ordinal)
+
+        return True
+
+    async def _resume(self, last) -> None:
+        """Populate or sync from the last change message or checkpoint"""
+
+        self.initial_start = last + timedelta(seconds=self.initial_timedelta) - timedelta(hours=self.overlap_timedelta)
+
+        if self.initial_start < datetime.utcnow().replace(tzinfo=self.tz_utc) - timedelta(
+                hours=self.populate_interval):
+            self.log.debug('More than {} hours, populating'.format(self.populate_interval))
+            await self.populate()
+        else:
+            self.log.debug('Less than {} hours, syncing'.format(self.populate_interval))
+            await self.sync()
+
+    async def _set_checkpoint(self, end_date) -> None:
+        """Store the end of the last window fetched, see :py:meth:`sync.NifSync._set_checkpoint`"""
+
+        try:
+            await self.engine.run_in_executor(self.checkpoints.set_checkpoint, self.org_id, self.sync_type, end_date)
+        except Exception:
+            self.log.exception('Could not store checkpoint')
+
+    async def populate(self) -> None:
+        """Populate change messages in windows of :py:attr:`populate_interval` hours, see
+        :py:meth:`sync.NifSync.populate`. Each window requires a slot in the engine semaphore.
+        """
+
+        self.state.set_state(mode='populate', state='initializing')
+
+        if self.initial_start is None:
+            end_date = self.org_created
+        else:
+            end_date = self.initial_start
+
+        start_date = end_date - timedelta(hours=self.populate_interval)
+
+        while end_date < datetime.utcnow().replace(tzinfo=self.tz_utc) + timedelta(hours=self.populate_interval):
+
+            if self.engine.stopping.is_set() or self.sync_errors >= NIF_SYNC_MAX_ERRORS:
+                return
+
+            self.state.set_state(state='waiting', reason='connection pool')
+
+            async with self.engine.semaphore:
+                self.state.set_state(state='running')
+
+                if end_date > datetime.utcnow().replace(tzinfo=self.tz_utc):
+                    end_date = datetime.utcnow().replace(tzinfo=self.tz_utc)
+
+                    if await self.get_changes(start_date, end_date) is True:
+                        await self._set_checkpoint(end_date)
+                        break
+                else:
+                    if await self.get_changes(start_date, end_date) is True:
+                        await self._set_checkpoint(end_date)
+                        start_date = end_date
+                        end_date = end_date + timedelta(hours=self.populate_interval)
+
+        self.initial_start = start_date
+        self.state.set_state(mode='populate', state='finished', reason='ended populate')
+
+    async def sync(self) -> None:
+        """Get change messages since last sync, see :py:meth:`sync.NifSync.sync`"""
+
+        self.state.set_state(mode='sync', state='running')
+
+        end = datetime.utcnow().replace(tzinfo=self.tz_utc)
+
+        if self.initial_start is None:
+            self.initial_start = end - timedelta(minutes=self.sync_interval)
+            start = self.initial_start
+        else:
+            start = self.initial_start + timedelta(seconds=self.initial_timedelta)
+
+        if end > start:
+            if await self.get_changes(start, end):
+                self.initial_start = end
+                await self._set_checkpoint(end)
+        else:
+            self.log.error('Inconsistence between dates')
+
+        self.state.set_state(mode='sync', state='sleeping')
+
+    async def get_changes(self, start_date, end_date) -> bool:
+        """Get change messages from NIF and insert them into the api
+
+        :return: True on success
+        :rtype: bool
+        """
+
+        self.from_to = [start_date, end_date]
+
+        await asyncio.sleep(NIF_SYNC_DELAY)
+
+        if self.sync_type == 'changes':
+            func = self.nif.get_changes
+        elif self.sync_type == 'competence':
+            func = self.nif.get_changes_competence
+        elif self.sync_type == 'license':
+            func = self.nif.get_changes_license
+        else:
+            func = self.nif.get_changes_federation
+
+        try:
+            with NIF_CALL_SECONDS.time(call=getattr(func, '__name__', self.sync_type)):
+                status, changes = await self.engine.run_in_executor(func,
+                                                                    start_date.astimezone(self.tz_local),
+                                                                    end_date.astimezone(self.tz_local))
+
+            if status is not True:
+                self.log.error('GetChanges returned error: {0} - {1}'.format(changes.get('code', 0),
+                                                                             changes.get('error', 'Unknown error')))
+                raise Exception('get_changes returned an error')
+
+            self.log.debug('Got {} changes for {}'.format(len(changes), self.sync_type))
+
+            changes = prepare_changes(changes, self.org_id, self.log)
+            for i in range(0, len(changes), self.batch_size):
+                await self._post_changes(changes[i:i + self.batch_size])
+
+            if self.sync_errors > 0:
+                self.sync_errors -= 1
+
+            return True
+
+        except TypeError:
+            self.log.debug('TypeError: Empty change messages list ({})'.format(self.sync_type))
+        except Exception:
+            self.sync_errors += 1
+            self.log.exception('Exception in get_changes')
+
+        return False
+
+    async def _post_changes(self, batch) -> None:
+        """Bulk insert a list of change messages, see :py:meth:`sync.NifSync._post_changes`"""
+
+        payload = batch if len(batch) > 1 else batch[0]
+
+        async with self.engine.session.post(self.api_integration_url, json=payload) as resp:
+            status = resp.status
+            try:
+                r = await resp.json()
+            except Exception:
+                r = {}
+
+        if status == 201:
+            self.messages += len(batch)
+
+        elif status == 422:
+            if len(batch) == 1:
+                self.log.debug('422 {0} with id {1} already exists'.format(batch[0]['entity_type'], batch[0]['id']))
+                return
+
+            items = r.get('_items', [])
+
+            if len(items) != len(batch):
+                for v in batch:
+                    await self._post_changes([v])
+                return
+
+            retry = bulk_insert_retries(batch, items, self.log)
+            if len(retry) > 0:
+                await self._post_changes(retry)
+
+        else:
+            self.log.error('{0} - Could not create {1} change messages'.format(status, len(batch)))
+
+
+if __name__ == "__main__":
+    print('Running this file directly is not permittet')
+    sys.exit(0)
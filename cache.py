@@ -0,0 +1,159 @@
+"""
+.. module:: Cache
+    :platform: Unix
+    :synopsis: Bounded thread safe cache with time to live and LRU eviction
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS, CACHE_SIZE
+
+
+class TTLCache:
+    """A thread safe LRU cache where entries expire after ``ttl`` seconds
+
+    Each entry can carry a ``modified`` stamp. A lookup with a newer ``modified`` than the one stored is a miss and
+    drops the entry, the cached value can not reflect a change made after it was fetched.
+
+    :param maxsize: Max number of entries, the least recently used entry is evicted first
+    :type maxsize: int
+    :param ttl: Seconds an entry is valid, None for no expiry
+    :type ttl: int
+    :param name: Label of the cache in the ``cache_*`` metrics, None does not export the counters
+    :type name: str
+
+    Usage::
+
+        cache = TTLCache(maxsize=1000, ttl=300, name='stream_nif')  # Exported as cache_*{cache="stream_nif"}
+        cache.set(('Person', 1), person, modified=change.get_modified())
+        person = cache.get(('Person', 1), modified=change.get_modified())  # None on miss
+        cache.stats()
+    """
+
+    def __init__(self, maxsize=1000, ttl=300, name=None):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()  # key -> (value, expires, modified)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, modified=None, count=True):
+        """Get the value for ``key``
+
+        :param key: The key
+        :type key: hashable
+        :param modified: If the entry is older than this it is a miss
+        :type modified: datetime.datetime
+        :param count: If False do not count the lookup as a hit or miss
+        :type count: bool
+        :return: The value or None on miss
+        """
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is not None:
+                value, expires, stored = entry
+
+                if expires is not None and expires < time.monotonic():
+                    entry = None
+                elif modified is not None and stored is not None and not self._newer_or_equal(stored, modified):
+                    entry = None
+
+                if entry is None:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+
+            if count is True:
+                if entry is None:
+                    self.misses += 1
+                    if self.name is not None:
+                        CACHE_MISSES.inc(cache=self.name)
+                else:
+                    self.hits += 1
+                    if self.name is not None:
+                        CACHE_HITS.inc(cache=self.name)
+
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, modified=None) -> None:
+        """Set the value for ``key``
+
+        :param key: The key
+        :type key: hashable
+        :param value: The value
+        :param modified: The modified stamp of the value
+        :type modified: datetime.datetime
+        """
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None and old[2] is not None and modified is not None \
+                    and self._newer_or_equal(old[2], modified):
+                modified = old[2]
+
+            self._entries[key] = (value, expires, modified)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                if self.name is not None:
+                    CACHE_EVICTIONS.inc(cache=self.name)
+
+            if self.name is not None:
+                CACHE_SIZE.set(len(self._entries), cache=self.name)
+
+    def invalidate(self, key) -> None:
+        """Drop the entry for ``key``"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all entries"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Get the cache counters
+
+        :return: hits, misses, hit ratio, evictions and size
+        :rtype: dict
+        """
+
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'ratio': self.hits / lookups if lookups > 0 else 0.0,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl}
+
+    @staticmethod
+    def _newer_or_equal(a, b) -> bool:
+        """Compare stamps, stamps that can not be compared are treated as older"""
+
+        try:
+            return a >= b
+        except TypeError:
+            return False
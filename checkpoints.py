@@ -0,0 +1,202 @@
+"""
+.. module:: Sync checkpoints
+    :platform: Unix
+    :synopsis: Local store of sync progress for each worker
+"""
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import dateutil.parser
+
+from settings import SYNC_CHECKPOINT_FILE, NIF_REALM
+
+
+class SyncCheckpoints:
+    """Local SQLite store of sync progress keyed by ``(org_id, sync_type, realm)``
+
+    Holds the end of the last window fetched, which :py:meth:`sync.NifSync._check` resumes from without querying the
+    api, the plan and completed windows of a parallel populate, see :py:meth:`sync.NifSync.populate`, and the learned
+    GetChanges window size, see :py:class:`sync.AdaptiveWindow`.
+
+    All workers in a process can share one instance, each call uses its own connection.
+
+    :param path: The SQLite database file. Defaults to SYNC_CHECKPOINT_FILE
+    :type path: str
+
+    Usage::
+
+        from checkpoints import SyncCheckpoints
+        checkpoints = SyncCheckpoints()
+        checkpoints.set_checkpoint(org_id, 'changes', end)
+        checkpoints.get_checkpoint(org_id, 'changes')
+        checkpoints.set_plan(org_id, 'changes', anchor, 720)
+        checkpoints.add_window(org_id, 'changes', start, end)
+        checkpoints.get_windows(org_id, 'changes')
+        checkpoints.set_window_size(org_id, 'changes', 48)
+        checkpoints.clear()  # After the api is reset
+    """
+
+    def __init__(self, path=SYNC_CHECKPOINT_FILE):
+
+        self.path = path
+        self._lock = threading.Lock()
+
+        with self._connect() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS sync_checkpoints '
+                      '(org_id INTEGER, sync_type TEXT, realm TEXT, checkpoint TEXT, updated TEXT, '
+                      'PRIMARY KEY (org_id, sync_type, realm))')
+            c.execute('CREATE TABLE IF NOT EXISTS populate_plans '
+                      '(org_id INTEGER, sync_type TEXT, realm TEXT, anchor TEXT, interval REAL, '
+                      'PRIMARY KEY (org_id, sync_type, realm))')
+            c.execute('CREATE TABLE IF NOT EXISTS populate_windows '
+                      '(org_id INTEGER, sync_type TEXT, realm TEXT, start TEXT, end TEXT, '
+                      'PRIMARY KEY (org_id, sync_type, realm, start))')
+            c.execute('CREATE TABLE IF NOT EXISTS window_sizes '
+                      '(org_id INTEGER, sync_type TEXT, realm TEXT, size REAL, '
+                      'PRIMARY KEY (org_id, sync_type, realm))')
+
+    @contextmanager
+    def _connect(self):
+        """A connection in a transaction, committed on exit"""
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_checkpoint(self, org_id, sync_type, realm=NIF_REALM):
+        """Get the end of the last window fetched
+
+        :return: The checkpoint or None if missing
+        :rtype: datetime.datetime
+        """
+
+        with self._connect() as c:
+            row = c.execute('SELECT checkpoint FROM sync_checkpoints WHERE org_id=? AND sync_type=? AND realm=?',
+                            (org_id, sync_type, realm)).fetchone()
+
+        return None if row is None else dateutil.parser.parse(row[0])
+
+    def set_checkpoint(self, org_id, sync_type, checkpoint, realm=NIF_REALM) -> None:
+        """Store the end of the last window fetched
+
+        :param checkpoint: End of the window
+        :type checkpoint: datetime.datetime
+        """
+
+        with self._lock, self._connect() as c:
+            c.execute('INSERT OR REPLACE INTO sync_checkpoints VALUES (?, ?, ?, ?, ?)',
+                      (org_id, sync_type, realm, checkpoint.isoformat(), datetime.utcnow().isoformat()))
+
+    def get_plan(self, org_id, sync_type, realm=NIF_REALM):
+        """Get the unfinished populate plan
+
+        :return: (anchor, interval) where anchor is the start of the first window and interval is the window size in
+            hours, or None if no plan
+        :rtype: (datetime.datetime, float)
+        """
+
+        with self._connect() as c:
+            row = c.execute('SELECT anchor, interval FROM populate_plans WHERE org_id=? AND sync_type=? AND realm=?',
+                            (org_id, sync_type, realm)).fetchone()
+
+        if row is None:
+            return None
+
+        return dateutil.parser.parse(row[0]), row[1]
+
+    def set_plan(self, org_id, sync_type, anchor, interval, realm=NIF_REALM) -> None:
+        """Store a populate plan, replacing any existing plan and its windows
+
+        :param anchor: Start of the first window
+        :type anchor: datetime.datetime
+        :param interval: Window size in hours
+        :type interval: float
+        """
+
+        with self._lock, self._connect() as c:
+            c.execute('DELETE FROM populate_windows WHERE org_id=? AND sync_type=? AND realm=?',
+                      (org_id, sync_type, realm))
+            c.execute('INSERT OR REPLACE INTO populate_plans VALUES (?, ?, ?, ?, ?)',
+                      (org_id, sync_type, realm, anchor.isoformat(), interval))
+
+    def clear_plan(self, org_id, sync_type, realm=NIF_REALM) -> None:
+        """Remove the populate plan and its windows"""
+
+        with self._lock, self._connect() as c:
+            c.execute('DELETE FROM populate_windows WHERE org_id=? AND sync_type=? AND realm=?',
+                      (org_id, sync_type, realm))
+            c.execute('DELETE FROM populate_plans WHERE org_id=? AND sync_type=? AND realm=?',
+                      (org_id, sync_type, realm))
+
+    def get_windows(self, org_id, sync_type, realm=NIF_REALM) -> list:
+        """Get all completed windows
+
+        :return: (start, end) of each completed window ordered by start
+        :rtype: list[(datetime.datetime, datetime.datetime)]
+        """
+
+        with self._connect() as c:
+            rows = c.execute('SELECT start, end FROM populate_windows WHERE org_id=? AND sync_type=? AND realm=?',
+                             (org_id, sync_type, realm)).fetchall()
+
+        return sorted((dateutil.parser.parse(r[0]), dateutil.parser.parse(r[1])) for r in rows)
+
+    def add_window(self, org_id, sync_type, start, end, realm=NIF_REALM) -> None:
+        """Mark the window from ``start`` to ``end`` as completed
+
+        :param start: Start of the window
+        :type start: datetime.datetime
+        :param end: End of the window
+        :type end: datetime.datetime
+        """
+
+        with self._lock, self._connect() as c:
+            c.execute('INSERT OR REPLACE INTO populate_windows VALUES (?, ?, ?, ?, ?)',
+                      (org_id, sync_type, realm, start.isoformat(), end.isoformat()))
+
+    def get_window_size(self, org_id, sync_type, realm=NIF_REALM):
+        """Get the learned window size
+
+        :return: Window size in hours or None if not learned
+        :rtype: float
+        """
+
+        with self._connect() as c:
+            row = c.execute('SELECT size FROM window_sizes WHERE org_id=? AND sync_type=? AND realm=?',
+                            (org_id, sync_type, realm)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_window_size(self, org_id, sync_type, size, realm=NIF_REALM) -> None:
+        """Store the learned window size
+
+        :param size: Window size in hours
+        :type size: float
+        """
+
+        with self._lock, self._connect() as c:
+            c.execute('INSERT OR REPLACE INTO window_sizes VALUES (?, ?, ?, ?)', (org_id, sync_type, realm, size))
+
+    def clear(self) -> int:
+        """Remove all checkpoints, populate plans, windows and window sizes
+
+        Must be called when the change messages in the api are deleted, else the workers resume from the checkpoints
+        and never populate the api again. See :py:mod:`reset_api`.
+
+        :return: Number of rows removed
+        :rtype: int
+        """
+
+        count = 0
+
+        with self._lock, self._connect() as c:
+            for table in ['sync_checkpoints', 'populate_plans', 'populate_windows', 'window_sizes']:
+                count += c.execute('DELETE FROM {}'.format(table)).rowcount
+
+        return count
@@ -15,17 +15,24 @@ def async(f):
     return wrapper
 
 
-def track_time_spent(name):
+def track_time_spent(name, histogram=None, **labels):
     """Time something
+
+    If a :py:class:`metrics.Histogram` is given the time is observed with ``labels``, else it is printed.
     """
 
     def decorator(f):
         @wraps(f)
         def wrapped(*args, **kwargs):
             start = datetime.now()
-            delta = datetime.now() - start
-            print(name, "took", delta.total_seconds(), "seconds")
-            return f(*args, **kwargs)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                delta = datetime.now() - start
+                if histogram is not None:
+                    histogram.observe(delta.total_seconds(), **labels)
+                else:
+                    print(name, "took", delta.total_seconds(), "seconds")
 
         return wrapped
 
@@ -1,7 +1,8 @@
-from eve_api.api import *
-from eve_api.change import *
 from eve_api.eve_jsonencoder import *
 from eve_api.exceptions import *
+from eve_api.session import *
+from eve_api.api import *
+from eve_api.change import *
 
 # from eve_api.integration_changes import *
 # from eve_api.client import *
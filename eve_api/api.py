@@ -1,4 +1,4 @@
-import requests
+from eve_api.session import lungo
 from settings import API_URL, API_HEADERS
 
 class Api:
@@ -9,7 +9,7 @@ class Api:
 
     def get_item(self, item, query=None):
 
-        resp = requests.get('{}/{}'.format(self.resource, item), headers=API_HEADERS)
+        resp = lungo.get('{}/{}'.format(self.resource, item), headers=API_HEADERS)
 
 class Query:
 
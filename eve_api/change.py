@@ -1,9 +1,17 @@
-import requests
-from settings import API_HEADERS, API_URL
-from bson import ObjectId
+from eve_api.session import lungo
+from settings import (
+    API_HEADERS,
+    API_URL,
+    STREAM_STATUS_BUFFER_SIZE,
+    STREAM_STATUS_BUFFER_INTERVAL
+)
+from bson import ObjectId, json_util
+from collections import OrderedDict
 import dateutil.parser
 import datetime
+import threading
 from eve_api import EveJSONEncoder
+import hashlib
 import json
 
 
@@ -12,7 +20,17 @@ class ErrorNoEtag(Exception):
 
 
 class ChangeStreamItem:
-    def __init__(self, document):
+    """A change message from integration/changes
+
+    :param document: The change message
+    :type document: dict
+    :param status_buffer: If given, status transitions are handed to the buffer instead of being patched one by one
+    :type status_buffer: ChangeStatusBuffer
+    """
+
+    def __init__(self, document, status_buffer=None):
+
+        self.status_buffer = status_buffer
 
         self.change = document.copy()
 
@@ -45,6 +63,14 @@ class ChangeStreamItem:
     def set_status(self, status, error=None):
         """Sets the status of a change item"""
 
+        if self.status_buffer is not None:
+            return self.status_buffer.add(self, status, error)
+
+        return self._patch_status(status, error)
+
+    def _patch_status(self, status, error=None):
+        """Patch the status of a change item in the api"""
+
         if status in ['ready', 'pending', 'finished', 'error']:
 
             payload = {'_status': status}
@@ -52,9 +78,9 @@ class ChangeStreamItem:
             if error is not None:
                 payload.update({'_issues': error})
 
-            r = requests.patch('%s/%s' % (self.api_url, self._id),
-                               data=json.dumps(payload, cls=EveJSONEncoder),
-                               headers=self._get_headers_etag())
+            r = lungo.patch('%s/%s' % (self.api_url, self._id),
+                            data=json.dumps(payload, cls=EveJSONEncoder),
+                            headers=self._get_headers_etag())
 
             # print('Patch status %s %s - url: %s/%s' % (status, r.status_code, self.api_url, self._id))
 
@@ -68,8 +94,8 @@ class ChangeStreamItem:
                     return True
             elif r.status_code == 412:
                 # Client and server etags don't match
-                new = requests.get('%s/%s' % (self.api_url, self._id),
-                                   headers=API_HEADERS)
+                new = lungo.get('%s/%s' % (self.api_url, self._id),
+                                headers=API_HEADERS)
 
                 if new.status_code == 200:
 
@@ -80,7 +106,7 @@ class ChangeStreamItem:
 
                     elif '_etag' in new_json:
                         self._etag = new_json['_etag']
-                        self.set_status(status, error)
+                        return self._patch_status(status, error)
 
             else:
                 # print('Error in Change status', r.text)
@@ -122,3 +148,213 @@ class ChangeStreamItem:
 
         if key in self.change:
             return self.change[key]
+
+
+class ChangeStatusBuffer:
+    """Buffers status transitions of change messages and writes them in bulk
+
+    Only the last status of each change message is written. The ``pending`` status is never written, a change message
+    that is interrupted while processing is then left as ``ready`` and picked up on recover. Since ``finished`` and
+    ``error`` are only added after a change message is processed, a change message is never written as finished
+    without being processed.
+
+    With a :py:class:`pymongo.database.Database` all statuses are written with one ``bulk_write`` to
+    ``integration_changes``, with a new ``_etag`` for each change message as Eve would set it. Else each change message
+    gets one http PATCH, Eve has no bulk PATCH, and only the coalescing of transitions is saved.
+
+    The buffer is flushed when it holds ``max_size`` change messages, every ``interval`` seconds after
+    :py:meth:`start` and on :py:meth:`flush`.
+
+    :param db: The database holding ``integration_changes``, None to write via the api
+    :type db: pymongo.database.Database
+    :param max_size: Flush when this many change messages are buffered. Defaults to STREAM_STATUS_BUFFER_SIZE
+    :type max_size: int
+    :param interval: Seconds between each background flush. Defaults to STREAM_STATUS_BUFFER_INTERVAL
+    :type interval: int
+    :param log: The logger
+    :type log: app_logger.AppLogger
+    """
+
+    def __init__(self, db=None, max_size=STREAM_STATUS_BUFFER_SIZE, interval=STREAM_STATUS_BUFFER_INTERVAL, log=None):
+
+        self.db = db
+        self.max_size = max(1, max_size)
+        self.interval = interval
+        self.log = log
+
+        self.writes = 0  # Number of write requests
+        self.transitions = 0  # Number of status transitions added
+
+        self._items = OrderedDict()  # _id -> (ChangeStreamItem, status, error)
+        self._checkpoint = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item, status, error=None) -> bool:
+        """Add a status transition
+
+        :param item: The change message
+        :type item: ChangeStreamItem
+        :param status: The new status
+        :type status: str
+        :param error: Optional issues
+        :type error: dict
+        :return: True if the transition is accepted
+        :rtype: bool
+        """
+
+        if status not in ['ready', 'pending', 'finished', 'error']:
+            return False
+
+        self.transitions += 1
+
+        if status == 'pending':
+            return True
+
+        with self._lock:
+            self._items.pop(item._id, None)
+            self._items[item._id] = (item, status, error)
+            full = len(self._items) >= self.max_size
+
+        if full:
+            self.flush()
+
+        return True
+
+    def set_checkpoint(self, checkpoint) -> None:
+        """Set a callable to run after the next successful flush
+
+        Every status added before the checkpoint is set is written before the checkpoint is called. Only the last
+        checkpoint set is kept.
+
+        :param checkpoint: The callable
+        :type checkpoint: callable
+        """
+
+        with self._lock:
+            self._checkpoint = checkpoint
+
+    def flush(self) -> bool:
+        """Write all buffered statuses
+
+        :return: True if all statuses were written
+        :rtype: bool
+        """
+
+        with self._flush_lock:
+
+            with self._lock:
+                items = self._items
+                checkpoint = self._checkpoint
+                self._items = OrderedDict()
+                self._checkpoint = None
+
+            if len(items) == 0 and checkpoint is None:
+                return True
+
+            try:
+                if len(items) > 0:
+                    if self.db is not None:
+                        self._bulk_write(items)
+                    else:
+                        self._patch(items)
+            except Exception:
+                if self.log is not None:
+                    self.log.exception('Could not write {} change message statuses'.format(len(items)))
+
+                # Put back what has not been replaced by a newer status
+                with self._lock:
+                    for _id, value in items.items():
+                        if _id not in self._items:
+                            self._items[_id] = value
+                    if self._checkpoint is None:
+                        self._checkpoint = checkpoint
+
+                return False
+
+            if checkpoint is not None:
+                checkpoint()
+
+        return True
+
+    def _bulk_write(self, items) -> None:
+        """Write the statuses directly to MongoDB
+
+        The documents are read first to compute the new ``_etag``, so clients holding the old ``_etag`` get a 412 on
+        PATCH or PUT as if the status was written through Eve.
+        """
+
+        from pymongo import UpdateOne
+
+        now = datetime.datetime.utcnow().replace(microsecond=0)  # Eve's precision
+        ids = [ObjectId(_id) for _id in items]
+        documents = {d['_id']: d for d in self.db.integration_changes.find({'_id': {'$in': ids}})}
+        operations = []
+
+        for _id, (item, status, error) in items.items():
+            document = documents.get(ObjectId(_id), None)
+            if document is None:
+                continue
+
+            update = {'_status': status, '_updated': now}
+            if error is not None:
+                update['_issues'] = json.loads(json.dumps(error, cls=EveJSONEncoder))
+
+            document.update(update)
+            update['_etag'] = document['_etag'] = self._etag(document)
+
+            operations.append(UpdateOne({'_id': document['_id']}, {'$set': update}))
+
+        if len(operations) > 0:
+            self.db.integration_changes.bulk_write(operations, ordered=False)
+        self.writes += 1
+
+        for _id, (item, status, error) in items.items():
+            document = documents.get(ObjectId(_id), None)
+            if document is not None:
+                item.change['_etag'] = item._etag = document['_etag']
+            item.change['_status'] = status
+
+    @staticmethod
+    def _etag(document) -> str:
+        """The ``_etag`` of a document as computed by Eve's ``document_etag``"""
+
+        value = {k: v for k, v in document.items() if k != '_etag'}
+
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=json_util.default).encode('utf-8')).hexdigest()
+
+    def _patch(self, items) -> None:
+        """Write the statuses via the api, one PATCH for each change message"""
+
+        for _id, (item, status, error) in items.items():
+            if item._patch_status(status, error) is not True and self.log is not None:
+                self.log.error('Could not set status {} for change message {}'.format(status, _id))
+            self.writes += 1
+
+    def start(self) -> None:
+        """Start flushing in the background every :py:attr:`interval` seconds"""
+
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._flusher, name='status-buffer', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background flushing and write remaining statuses"""
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def _flusher(self) -> None:
+
+        while not self._stop.wait(self.interval):
+            self.flush()
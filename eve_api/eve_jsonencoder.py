@@ -1,4 +1,5 @@
 import json
+import hashlib
 from bson import ObjectId
 from datetime import datetime
 from dateutil import tz
@@ -47,3 +48,21 @@ class EveJSONEncoder(json.JSONEncoder):
             return str(float(o))
 
         return json.JSONEncoder.default(self, o)
+
+
+def content_hash(payload) -> str:
+    """A canonical hash of a payload
+
+    The payload is serialized with :py:class:`EveJSONEncoder` and sorted keys, so equal content always gives the same
+    hash regardless of key order.
+
+    :param payload: The payload
+    :type payload: dict
+    :return: sha1 hex digest
+    :rtype: str
+    """
+
+    return hashlib.sha1(json.dumps(payload,
+                                   cls=EveJSONEncoder,
+                                   sort_keys=True,
+                                   separators=(',', ':')).encode('utf-8')).hexdigest()
@@ -0,0 +1,82 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from settings import API_URL, SYNC_CONNECTIONPOOL_SIZE, STREAM_WORKERS
+from metrics import LUNGO_REQUEST_SECONDS
+
+
+class LungoSession:
+    """A shared keep-alive http session for all calls to the Lungo api
+
+    All threads share one :py:class:`requests.Session` and its connection pool, so each connection to
+    ``API_URL`` is only set up once and then reused. The pool is sized to ``SYNC_CONNECTIONPOOL_SIZE`` plus
+    ``STREAM_WORKERS``.
+
+    The latency of each request is observed in :py:data:`metrics.LUNGO_REQUEST_SECONDS`.
+
+    The methods mirrors the module level functions in :py:mod:`requests`::
+
+        from eve_api import lungo
+        resp = lungo.get('{}/organizations/376'.format(API_URL), headers=API_HEADERS)
+
+    :param pool_size: Max number of connections kept alive. Defaults to SYNC_CONNECTIONPOOL_SIZE + STREAM_WORKERS
+    :type pool_size: int
+    """
+
+    def __init__(self, pool_size=SYNC_CONNECTIONPOOL_SIZE + STREAM_WORKERS):
+        self.pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """The shared session, created on first use"""
+
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount(API_URL, adapter)
+                    self._session = session
+
+        return self._session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+
+        t = time.time()
+        status = 'error'
+
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            status = resp.status_code
+            return resp
+        finally:
+            LUNGO_REQUEST_SECONDS.observe(time.time() - t, method=method, status=status)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs) -> requests.Response:
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs) -> requests.Response:
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self) -> None:
+        """Close all pooled connections, a new session is created on next use"""
+
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+lungo = LungoSession()
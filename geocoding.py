@@ -1,9 +1,8 @@
 import geocoder
 from decorators import async
 from settings import API_URL, API_HEADERS
-import requests
 import json
-from eve_api import EveJSONEncoder
+from eve_api import EveJSONEncoder, lungo
 
 
 @async
@@ -29,10 +28,10 @@ def update_person_location(person, url):
                 api_headers = API_HEADERS.copy()
                 api_headers['If-Match'] = person['_etag']
 
-                resp = requests.patch('{}/{}'.format(url, person['_id']),
-                                      headers=api_headers,
-                                      data=json.dumps({'address': person['address']}, cls=EveJSONEncoder)
-                                      )
+                resp = lungo.patch('{}/{}'.format(url, person['_id']),
+                                   headers=api_headers,
+                                   data=json.dumps({'address': person['address']}, cls=EveJSONEncoder)
+                                   )
 
 
 def get_geo(street, city='', zip_code='', country='Norway'):
@@ -1,9 +1,12 @@
+import heapq
+import itertools
+import threading
 import time
 import json
-import requests
+from concurrent.futures import Future, ThreadPoolExecutor
 from random import sample
 
-from eve_api import EveJSONEncoder
+from eve_api import EveJSONEncoder, lungo
 from app_logger import AppLogger
 
 from settings import NIF_INTEGRATION_URL, ACLUBP, ACLUBU, NIF_INTEGRATION_GROUPS_AS_CLUBS
@@ -19,7 +22,11 @@ from settings import (
     NIF_INTEGRATION_FUNCTION_TYPE_ID,
     NLF_ORG_STRUCTURE,
     NIF_PLATFORM_FUNCTION_ID,
-    NIF_REALM
+    NIF_REALM,
+    NIF_INTEGRATION_AUTH_DELAY,
+    NIF_AUTH_PROBE_WORKERS,
+    NIF_AUTH_PROBE_DELAY,
+    NIF_AUTH_PROBE_MAX_DELAY
 )
 
 from nif_api import NifApiIntegration, NifApiSynchronization
@@ -53,9 +60,24 @@ class NifIntegrationUser:
 
     .. attention::
         It might take up to (or more) than 180 seconds from creating a user before that user can be authenticated
+
+    .. note::
+        ``api_users`` and ``club`` are the records from :py:meth:`NifIntegration.get_integration_users` and
+        :py:meth:`NifIntegration.get_club_details`, given they are not fetched from the api for each club.
+
+    :param club_id: The club id
+    :type club_id: int
+    :param create_delay: Max seconds to wait for a user to authenticate, 0 does not wait
+    :type create_delay: int
+    :param log_file: Log file for the NIF client
+    :type log_file: str
+    :param api_users: The active integration users for the club in the api, None fetches them
+    :type api_users: list[dict]
+    :param club: (created, name) of the club, None fetches them if needed
+    :type club: tuple
     """
 
-    def __init__(self, club_id, create_delay=1, log_file='integration_user.log'):
+    def __init__(self, club_id, create_delay=1, log_file='integration_user.log', api_users=None, club=None):
 
         self.ALPHNUM = (
                 'abcdefghijklmnopqrstuvwxyz' +
@@ -69,6 +91,7 @@ class NifIntegrationUser:
         self.user_id = None
         self.club_created = None
         self.club_name = None
+        self.created = False  # True if the user was created now and might not authenticate yet
         self.log_file = log_file
 
         self.log = AppLogger('klubb-{0}'.format(club_id))
@@ -76,25 +99,33 @@ class NifIntegrationUser:
         self.log.debug('[Integration user]')
 
         self.club_id = club_id
+        self.club = club
 
         self.test_client = None
 
-        api_user = requests.get(
-            '%s/integration/users/?where={"club_id": %s, "_active": true, "_realm": "%s"}&max_results=1000' % (API_URL,
-                                                                                                               self.club_id,
-                                                                                                               NIF_REALM),
-            headers=API_HEADERS)
+        if api_users is None:
+            api_user = lungo.get(
+                '%s/integration/users/?where={"club_id": %s, "_active": true, "_realm": "%s"}&max_results=1000' % (
+                    API_URL,
+                    self.club_id,
+                    NIF_REALM),
+                headers=API_HEADERS)
+
+            status_code = api_user.status_code
+            if status_code == 200:
+                api_users = api_user.json()['_items']
+        else:
+            status_code = 200
 
-        if api_user.status_code == 200:
-            api_users_json = api_user.json()
+        if status_code == 200:
 
-            if len(api_users_json['_items']) > 1:  # multiple users
+            if len(api_users) > 1:  # multiple users
                 self.log.error('More than one active club in realm {} for club id {}'.format(NIF_REALM, self.club_id))
                 raise NifIntegrationUserError('More than one active club')
 
-            elif len(api_users_json['_items']) == 1:  # One user only
+            elif len(api_users) == 1:  # One user only
 
-                api_user_json = api_users_json['_items'][0]
+                api_user_json = api_users[0]
 
                 self.username = '{0}/{1}/{2}'.format(NIF_CLUB_APP_ID,
                                                      api_user_json['function_id'],
@@ -118,7 +149,7 @@ class NifIntegrationUser:
                         self.log.error('Failed authentication via Hello')
                         time.sleep(5)
 
-            elif len(api_users_json['_items']) == 0:  # No users found but 200 anyway
+            elif len(api_users) == 0:  # No users found but 200 anyway
                 """Not found create user!"""
                 self.log.debug('No existing integration user found but http 200, creating...')
 
@@ -135,9 +166,9 @@ class NifIntegrationUser:
             else:
                 self.log.exception(
                     'Creation of user for club id {} failed, got {} users and http 200'.format(
-                        self.club_id, len(api_users_json['_items'])))
+                        self.club_id, len(api_users)))
 
-        elif api_user.status_code == 404:
+        elif status_code == 404:
             """Not found create user!"""
             self.log.debug('No existing integration user found, creating...')
 
@@ -165,36 +196,57 @@ class NifIntegrationUser:
             raise NifIntegrationUserError
 
     def _time_authentication(self, create_delay) -> bool:
+        """Wait until the user can authenticate, see :py:class:`AuthenticationProber`
 
-        self.log.debug('Running auth test for {} with password {}'.format(self.username, self.password))
+        :param create_delay: Max seconds to wait
+        :type create_delay: int
+        :raises NifIntegrationUserAuthenticationError: If not authenticated within ``create_delay``
+        """
 
-        authenticated = False
-        time_spent = 0
-        increment = 10
+        self.log.debug('Running auth test for {} with password {}'.format(self.username, self.password))
 
-        while not authenticated:
-            print('.')
-            if time_spent > create_delay:
-                self.log.debug('Could not authenticate user after {} seconds'.format(time_spent))
-                raise NifIntegrationUserAuthenticationError('Can not authenticate user')
+        t = time.time()
+        prober = AuthenticationProber(workers=1, timeout=create_delay)
 
-            authenticated = self.test_login()
-            time.sleep(increment)
-            time_spent += increment
+        try:
+            authenticated = prober.probe(self).result()
+        finally:
+            prober.shutdown()
 
-            if time_spent > 220:
-                self.log.debug('Could NOT authenticate user after {} seconds, exiting'.format(time_spent))
-                break
+        if authenticated is not True:
+            self.log.debug('Could not authenticate user after {:.0f} seconds'.format(time.time() - t))
+            raise NifIntegrationUserAuthenticationError('Can not authenticate user')
 
-        if authenticated:
-            self.log.debug('Authenticated user after {} seconds'.format(time_spent))
+        self.log.debug('Authenticated user after {:.0f} seconds'.format(time.time() - t))
 
         return authenticated
 
+    def test_login(self) -> bool:
+        """Test if the user can authenticate in NIF
+
+        :return: True if authenticated
+        :rtype: bool
+        """
+
+        try:
+            self.test_client = NifApiSynchronization(username=self.username,
+                                                     password=self.password,
+                                                     realm=NIF_REALM,
+                                                     log_file=self.log_file,
+                                                     test_login=True)
+            return True
+        except Exception:
+            self.log.debug('Authentication failed for {}'.format(self.username))
+
+        return False
+
     def _get_club_details(self):
 
-        response = requests.get('{}/organizations/{}'.format(API_URL, self.club_id),
-                                headers=API_HEADERS)
+        if self.club is not None:
+            return self.club
+
+        response = lungo.get('{}/organizations/{}'.format(API_URL, self.club_id),
+                             headers=API_HEADERS)
 
         if response.status_code == 200:
 
@@ -282,12 +334,13 @@ class NifIntegrationUser:
                        '_realm': NIF_REALM,
                        '_active': True}
 
-            api_user = requests.post('{}/integration/users'.format(API_URL),
-                                     data=json.dumps(payload, cls=EveJSONEncoder),
-                                     headers=API_HEADERS
-                                     )
+            api_user = lungo.post('{}/integration/users'.format(API_URL),
+                                  data=json.dumps(payload, cls=EveJSONEncoder),
+                                  headers=API_HEADERS
+                                  )
             if api_user.status_code == 201:
                 self.log.debug('Successfully created user in Lungo')
+                self.created = True
                 return True  # Instead of returning void, return something else
             else:
                 self.log.error('Could not create user in Lungo')
@@ -333,13 +386,210 @@ class NifIntegrationUser:
         return passwords
 
 
+class AuthenticationProber:
+    """Test authentication of many integration users concurrently
+
+    Each call to :py:meth:`probe` returns a :py:class:`concurrent.futures.Future` resolved with True when the user
+    authenticates, or False after ``timeout`` seconds. Failed attempts are retried with exponential backoff from
+    ``delay`` up to ``max_delay`` seconds, attempts for all users share a pool of ``workers`` threads.
+
+    :param workers: Number of concurrent login tests. Defaults to NIF_AUTH_PROBE_WORKERS
+    :type workers: int
+    :param delay: Seconds before the first retry. Defaults to NIF_AUTH_PROBE_DELAY
+    :type delay: float
+    :param max_delay: Max seconds between retries. Defaults to NIF_AUTH_PROBE_MAX_DELAY
+    :type max_delay: float
+    :param timeout: Seconds before giving up on a user. Defaults to NIF_INTEGRATION_AUTH_DELAY
+    :type timeout: float
+    :param stopper: a threading.Event flag to exit
+    :type stopper: threading.Event
+
+    Usage::
+
+        prober = AuthenticationProber()
+        future = prober.probe(NifIntegrationUser(club_id))
+        future.add_done_callback(lambda f: print(f.result()))
+    """
+
+    def __init__(self,
+                 workers=NIF_AUTH_PROBE_WORKERS,
+                 delay=NIF_AUTH_PROBE_DELAY,
+                 max_delay=NIF_AUTH_PROBE_MAX_DELAY,
+                 timeout=NIF_INTEGRATION_AUTH_DELAY,
+                 stopper=None):
+
+        self.delay = delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.stopper = stopper
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth-probe')
+
+        self._heap = []  # (due, seq, user, future, attempt, started)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+
+        self._thread = threading.Thread(target=self._run, name='auth-prober', daemon=True)
+        self._thread.start()
+
+    def probe(self, user, delay=0) -> Future:
+        """Test authentication of a user until it succeeds or times out
+
+        :param user: The integration user
+        :type user: NifIntegrationUser
+        :param delay: Seconds before the first attempt, e.g. for a user just created
+        :type delay: float
+        :return: Future resolved with True if authenticated
+        :rtype: concurrent.futures.Future
+        """
+
+        future = Future()
+        self._schedule(user, future, time.time() + delay, 0, time.time())
+
+        return future
+
+    def shutdown(self) -> None:
+        """Stop probing, pending users are resolved with False"""
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        self._thread.join()
+        self.executor.shutdown(wait=False)
+
+    def _schedule(self, user, future, due, attempt, started) -> None:
+
+        with self._cond:
+            if self._stopping is True:
+                future.set_result(False)
+                return
+
+            heapq.heappush(self._heap, (due, next(self._seq), user, future, attempt, started))
+            self._cond.notify()
+
+    def _run(self) -> None:
+        """Submit attempts when due"""
+
+        with self._cond:
+            while self._stopping is False:
+                if self.stopper is not None and self.stopper.is_set():
+                    self._stopping = True
+                    break
+
+                if len(self._heap) == 0:
+                    self._cond.wait(1)
+                    continue
+
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._cond.wait(min(wait, 1))
+                    continue
+
+                due, seq, user, future, attempt, started = heapq.heappop(self._heap)
+                self.executor.submit(self._attempt, user, future, attempt, started)
+
+            pending, self._heap = self._heap, []
+
+        for due, seq, user, future, attempt, started in pending:
+            future.set_result(False)
+
+    def _attempt(self, user, future, attempt, started) -> None:
+
+        try:
+            authenticated = user.test_login()
+        except Exception:
+            authenticated = False
+
+        if authenticated is True:
+            future.set_result(True)
+        elif self._stopping is True or time.time() - started >= self.timeout:
+            future.set_result(False)
+        else:
+            delay = min(self.max_delay, self.delay * 2 ** attempt)
+            self._schedule(user, future, time.time() + delay, attempt + 1, started)
+
+
 class NifIntegration:
     def __init__(self):
 
         pass
 
+    def _get_all(self, resource, where, projection=None, max_results=500):
+        """Get all items in all pages of a query
+
+        :return: The items or None on errors
+        :rtype: list[dict]
+        """
+
+        items = []
+        page = 1
+        params = {'where': json.dumps(where), 'max_results': max_results}
+        if projection is not None:
+            params['projection'] = json.dumps(projection)
+
+        while True:
+            params['page'] = page
+            r = lungo.get('{}/{}'.format(API_URL, resource), params=params, headers=API_HEADERS)
+
+            if r.status_code != 200:
+                return None
+
+            resp = r.json()
+            items += resp.get('_items', [])
+
+            if 'next' not in resp.get('_links', {}):
+                return items
+
+            page += 1
+
+    def get_integration_users(self):
+        """Get all active integration users in the realm
+
+        :return: The integration users for each club id or None on errors
+        :rtype: dict[int, list[dict]]
+        """
+
+        items = self._get_all('integration/users', {'_active': True, '_realm': NIF_REALM})
+
+        if items is None:
+            return None
+
+        users = {}
+        for item in items:
+            users.setdefault(item['club_id'], []).append(item)
+
+        return users
+
+    def get_club_details(self, club_ids, chunk_size=500):
+        """Get created and name for a list of clubs with ``$in`` queries
+
+        :param club_ids: The club ids
+        :type club_ids: list[int]
+        :return: (created, name) for each club id found or None on errors
+        :rtype: dict[int, tuple]
+        """
+
+        clubs = {}
+        club_ids = list(club_ids)
+
+        for i in range(0, len(club_ids), chunk_size):
+            items = self._get_all('organizations',
+                                  {'id': {'$in': club_ids[i:i + chunk_size]}},
+                                  projection={'id': 1, 'created': 1, 'name': 1})
+
+            if items is None:
+                return None
+
+            for item in items:
+                if 'created' in item and 'name' in item:
+                    clubs[item['id']] = (item['created'], item['name'])
+
+        return clubs
+
     def get_active_clubs_from_ka(self) -> [int]:
-        r = requests.get(
+        r = lungo.get(
             '{}/ka/clubs?max_results=10000&where={{"IsActive": true, "OrgTypeId": {{"$in": [5,6]}} }}'.format(API_URL),
             headers=API_HEADERS)
 
@@ -354,8 +604,8 @@ class NifIntegration:
 
     def get_ka_clubs(self, active=True) -> [int]:
 
-        r = requests.get('{}/ka/clubs?max_results=1000'.format(API_URL),
-                         headers=API_HEADERS)
+        r = lungo.get('{}/ka/clubs?max_results=1000'.format(API_URL),
+                      headers=API_HEADERS)
 
         if r.status_code == 200:
             resp = r.json()
@@ -368,8 +618,8 @@ class NifIntegration:
 
     def get_club_list(self) -> [int]:
 
-        r = requests.get('%s/organizations?where={"type_id":5}&max_results=1000' % API_URL,
-                         headers=API_HEADERS)
+        r = lungo.get('%s/organizations?where={"type_id":5}&max_results=1000' % API_URL,
+                      headers=API_HEADERS)
 
         if r.status_code == 200:
             resp = r.json()
@@ -383,8 +633,8 @@ class NifIntegration:
     def get_clubs(self) -> [dict]:
         """Gets all clubs in organization"""
 
-        r = requests.get('%s/organizations?where={"type_id":5, "is_active": true}&max_results=1000' % API_URL,
-                         headers=API_HEADERS)
+        r = lungo.get('%s/organizations?where={"type_id":5, "is_active": true}&max_results=1000' % API_URL,
+                      headers=API_HEADERS)
 
         if r.status_code == 200:
             resp = r.json()
@@ -417,10 +667,10 @@ class NifIntegration:
 
             if status is True:
 
-                post = requests.post('{0}/organizations/process'.format(API_URL),
-                                     data=json.dumps(org, cls=EveJSONEncoder),
-                                     headers=API_HEADERS
-                                     )
+                post = lungo.post('{0}/organizations/process'.format(API_URL),
+                                  data=json.dumps(org, cls=EveJSONEncoder),
+                                  headers=API_HEADERS
+                                  )
                 # print('Type id', org['type_id'])
                 if post.status_code == 201:
                     # print('Success')
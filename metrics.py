@@ -0,0 +1,296 @@
+"""
+.. module:: Metrics
+    :platform: Unix
+    :synopsis: Counters, gauges and latency histograms exposed via Pyro and a Prometheus style text endpoint
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from settings import METRICS_BUCKETS, METRICS_HOST
+
+
+class _Metric:
+    """Base for metrics with a value for each combination of label values"""
+
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def _format_labels(self, key, extra=None) -> str:
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+
+        if len(pairs) == 0:
+            return ''
+
+        return '{%s}' % ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in pairs)
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, self._format_labels(key), value))
+
+        return lines
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {','.join(key) if len(key) > 0 else '': value for key, value in self._values.items()}
+
+
+class Counter(_Metric):
+    """A value that only increases
+
+    Usage::
+
+        CHANGES.inc(len(changes), sync_type='changes')
+    """
+
+    type = 'counter'
+
+    def inc(self, value=1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """A value that can go up and down
+
+    Usage::
+
+        QUEUE_DEPTH.set(dispatcher.pending, lane='live')
+    """
+
+    type = 'gauge'
+
+    def set(self, value, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value=1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels) -> None:
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, typically latencies in seconds
+
+    Usage::
+
+        with NIF_CALL_SECONDS.time(call='get_person'):
+            status, person = api.get_person(person_id)
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels) -> None:
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the context"""
+
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - t, **labels)
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, ('le', bound)),
+                                                         cumulative))
+                lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(key, ('le', '+Inf')), count))
+                lines.append('{}_sum{} {}'.format(self.name, self._format_labels(key), total))
+                lines.append('{}_count{} {}'.format(self.name, self._format_labels(key), count))
+
+        return lines
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {','.join(key) if len(key) > 0 else '': {'count': count,
+                                                            'sum': total,
+                                                            'avg': total / count if count > 0 else 0.0,
+                                                            'buckets': {str(b): c for b, c in zip(self.buckets, counts)}}
+                    for key, (counts, total, count) in self._values.items()}
+
+
+class Registry:
+    """Holds all metrics in a process
+
+    Metrics are created once by name, asking for an existing name returns the existing metric.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self._get(Counter, name, description, labels)
+
+    def gauge(self, name, description, labels=()) -> Gauge:
+        return self._get(Gauge, name, description, labels)
+
+    def histogram(self, name, description, labels=(), buckets=METRICS_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, description, labels, buckets)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """All metrics as plain dicts, for Pyro"""
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return {m.name: m.snapshot() for m in metrics}
+
+
+registry = Registry()
+
+# NIF and Lungo
+NIF_CALL_SECONDS = registry.histogram('nif_call_seconds', 'Latency of NIF SOAP calls', labels=('call',))
+LUNGO_REQUEST_SECONDS = registry.histogram('lungo_request_seconds', 'Latency of Lungo api requests',
+                                           labels=('method', 'status'))
+
+# Sync
+SYNC_WINDOW_SECONDS = registry.histogram('sync_window_seconds', 'Time to get and post a window of change messages',
+                                         labels=('mode', 'sync_type'))
+SYNC_CHANGES = registry.counter('sync_changes_total', 'Change messages received from NIF', labels=('sync_type',))
+SYNC_CHANGES_PER_SECOND = registry.gauge('sync_changes_per_second', 'Change messages per second in the last window',
+                                         labels=('worker',))
+POOL_WAIT_SECONDS = registry.histogram('pool_wait_seconds', 'Time waiting for a slot in the connection pool',
+                                       labels=('mode',))
+POOL_HOLD_SECONDS = registry.histogram('pool_hold_seconds', 'Time holding a slot in the connection pool',
+                                       labels=('mode',))
+POOL_WAITING = registry.gauge('pool_waiting', 'Workers waiting for a slot in the connection pool')
+POOL_IN_USE = registry.gauge('pool_in_use', 'Slots in use in the connection pool')
+POOL_SIZE = registry.gauge('pool_size', 'Slots in the connection pool')
+
+# Stream
+STREAM_QUEUE_DEPTH = registry.gauge('stream_queue_depth', 'Change messages submitted but not finished')
+STREAM_CHANGE_SECONDS = registry.histogram('stream_change_seconds', 'Time to process a change message',
+                                           labels=('entity_type',))
+STREAM_WRITES = registry.counter('stream_writes_total', 'Documents written to the api', labels=('entity_type',))
+STREAM_WRITES_SKIPPED = registry.counter('stream_writes_skipped_total',
+                                         'Writes to the api skipped because the payload was unchanged',
+                                         labels=('entity_type',))
+STREAM_LANE_DEPTH = registry.gauge('stream_lane_depth', 'Entities ready to be processed in each lane', labels=('lane',))
+STREAM_LANE_WAIT_SECONDS = registry.histogram('stream_lane_wait_seconds',
+                                              'Time from submit until a change message is started', labels=('lane',))
+STREAM_LANE_SECONDS = registry.histogram('stream_lane_seconds',
+                                         'Time from submit until a change message is finished', labels=('lane',))
+
+# Cache
+CACHE_HITS = registry.counter('cache_hits_total', 'Cache lookups found', labels=('cache',))
+CACHE_MISSES = registry.counter('cache_misses_total', 'Cache lookups not found, expired or outdated', labels=('cache',))
+CACHE_EVICTIONS = registry.counter('cache_evictions_total', 'Cache entries evicted to stay within the max size',
+                                   labels=('cache',))
+CACHE_SIZE = registry.gauge('cache_size', 'Entries in the cache', labels=('cache',))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    """Serve :py:data:`registry` as Prometheus text on ``http://host:port/metrics``
+
+    :param port: The port
+    :type port: int
+    :param host: The interface to bind to. Defaults to METRICS_HOST
+    :type host: str
+
+    Usage::
+
+        from metrics import MetricsServer
+        server = MetricsServer(port=9101)
+        server.start()
+        server.shutdown()
+    """
+
+    def __init__(self, port, host=METRICS_HOST):
+        super().__init__(name='metrics-server', daemon=True)
+        self.server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+
+    def run(self) -> None:
+        self.server.serve_forever()
+
+    def shutdown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,352 @@
+"""
+.. module:: Organization index
+    :platform: Unix
+    :synopsis: In memory index of the organization hierarchy with ancestor, descendant and activity queries
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+import dateutil.parser
+
+from eve_api import lungo
+from settings import API_URL, API_HEADERS, NLF_ORG_STRUCTURE, ORG_INDEX_REFRESH_INTERVAL
+
+ORG_TYPE_CLUB = 5
+ORG_TYPE_GROUP = 6
+ORG_TYPE_GREN = 14
+
+
+class OrgIndex:
+    """In memory index of the organization hierarchy in the api
+
+    Answers structural questions, like which club a group or gren belongs to and which activities a club has,
+    without calls to NIF. All organizations are loaded from /organizations on first use. After ``refresh``
+    seconds the next query loads only the organizations with a newer ``_updated``. Organizations written elsewhere
+    can be applied directly with :py:meth:`update`. Concurrent queries after the interval refresh once.
+
+    Parents and children are dict lookups. Ancestors, descendants and activities are cached until the index changes.
+
+    :param refresh: Seconds between incremental refreshes from the api, 0 never refreshes. Defaults to
+        ORG_INDEX_REFRESH_INTERVAL
+    :type refresh: int
+
+    Usage::
+
+        from org_index import org_index
+        org_index.club(gren_id)  # The club a group or gren belongs to
+        org_index.ancestors(gren_id)
+        org_index.descendants(club_id, type_id=14)
+        org_index.activities(club_id)  # (activities, main_activity)
+    """
+
+    def __init__(self, refresh=ORG_INDEX_REFRESH_INTERVAL):
+
+        self.refresh_interval = refresh
+
+        self.loads = 0
+
+        self._orgs = {}  # id -> {'type_id', 'name', 'activities', 'main_activity'}
+        self._parents = {}  # id -> [(id, type_id)]
+        self._children = {}  # id -> [(id, type_id)]
+        self._cache = {}
+
+        self._updated = None  # Latest _updated seen, as returned by the api
+        self._loaded = None
+        self._lock = threading.RLock()
+
+    def __contains__(self, org_id):
+        self._ensure()
+        return org_id in self._orgs
+
+    def __len__(self):
+        self._ensure()
+        return len(self._orgs)
+
+    def get(self, org_id) -> dict:
+        """Get the indexed fields of an organization
+
+        :return: type_id, name, activities and main_activity or None if not indexed
+        :rtype: dict
+        """
+
+        self._ensure()
+        return self._orgs.get(org_id, None)
+
+    def parents(self, org_id, type_id=None) -> list:
+        """Ids of the direct parents of ``org_id``, only of ``type_id`` if given"""
+
+        self._ensure()
+        return [p for p, t in self._parents.get(org_id, []) if type_id is None or t == type_id]
+
+    def parent(self, org_id, type_id=None):
+        """Id of the first parent of ``org_id``, only of ``type_id`` if given, None if none"""
+
+        parents = self.parents(org_id, type_id)
+        return parents[0] if len(parents) > 0 else None
+
+    def children(self, org_id, type_id=None) -> list:
+        """Ids of the direct children of ``org_id``, only of ``type_id`` if given"""
+
+        self._ensure()
+        return [c for c, t in self._children.get(org_id, []) if type_id is None or t == type_id]
+
+    def ancestors(self, org_id) -> list:
+        """Ids of all ancestors of ``org_id``, nearest first"""
+
+        return self._cached(('ancestors', org_id), lambda: self._walk(org_id, self._parents))
+
+    def descendants(self, org_id, type_id=None) -> list:
+        """Ids of all descendants of ``org_id``, nearest first, only of ``type_id`` if given"""
+
+        descendants = self._cached(('descendants', org_id), lambda: self._walk(org_id, self._children))
+
+        if type_id is None:
+            return descendants
+
+        return [d for d in descendants if self._type(d) == type_id]
+
+    def club(self, org_id):
+        """Id of the club ``org_id`` belongs to, ``org_id`` itself if it is a club, None if not found"""
+
+        if self._type(org_id) == ORG_TYPE_CLUB:
+            return org_id
+
+        for a in self.ancestors(org_id):
+            if self._type(a) == ORG_TYPE_CLUB:
+                return a
+
+        return None
+
+    def activities(self, org_id) -> (list, dict):
+        """The activities of an organization
+
+        Organizations in NLF_ORG_STRUCTURE have the activity set there. A club with the general Luftsport main activity
+        gets the activities of its grens, as in :py:meth:`rebuild_api_resources.NifRebuildResources._get_gren`. Any
+        other organization without activities inherits from its nearest ancestor with activities.
+
+        :return: (activities, main_activity), ([], {}) if unknown
+        :rtype: (list, dict)
+        """
+
+        return self._cached(('activities', org_id), lambda: self._activities(org_id))
+
+    def gren_activities(self, club_id) -> (list, dict):
+        """Activities of the grens in ``club_id``, unique by id, and the main activity of the last gren
+
+        :rtype: (list, dict)
+        """
+
+        return self._cached(('gren_activities', club_id), lambda: self._gren_activities(club_id))
+
+    def update(self, org) -> None:
+        """Apply an organization, as from NIF or the api, to the index
+
+        :param org: The organization with ``id``, ``type_id`` and ``_up`` and ``_down``
+        :type org: dict
+        """
+
+        self._ensure()
+
+        with self._lock:
+            if self._apply(org) is True:
+                self._cache = {}
+
+    def refresh(self, full=False) -> int:
+        """Load organizations updated since the last load from the api
+
+        :param full: If True load all organizations
+        :type full: bool
+        :return: Number of organizations loaded
+        :rtype: int
+        """
+
+        with self._lock:
+            # _updated has a precision of seconds, $gte also loads organizations written in the same second as the
+            # last one seen. Loading an organization again is a no-op in _apply
+            where = {}
+            if full is False and self._updated is not None:
+                where = {'_updated': {'$gte': self._updated}}
+
+            count = 0
+            changed = False
+            page = 1
+
+            while True:
+                resp = lungo.get('{}/organizations'.format(API_URL),
+                                 params={'where': json.dumps(where),
+                                         'projection': json.dumps({'id': 1, 'type_id': 1, 'name': 1, '_up': 1,
+                                                                   '_down': 1, 'activities': 1, 'main_activity': 1,
+                                                                   '_updated': 1}),
+                                         'max_results': 500,
+                                         'page': page},
+                                 headers=API_HEADERS)
+
+                if resp.status_code != 200:
+                    raise Exception('Got http {} loading organizations'.format(resp.status_code))
+
+                result = resp.json()
+
+                for org in result.get('_items', []):
+                    changed = self._apply(org) or changed
+                    count += 1
+
+                    if self._updated is None or self._newer(org.get('_updated', None), self._updated):
+                        self._updated = org['_updated']
+
+                if 'next' not in result.get('_links', {}):
+                    break
+
+                page += 1
+
+            self._loaded = time.time()
+            self.loads += 1
+
+            if changed is True:
+                self._cache = {}
+
+            return count
+
+    def _ensure(self) -> None:
+        """Load on first use and refresh when older than :py:attr:`refresh_interval`"""
+
+        if self._loaded is None:
+            with self._lock:
+                if self._loaded is None:
+                    self.refresh(full=True)
+
+        elif 0 < self.refresh_interval < time.time() - self._loaded:
+            with self._lock:
+                # Refreshed by another caller while waiting for the lock
+                if 0 < self.refresh_interval < time.time() - self._loaded:
+                    try:
+                        self.refresh()
+                    except Exception:
+                        # Serve the current index, next query retries
+                        self._loaded = time.time()
+
+    def _apply(self, org) -> bool:
+        """Index ``org``, call with the lock held
+
+        :return: True if the index changed
+        :rtype: bool
+        """
+
+        org_id = org['id']
+
+        fields = {'type_id': org.get('type_id', None),
+                  'name': org.get('name', None),
+                  'activities': org.get('activities', []) or [],
+                  'main_activity': org.get('main_activity', {}) or {}}
+        parents = [(o['id'], o.get('type', None)) for o in org.get('_up', []) or [] if o['id'] != org_id]
+        children = [(o['id'], o.get('type', None)) for o in org.get('_down', []) or [] if o['id'] != org_id]
+
+        if self._orgs.get(org_id) == fields and self._parents.get(org_id) == parents \
+                and self._children.get(org_id) == children:
+            return False
+
+        self._orgs[org_id] = fields
+        self._parents[org_id] = parents
+        self._children[org_id] = children
+
+        return True
+
+    def _cached(self, key, func):
+
+        self._ensure()
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = func()
+
+            return self._cache[key]
+
+    def _walk(self, org_id, edges) -> list:
+        """Breadth-first walk from ``org_id`` along ``edges``"""
+
+        seen = {org_id}
+        result = []
+        frontier = deque([org_id])
+
+        while len(frontier) > 0:
+            for next_id, t in edges.get(frontier.popleft(), []):
+                if next_id not in seen:
+                    seen.add(next_id)
+                    result.append(next_id)
+                    frontier.append(next_id)
+
+        return result
+
+    def _type(self, org_id):
+        """Type of ``org_id``, from the organization or else from an edge to it"""
+
+        org = self._orgs.get(org_id, None)
+        if org is not None and org['type_id'] is not None:
+            return org['type_id']
+
+        for p, t in self._parents.get(org_id, []):
+            for c, ct in self._children.get(p, []):
+                if c == org_id:
+                    return ct
+
+        return None
+
+    def _activities(self, org_id) -> (list, dict):
+
+        if org_id in NLF_ORG_STRUCTURE and org_id != 1:
+            return [NLF_ORG_STRUCTURE[org_id]], NLF_ORG_STRUCTURE[org_id]
+
+        org = self._orgs.get(org_id, None)
+
+        if org is None:
+            return [], {}
+
+        if org['type_id'] == ORG_TYPE_CLUB and org['main_activity'].get('id', 27) == 27:
+            activities, main_activity = self._gren_activities(org_id)
+            if len(activities) > 0:
+                return activities, main_activity if len(main_activity) > 0 else org['main_activity']
+
+        if len(org['activities']) > 0 or len(org['main_activity']) > 0:
+            return org['activities'], org['main_activity']
+
+        for a in self._walk(org_id, self._parents):
+            if a in NLF_ORG_STRUCTURE and a != 1:
+                return [NLF_ORG_STRUCTURE[a]], NLF_ORG_STRUCTURE[a]
+
+            parent = self._orgs.get(a, None)
+            if parent is not None and (len(parent['activities']) > 0 or len(parent['main_activity']) > 0):
+                return parent['activities'], parent['main_activity']
+
+        return [], {}
+
+    def _gren_activities(self, club_id) -> (list, dict):
+
+        activities = []
+        main_activity = {}
+
+        for group in [c for c, t in self._children.get(club_id, []) if t == ORG_TYPE_GROUP]:
+            for gren in [c for c, t in self._children.get(group, []) if t == ORG_TYPE_GREN]:
+                org = self._orgs.get(gren, None)
+                if org is None:
+                    continue
+
+                if len(org['main_activity']) > 0:
+                    main_activity = org['main_activity']
+
+                activities += org['activities']
+
+        return list({a['id']: a for a in activities}.values()), main_activity
+
+    @staticmethod
+    def _newer(a, b) -> bool:
+
+        try:
+            return dateutil.parser.parse(a) > dateutil.parser.parse(b)
+        except Exception:
+            return False
+
+
+#: The shared index, loaded on first use
+org_index = OrgIndex()
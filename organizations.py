@@ -1,14 +1,20 @@
 import json
-import requests
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from nif_api import NifApiIntegration
 from settings import (
     API_HEADERS, API_URL,
     NIF_INTEGRATION_URL,
     ACLUBU, ACLUBP,
     NIF_REALM,
-    NLF_ORG_STRUCTURE
+    NLF_ORG_STRUCTURE,
+    NIF_ORG_CRAWL_WORKERS,
+    NIF_ORG_CRAWL_STATE_FILE,
+    NIF_ORG_SNAPSHOT_FILE
 )
-from eve_api import EveJSONEncoder
+from eve_api import EveJSONEncoder, lungo, content_hash
 from geocoding import add_organization_location
 
 from pprint import pprint
@@ -21,8 +27,8 @@ class NifOrganization:
         self._get_org()
 
     def _get_org(self):
-        resp = requests.get('{}/organizations/{}'.format(API_URL, self.org_id),
-                            headers=API_HEADERS)
+        resp = lungo.get('{}/organizations/{}'.format(API_URL, self.org_id),
+                         headers=API_HEADERS)
 
         if resp.status_code == 200:
 
@@ -64,20 +70,49 @@ class NifOrganization:
 
 
 class NifOrganizations:
-    raise Exception('Error in ')
+    """Crawl the organization graph in NIF from a start organization
+
+    The graph is explored breadth-first along the ``_up`` and ``_down`` edges of each organization. Up to ``workers``
+    organizations are fetched concurrently, each worker thread with its own NIF client. Organizations are marked as
+    visited when queued, so each organization is fetched once.
+
+    With a ``state_file`` the visited organizations, the organizations fetched and the frontier are saved every
+    ``save_every`` organizations and when the crawl is interrupted. :py:meth:`crawl` with ``resume=True`` continues
+    from the saved state. The state file is removed when a crawl completes.
+
+    :param org_id: The start organization
+    :type org_id: int
+    :param log_file: The log file for the NIF clients
+    :type log_file: str
+    :param workers: Organizations fetched concurrently. Defaults to NIF_ORG_CRAWL_WORKERS
+    :type workers: int
+    :param state_file: File to save the crawl state to, None to not save. Defaults to NIF_ORG_CRAWL_STATE_FILE
+    :type state_file: str
+    :param snapshot_file: File with the snapshot for :py:meth:`update`. Defaults to NIF_ORG_SNAPSHOT_FILE
+    :type snapshot_file: str
+
+    Usage::
+
+        from organizations import NifOrganizations
+        crawler = NifOrganizations(376, log_file='orgs.log')
+        crawler.crawl(resume=True)
+        crawler.insert_orgs()
+
+    Usage - incremental::
+
+        crawler = NifOrganizations(376, log_file='orgs.log')
+        crawler.update()  # Full crawl on first run, then only changed organizations
+    """
+
     allowed = [1, 2, 4, 6, 14, 8, 5, 19, 26]
 
     not_orgs = [1, 523382]
 
-    i = 0
-
-    orgs_list = []
-
-    orgs = []
+    nlf_activities = [27, 237, 238, 109, 110, 111, 236, 235]  # [370,371,372,373,374,375,376,377,378,379]
 
-    activities = []
+    max_orgs = 10000
 
-    nlf_activities = [27, 237, 238, 109, 110, 111, 236, 235]  # [370,371,372,373,374,375,376,377,378,379]
+    save_every = 100
 
     # org_id: {activity_id, name}
     """
@@ -94,68 +129,220 @@ class NifOrganizations:
                           }
     """
 
-    dbg_orgs = []
-
-    def __init__(self, org_id, log_file):
+    def __init__(self, org_id, log_file, workers=NIF_ORG_CRAWL_WORKERS, state_file=NIF_ORG_CRAWL_STATE_FILE,
+                 snapshot_file=NIF_ORG_SNAPSHOT_FILE):
 
         self.log_file = log_file
         self.start_org_id = org_id
+        self.workers = max(1, workers)
+        self.state_file = state_file
+        self.snapshot_file = snapshot_file
+
+        self.integration_client = self._new_client()
+        self._clients = threading.local()
+
+        self.visited = set()
+        self.frontier = deque()
+        self.orgs = []
+        self.activities = []
+        self.dbg_orgs = []
+        self.faults = []
+        self.i = 0  # Iterations in get_org_legacy
 
-        self.integration_client = NifApiIntegration(username=ACLUBU,
-                                                    password=ACLUBP,
-                                                    realm=NIF_REALM,
-                                                    log_file=self.log_file)
+    def _new_client(self) -> NifApiIntegration:
 
-        self.faults = []
+        return NifApiIntegration(username=ACLUBU,
+                                 password=ACLUBP,
+                                 realm=NIF_REALM,
+                                 log_file=self.log_file)
+
+    def _client(self) -> NifApiIntegration:
+        """The NIF client for the current thread"""
+
+        client = getattr(self._clients, 'client', None)
+
+        if client is None:
+            client = self._new_client()
+            self._clients.client = client
+
+        return client
 
     def get_org(self, org_id, activity=[]):
-        """Get all orgs recursively from a start org_id"""
+        """Get all orgs from a start org_id, see :py:meth:`crawl`"""
 
-        print('GET ORG', org_id)
-        # Testing
-        # if self.i > 4:
-        #    raise Exception('Out of numbers')
+        return self.crawl(org_id)
 
-        self.i = self.i + 1
-        if self.i > 10000:
-            raise ValueError("To many iterations %i" % self.i)
+    def crawl(self, org_id=None, resume=False) -> list:
+        """Fetch all organizations reachable from ``org_id`` breadth-first
 
-        if org_id in self.orgs_list:
-            raise ValueError("Already exists in org list")
+        :param org_id: The start organization. Defaults to the start organization of the crawler
+        :type org_id: int
+        :param resume: Continue from :py:attr:`state_file` if it exists
+        :type resume: bool
+        :return: The organizations fetched
+        :rtype: list[dict]
+        """
+
+        if resume is not True or self._load_state() is not True:
+            org_id = org_id if org_id is not None else self.start_org_id
+            self.visited = {org_id}
+            self.frontier = deque([org_id])
+            self.orgs = []
+            self.faults = []
+
+        running = {}
+        fetched = 0
+        complete = False
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='org-crawl') as executor:
+
+                while len(self.frontier) > 0 or len(running) > 0:
+
+                    while len(self.frontier) > 0 and len(running) < self.workers:
+                        next_id = self.frontier.popleft()
+                        running[executor.submit(self._fetch, next_id)] = next_id
+
+                    done, not_done = wait(running, return_when=FIRST_COMPLETED)
+
+                    for f in done:
+                        self._visit(running[f], f)
+                        del running[f]
+                        fetched += 1
+
+                        if self.state_file is not None and fetched % self.save_every == 0:
+                            self._save_state(running.values())
+
+            complete = True
 
-        self.orgs_list.append(org_id)
+        finally:
+            if self.state_file is not None:
+                if complete is True:
+                    self._remove_state()
+                else:
+                    self._save_state(running.values())
+
+        return self.orgs
+
+    def _fetch(self, org_id):
+
+        return self._client().get_organization(org_id, NLF_ORG_STRUCTURE)
 
-        # Hmm funny
-        # if org_id in [1, 523382]:  # NIF & FAI
-        status, org = self.integration_client.get_organization(org_id, NLF_ORG_STRUCTURE)
+    def _check(self, org_id, future) -> dict:
+        """Get a fetched organization, faults are recorded in :py:attr:`faults`
+
+        :return: The organization or None if it could not be fetched or is not part of the tree
+        :rtype: dict
+        """
+
+        try:
+            status, org = future.result()
+
+            if status is not True:
+                raise ValueError('Could not get organization {}'.format(org_id))
 
-        if status is True:
             if org['type_id'] == 2 and org_id != 376:
                 raise ValueError('Not correct federation {}'.format(org_id))
 
             if org['type_id'] in [4, 5, 6, 14] and org['main_activity'].get('id', 0) not in self.nlf_activities and len(
                     [x['id'] for x in org['activities'] if x.get('id', 0) in self.nlf_activities]) == 0:
-                pprint(org)
                 raise ValueError('No airsport main_activity {}'.format(org_id))
 
-            self.dbg_orgs.append(org)
-            self.orgs.append(org)
+        except Exception as e:
+            print('Err {}'.format(org_id), str(e))
+            self.faults.append(org_id)
+            return None
 
-            for up in org.get('_up', []):
-                if up['id'] not in self.orgs_list and org_id not in self.not_orgs and org['type_id'] != 8:
-                    try:
-                        self.get_org(up['id'])
-                    except Exception as e:
-                        print('Err up {}'.format(up['id']), str(e))
-                        pass
+        return org
 
-            for down in org.get('_down', []):
-                if down['id'] not in self.orgs_list and org_id not in self.not_orgs:
-                    try:
-                        self.get_org(down['id'])
-                    except Exception as e:
-                        print('Err down {}'.format(down['id']), str(e))
-                        pass
+    def _neighbours(self, org_id, org) -> list:
+        """The organizations the crawl follows from ``org``, NIF and FAI are not expanded and clubs are not left
+        upwards from a type 8"""
+
+        if org_id in self.not_orgs:
+            return []
+
+        neighbours = [down['id'] for down in org.get('_down', [])]
+
+        if org['type_id'] != 8:
+            neighbours = [up['id'] for up in org.get('_up', [])] + neighbours
+
+        return neighbours
+
+    def _visit(self, org_id, future) -> None:
+        """Check a fetched organization and queue its neighbours"""
+
+        org = self._check(org_id, future)
+
+        if org is None:
+            return
+
+        self.dbg_orgs.append(org)
+        self.orgs.append(org)
+
+        for neighbour in self._neighbours(org_id, org):
+            self._enqueue(neighbour)
+
+    def _enqueue(self, org_id) -> None:
+
+        if org_id in self.visited:
+            return
+
+        if len(self.visited) >= self.max_orgs:
+            print('Too many organizations, not queueing {}'.format(org_id))
+            return
+
+        self.visited.add(org_id)
+        self.frontier.append(org_id)
+
+    def _save_state(self, in_flight=()) -> None:
+        """Save the crawl state, organizations being fetched are put first in the frontier"""
+
+        state = {'start_org_id': self.start_org_id,
+                 'visited': list(self.visited),
+                 'frontier': list(in_flight) + list(self.frontier),
+                 'orgs': self.orgs,
+                 'faults': self.faults}
+
+        tmp = '{}.tmp'.format(self.state_file)
+        with open(tmp, 'w') as f:
+            json.dump(state, f, cls=EveJSONEncoder)
+
+        os.replace(tmp, self.state_file)
+
+    def _load_state(self) -> bool:
+        """Load the crawl state
+
+        :return: True if a state for the start organization was loaded
+        :rtype: bool
+        """
+
+        if self.state_file is None or os.path.isfile(self.state_file) is not True:
+            return False
+
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except Exception as e:
+            print('Could not load crawl state', str(e))
+            return False
+
+        if state.get('start_org_id', None) != self.start_org_id:
+            return False
+
+        self.visited = set(state['visited'])
+        self.frontier = deque(state['frontier'])
+        self.orgs = state['orgs']
+        self.faults = state['faults']
+
+        return True
+
+    def _remove_state(self) -> None:
+
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
 
     def get_org_legacy(self, org_id, activity=[]):
         """Get all orgs recursively from a start org_id"""
@@ -168,10 +355,10 @@ class NifOrganizations:
         if self.i > 10000:
             raise ValueError("To many iterations %i" % self.i)
 
-        if org_id in self.orgs_list:
+        if org_id in self.visited:
             raise ValueError("Already exists in org list")
 
-        self.orgs_list.append(org_id)
+        self.visited.add(org_id)
 
         if org_id in [1, 523382]:  # NIF & FAI
             org = self.integration_client.service.OrganisationsGet(Ids=[org_id])
@@ -222,7 +409,7 @@ class NifOrganizations:
             if up['OrgIdParent'] != org_id and up['OrgTypeIdParent'] in self.allowed:
                 org_up.append(up)  # {'id': up['OrgIdParent'], 'type': up['OrgTypeIdParent']})
 
-                if org_id not in self.not_orgs and up['OrgIdParent'] not in self.orgs_list and org['Org'][
+                if org_id not in self.not_orgs and up['OrgIdParent'] not in self.visited and org['Org'][
                     'OrganizationTypeId'] != 8:
 
                     try:
@@ -243,7 +430,7 @@ class NifOrganizations:
 
                 org_down.append(down)  # {'id': down['OrgIdChild'], 'type': down['OrgTypeIdChild']})
 
-                if org_id not in self.not_orgs and down['OrgIdChild'] not in self.orgs_list:
+                if org_id not in self.not_orgs and down['OrgIdChild'] not in self.visited:
                     try:
                         self.get_org(down['OrgIdChild'])
                     except:
@@ -256,20 +443,189 @@ class NifOrganizations:
         # self.orgs.append(org['Org'])
         self.orgs.append(org)
 
-    def _update(self, payload):
+    def update(self) -> dict:
+        """Incremental update of the organizations in the api
+
+        Keeps a snapshot in :py:attr:`snapshot_file` of every organization in the tree with its ``modified`` stamp, a
+        :py:func:`eve_api.content_hash` and the edges the crawl follows. The first run crawls the whole tree with
+        :py:meth:`crawl` and writes every organization.
+
+        Later runs read the Organization change messages in integration/changes after the last one seen and refetch
+        only those organizations and their direct ``_up`` and ``_down`` neighbours, both the edges in the snapshot and
+        the edges after the change. Only organizations with a changed content hash are written to
+        /organizations/process. Organizations beyond the direct neighbours are not refetched, an organization without
+        change messages of its own is only updated when it is a neighbour of a changed organization.
+
+        A changed organization that can no longer be fetched or is no longer part of the tree, see :py:meth:`_check`,
+        is dropped from the snapshot and reported in ``removed``. It is not removed from the api.
+
+        :return: Counts of changed, fetched and written organizations and the ids of removed organizations
+        :rtype: dict
+        """
+
+        snapshot = self._load_snapshot()
+
+        if snapshot is None:
+            # Changes arriving during the crawl are picked up by the next run
+            last_change_id = self._get_last_change_id()
+            self.crawl()
+            snapshot = {'start_org_id': self.start_org_id, 'last_change_id': last_change_id, 'orgs': {}}
+            changed = set(org['id'] for org in self.orgs)
+            fetched = {org['id']: org for org in self.orgs}
+
+        else:
+            changed, last_change_id = self._get_changed_ids(snapshot['last_change_id'])
+
+            if len(changed) == 0:
+                return {'changed': 0, 'fetched': 0, 'written': 0, 'removed': []}
+
+            # Old edges, an organization moved in the tree changes its old neighbours too
+            ids = set(changed)
+            for org_id in changed:
+                ids.update(snapshot['orgs'].get(str(org_id), {}).get('edges', []))
+
+            fetched = self._fetch_all(ids)
+
+            # New edges
+            ids = set()
+            for org_id in changed:
+                if org_id in fetched:
+                    ids.update(self._neighbours(org_id, fetched[org_id]))
+            fetched.update(self._fetch_all(ids - set(fetched.keys())))
+
+        written = 0
+        for org_id, org in fetched.items():
+            h = content_hash(org)
+            old = snapshot['orgs'].get(str(org_id), None)
+
+            if old is None or old['hash'] != h:
+                self._update(add_organization_location(org))
+                written += 1
+
+            snapshot['orgs'][str(org_id)] = {'modified': org.get('modified', None),
+                                             'hash': h,
+                                             'edges': self._neighbours(org_id, org)}
+
+        # Deleted, moved out of the tree or without an airsport activity
+        removed = sorted(org_id for org_id in changed if org_id not in fetched and str(org_id) in snapshot['orgs'])
+        for org_id in removed:
+            del snapshot['orgs'][str(org_id)]
+
+        snapshot['last_change_id'] = last_change_id
+        self._save_snapshot(snapshot)
+
+        return {'changed': len(changed), 'fetched': len(fetched), 'written': written, 'removed': removed}
+
+    def _fetch_all(self, org_ids) -> dict:
+        """Fetch organizations concurrently
+
+        :return: The organizations in the tree by id
+        :rtype: dict[int, dict]
+        """
+
+        orgs = {}
 
-        resp = requests.post('{}/organizations/process'.format(API_URL),
-                             data=json.dumps(payload, cls=EveJSONEncoder),
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='org-fetch') as executor:
+            futures = {org_id: executor.submit(self._fetch, org_id) for org_id in org_ids}
+
+            for org_id, future in futures.items():
+                org = self._check(org_id, future)
+                if org is not None:
+                    orgs[org_id] = org
+
+        return orgs
+
+    def _get_changed_ids(self, after, page_size=500) -> (set, str):
+        """Get the ids of organizations with change messages after the change message ``after``
+
+        Pages are read in ``_id`` order, see :py:meth:`stream.NifStream._get_changes`.
+
+        :return: The organization ids and the ``_id`` of the last change message
+        :rtype: (set, str)
+        """
+
+        ids = set()
+        last = after
+
+        while True:
+            where = {'entity_type': 'Organization', '_realm': NIF_REALM}
+            if last is not None:
+                where['_id'] = {'$gt': last}
+
+            resp = lungo.get('{}/integration/changes'.format(API_URL),
+                             params={'where': json.dumps(where),
+                                     'projection': json.dumps({'id': 1}),
+                                     'sort': '[("_id", 1)]',
+                                     'max_results': page_size},
                              headers=API_HEADERS)
 
+            if resp.status_code != 200:
+                raise Exception('Got http {} getting organization change messages'.format(resp.status_code))
+
+            items = resp.json().get('_items', [])
+
+            for item in items:
+                ids.add(item['id'])
+
+            if len(items) > 0:
+                last = items[-1]['_id']
+
+            if len(items) < page_size:
+                return ids, last
+
+    def _get_last_change_id(self):
+        """Get the ``_id`` of the last Organization change message, None if there are none"""
+
+        resp = lungo.get('{}/integration/changes'.format(API_URL),
+                         params={'where': json.dumps({'entity_type': 'Organization', '_realm': NIF_REALM}),
+                                 'projection': json.dumps({'id': 1}),
+                                 'sort': '[("_id", -1)]',
+                                 'max_results': 1},
+                         headers=API_HEADERS)
+
+        if resp.status_code != 200:
+            raise Exception('Got http {} getting organization change messages'.format(resp.status_code))
+
+        items = resp.json().get('_items', [])
+
+        return items[0]['_id'] if len(items) > 0 else None
+
+    def _load_snapshot(self):
+        """Load the snapshot for the start organization, None if missing"""
+
+        if self.snapshot_file is None or os.path.isfile(self.snapshot_file) is not True:
+            return None
+
+        with open(self.snapshot_file) as f:
+            snapshot = json.load(f)
+
+        if snapshot.get('start_org_id', None) != self.start_org_id:
+            return None
+
+        return snapshot
+
+    def _save_snapshot(self, snapshot) -> None:
+
+        tmp = '{}.tmp'.format(self.snapshot_file)
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f, cls=EveJSONEncoder)
+
+        os.replace(tmp, self.snapshot_file)
+
+    def _update(self, payload):
+
+        resp = lungo.post('{}/organizations/process'.format(API_URL),
+                          data=json.dumps(payload, cls=EveJSONEncoder),
+                          headers=API_HEADERS)
+
         if resp.status_code == 422:
 
             try:
                 resp_org = NifOrganization(payload['id'])
 
-                resp = requests.put('{}/organizations/process/{}'.format(API_URL, resp_org._id),
-                                    data=json.dumps(payload, cls=EveJSONEncoder),
-                                    headers=API_HEADERS)
+                resp = lungo.put('{}/organizations/process/{}'.format(API_URL, resp_org._id),
+                                 data=json.dumps(payload, cls=EveJSONEncoder),
+                                 headers=API_HEADERS)
             except:
                 pass
 
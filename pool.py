@@ -0,0 +1,182 @@
+"""
+.. module:: Pool
+    :platform: Unix
+    :synopsis: Connection pool slots shared by all sync workers, with wait and hold times for each worker
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import POOL_WAIT_SECONDS, POOL_HOLD_SECONDS, POOL_WAITING, POOL_IN_USE, POOL_SIZE
+from settings import SYNC_CONNECTIONPOOL_SIZE
+
+
+#: Slots are granted to waiting ``sync`` jobs before waiting ``populate`` windows
+PRIORITIES = {'sync': 0, 'populate': 1}
+
+
+class InstrumentedPool:
+    """A fair, resizable counting semaphore recording wait time, hold time and queue length for each worker
+
+    Replaces the :py:class:`threading.BoundedSemaphore` limiting the number of concurrent NIF calls from all
+    :py:class:`sync.NifSync` workers. Resizing takes effect for the next slot acquired, slots already held are not
+    revoked.
+
+    A free slot is handed to the waiter with the highest priority by mode, see :py:data:`PRIORITIES`, so live ``sync``
+    jobs are not queued behind backfill. Among waiters of the same priority the worker served least recently goes
+    first, a club with a long history gets one window in turn with all other waiting clubs instead of re-acquiring a
+    slot after every window.
+
+    :param size: Number of slots. Defaults to SYNC_CONNECTIONPOOL_SIZE
+    :type size: int
+
+    Usage::
+
+        from pool import InstrumentedPool
+        pool = InstrumentedPool(size=10)
+        with pool.slot('NIF-12345-changes', mode='populate'):
+            api.get_changes(start, end)
+        pool.resize(20)
+        pool.stats()
+    """
+
+    def __init__(self, size=SYNC_CONNECTIONPOOL_SIZE):
+
+        if size < 1:
+            raise ValueError('Pool size must be at least 1, got {}'.format(size))
+
+        self.size = size
+        self.in_use = 0
+        self.waiting = 0
+
+        self._workers = {}
+        self._queue = []  # Heap of (priority, last served, sequence, event)
+        self._served = itertools.count(1)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+        POOL_SIZE.set(size)
+
+    @contextmanager
+    def slot(self, worker, mode=None):
+        """Hold a slot for the duration of the context, blocks until a slot is free
+
+        :param worker: Name of the worker, stats are kept for each worker
+        :type worker: str
+        :param mode: The worker mode, 'populate' or 'sync', sets the priority and is used as label for the metrics
+        :type mode: str
+        """
+
+        t = time.time()
+        event = None
+
+        with self._lock:
+            stats = self._worker(worker)
+
+            if self.in_use < self.size and len(self._queue) == 0:
+                self.in_use += 1
+            else:
+                event = threading.Event()
+                heapq.heappush(self._queue, (PRIORITIES.get(mode, len(PRIORITIES)), stats['served'],
+                                             next(self._sequence), event))
+                stats['waiting'] += 1
+                self.waiting += 1
+                POOL_WAITING.inc()
+
+        if event is not None:
+            # Slot is counted as in use when granted in _grant
+            event.wait()
+
+        with self._lock:
+            if event is not None:
+                stats['waiting'] -= 1
+                self.waiting -= 1
+                POOL_WAITING.dec()
+
+            POOL_IN_USE.set(self.in_use)
+
+            wait = time.time() - t
+            stats['served'] = next(self._served)
+            stats['acquired'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            stats['holding'] += 1
+
+        POOL_WAIT_SECONDS.observe(wait, mode=mode)
+        t = time.time()
+
+        try:
+            yield
+        finally:
+            hold = time.time() - t
+
+            with self._lock:
+                self.in_use -= 1
+                self._grant()
+                POOL_IN_USE.set(self.in_use)
+
+                stats['holding'] -= 1
+                stats['hold_total'] += hold
+                stats['hold_max'] = max(stats['hold_max'], hold)
+
+            POOL_HOLD_SECONDS.observe(hold, mode=mode)
+
+    def resize(self, size) -> None:
+        """Set the number of slots
+
+        :param size: Number of slots, at least 1
+        :type size: int
+        """
+
+        if size < 1:
+            raise ValueError('Pool size must be at least 1, got {}'.format(size))
+
+        with self._lock:
+            self.size = size
+            POOL_SIZE.set(size)
+            self._grant()
+
+    def stats(self) -> dict:
+        """Get the pool and worker stats
+
+        :return: size, slots in use, workers waiting and for each worker the number of slots acquired, total and max
+            seconds waiting and holding a slot and if it is currently waiting or holding
+        :rtype: dict
+        """
+
+        with self._lock:
+            workers = {}
+            for name, s in self._workers.items():
+                workers[name] = dict(s,
+                                     wait_avg=s['wait_total'] / s['acquired'] if s['acquired'] > 0 else 0.0,
+                                     hold_avg=s['hold_total'] / s['acquired'] if s['acquired'] > 0 else 0.0)
+
+            return {'size': self.size,
+                    'in_use': self.in_use,
+                    'waiting': self.waiting,
+                    'workers': workers}
+
+    def _grant(self) -> None:
+        """Hand free slots to the first waiters in the queue, call with the lock held"""
+
+        while self.in_use < self.size and len(self._queue) > 0:
+            self.in_use += 1
+            heapq.heappop(self._queue)[3].set()
+
+    def _worker(self, worker) -> dict:
+        """Stats for ``worker``, call with the lock held"""
+
+        if worker not in self._workers:
+            self._workers[worker] = {'served': 0,
+                                     'acquired': 0,
+                                     'waiting': 0,
+                                     'holding': 0,
+                                     'wait_total': 0.0,
+                                     'wait_max': 0.0,
+                                     'hold_total': 0.0,
+                                     'hold_max': 0.0}
+
+        return self._workers[worker]
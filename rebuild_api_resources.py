@@ -4,36 +4,86 @@ from settings import (
     ACLUBP,
     NLF_ORG_STRUCTURE,
     API_HEADERS,API_URL,
-    NLF_ORG_STRUCTURE
+    NLF_ORG_STRUCTURE,
+    NIF_REBUILD_WORKERS
 )
-import requests
+import copy
 import json
-from eve_api import EveJSONEncoder
+import threading
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, Future
+from eve_api import EveJSONEncoder, lungo, content_hash
 from geocoding import add_organization_location
+from org_index import org_index, ORG_TYPE_GROUP, ORG_TYPE_GREN
+
+
+class _NumberJSONEncoder(EveJSONEncoder):
+    """EveJSONEncoder with Decimals as numbers instead of strings"""
+
+    def default(self, o):
+
+        if isinstance(o, Decimal):
+            return float(o)
+
+        return super().default(o)
 
 
 class NifRebuildResources:
-    def __init__(self):
+    """Rebuild the resources in the api from NIF
+
+    Organizations are fetched through :py:meth:`_get_organization`, which fetches each organization from NIF once per
+    run of :py:meth:`organizations`, concurrently with one NIF client per thread. Clubs are updated by ``workers``
+    threads. See :py:meth:`stats` for the NIF calls saved.
+
+    :param workers: Clubs updated and organizations fetched concurrently. Defaults to NIF_REBUILD_WORKERS
+    :type workers: int
+    """
+
+    def __init__(self, workers=NIF_REBUILD_WORKERS):
 
         self.api_club = NifApiIntegration(ACLUBU, ACLUBP)
+        self.workers = max(1, workers)
+
+        self.requests = 0  # Organizations asked for
+        self.fetches = 0  # Organizations fetched from NIF
+
+        self._orgs = {}  # org_id -> Future of (status, org)
+        self._orgs_lock = threading.Lock()
+        self._clients = threading.local()
+        self._executor = None
         # self.api_fed = NifApiIntegration(NIF_FEDERATION_USERNAME, NIF_FEDERATION_PASSWORD)
         # self.api_competences = NifApiCompetence(NIF_FEDERATION_USERNAME, NIF_FEDERATION_PASSWORD)
 
-    def _get_list(self, resource):
+    def _get_list(self, resource, max_results=500):
+        """Get all items in all pages of ``resource``
 
-        resp = requests.get('{}/{}/?max_results=100000'.format(API_URL, resource),
-                            headers=API_HEADERS)
+        :return: status and the items
+        :rtype: (bool, list[dict])
+        """
+
+        items = []
+        page = 1
+
+        while True:
+            resp = lungo.get('{}/{}/'.format(API_URL, resource),
+                             params={'max_results': max_results, 'page': page},
+                             headers=API_HEADERS)
+
+            if resp.status_code != 200:
+                return False, {}
 
-        if resp.status_code == 200:
             result = resp.json()
-            return True, result['_items']
-        else:
-            return False, {}
+            items += result.get('_items', [])
+
+            if 'next' not in result.get('_links', {}):
+                return True, items
+
+            page += 1
 
     def _get_item(self, item_id, resource):
 
-        resp = requests.get('{}/{}/{}'.format(API_URL, resource, item_id),
-                            headers=API_HEADERS)
+        resp = lungo.get('{}/{}/{}'.format(API_URL, resource, item_id),
+                         headers=API_HEADERS)
 
         if resp.status_code == 200:
 
@@ -50,9 +100,9 @@ class NifRebuildResources:
 
         headers['If-Match'] = etag
 
-        resp = requests.put('{}/{}/{}'.format(API_URL, resource, payload['_id']),
-                            data=json.dumps(payload, cls=EveJSONEncoder),
-                            headers=headers)
+        resp = lungo.put('{}/{}/{}'.format(API_URL, resource, payload['_id']),
+                         data=json.dumps(payload, cls=EveJSONEncoder),
+                         headers=headers)
 
         if resp.status_code == 200:
             return True, resp.json()
@@ -61,9 +111,9 @@ class NifRebuildResources:
 
     def _insert(self, payload, resource):
 
-        resp = requests.post('{}/{}'.format(API_URL, resource),
-                             data=json.dumps(payload, cls=EveJSONEncoder),
-                             headers=API_HEADERS)
+        resp = lungo.post('{}/{}'.format(API_URL, resource),
+                          data=json.dumps(payload, cls=EveJSONEncoder),
+                          headers=API_HEADERS)
 
         if resp.status_code == 201:
             return True, resp.json()
@@ -76,55 +126,238 @@ class NifRebuildResources:
 
     def _delete_resource(self, resource):
 
-        resp = requests.delete('{}/{}'.format(API_URL, resource),
-                               headers=API_HEADERS)
+        resp = lungo.delete('{}/{}'.format(API_URL, resource),
+                            headers=API_HEADERS)
 
         if resp.status_code == 404 or resp.status_code == 204:
             return True
         else:
             return False
 
-    def _delete_item(self, resource, item_id):
+    def _delete_item(self, resource, item_id, etag=None):
+
+        headers = API_HEADERS.copy()
+
+        if etag is not None:
+            headers['If-Match'] = etag
 
-        resp = requests.delete('{}/{}/{}'.format(API_URL, resource, item_id),
-                               headers=API_HEADERS)
+        resp = lungo.delete('{}/{}/{}'.format(API_URL, resource, item_id),
+                            headers=headers)
 
         if resp.status_code == 204:
             return True
 
         return False
 
+    def _sync_resource(self, resource, items, key='id', diff=True, batch_size=100) -> dict:
+        """Write ``items`` to ``resource`` so it holds exactly ``items``
+
+        With ``diff`` the current contents, all pages, are matched to ``items`` by ``key``. New items are inserted in
+        batches of ``batch_size``, one by one if a batch fails, changed items are replaced with their ``_etag`` and
+        items no longer in ``items`` are deleted. Replaces and deletes run on :py:attr:`workers` threads. Readers never
+        see an empty resource.
+
+        Items are compared and written as json with Decimals as numbers, see :py:meth:`_normalize`.
+
+        Without ``diff`` the resource is deleted and all items are inserted in batches.
+
+        :param resource: The resource, e.g. ``counties``
+        :type resource: str
+        :param items: The items from NIF
+        :type items: list[dict]
+        :param key: The field identifying an item
+        :type key: str
+        :return: Number of items inserted, updated, deleted, unchanged and errors
+        :rtype: dict
+        """
+
+        result = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0, 'errors': 0}
+
+        # As returned by the api, else items with Decimals are always changed
+        items = [self._normalize(i) for i in items]
+
+        if diff is True:
+            status, current = self._get_list(resource)
+
+            if status is not True:
+                print('Error getting', resource)
+                result['errors'] += 1
+                return result
+        else:
+            if self._delete_resource(resource) is not True:
+                print('Error deleting', resource)
+                result['errors'] += 1
+                return result
+            current = []
+
+        existing = {c[key]: c for c in current if key in c}
+        wanted = {i[key]: i for i in items if key in i}
+
+        inserts = [i for k, i in wanted.items() if k not in existing]
+        updates = []
+        for k, i in wanted.items():
+            if k in existing:
+                if self._changed(existing[k], i) is True:
+                    updates.append((i, existing[k]))
+                else:
+                    result['unchanged'] += 1
+        deletes = [c for k, c in existing.items() if k not in wanted]
+
+        for n in range(0, len(inserts), batch_size):
+            batch = inserts[n:n + batch_size]
+            status, resp = self._insert(batch, resource)
+
+            if status is True:
+                result['inserted'] += len(batch)
+                continue
+
+            # One invalid item fails the batch, insert one by one
+            for i in batch:
+                status, resp = self._insert(i, resource)
+
+                if status is True:
+                    result['inserted'] += 1
+                else:
+                    print('Error inserting', resource, i, resp)
+                    result['errors'] += 1
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rebuild-write') as executor:
+            replaced = [executor.submit(self._replace, dict(i, _id=c['_id']), resource, c['_etag']) for i, c in updates]
+            deleted = [executor.submit(self._delete_item, resource, c['_id'], c['_etag']) for c in deletes]
+
+            for f in replaced:
+                if f.result()[0] is True:
+                    result['updated'] += 1
+                else:
+                    result['errors'] += 1
+
+            for f in deleted:
+                if f.result() is True:
+                    result['deleted'] += 1
+                else:
+                    result['errors'] += 1
+
+        print('{}: {inserted} inserted, {updated} updated, {deleted} deleted, {unchanged} unchanged, {errors} errors'
+              .format(resource, **result))
+
+        return result
+
+    @staticmethod
+    def _normalize(item) -> dict:
+        """An item from NIF as plain json, with Decimals as numbers like the api returns them"""
+
+        return json.loads(json.dumps(item, cls=_NumberJSONEncoder))
+
+    @staticmethod
+    def _changed(current, item) -> bool:
+        """Compare an item in the api with a normalized item from NIF, ignoring Eve's fields"""
+
+        fields = {k: v for k, v in current.items() if not k.startswith('_')}
+
+        return content_hash(fields) != content_hash(item)
+
+    def stats(self) -> dict:
+        """Get the organization fetch counters
+
+        :return: Organizations asked for, fetched from NIF and NIF calls saved
+        :rtype: dict
+        """
+
+        return {'requests': self.requests,
+                'nif_calls': self.fetches,
+                'nif_calls_saved': self.requests - self.fetches}
+
+    def _client(self) -> NifApiIntegration:
+        """The NIF client for the current thread"""
+
+        client = getattr(self._clients, 'client', None)
+
+        if client is None:
+            client = NifApiIntegration(ACLUBU, ACLUBP)
+            self._clients.client = client
+
+        return client
+
+    def _fetch_organization(self, org_id):
+
+        try:
+            return self._client().get_organization(org_id, NLF_ORG_STRUCTURE)
+        except Exception as e:
+            print('Error getting organization', org_id, str(e))
+            return False, {}
+
+    def _prefetch(self, org_ids) -> Future:
+        """Start fetching organizations not already fetched or being fetched
+
+        :return: The future of the last organization
+        """
+
+        future = None
+        fetch = []  # Fetched in this thread without an executor
+
+        with self._orgs_lock:
+            for org_id in org_ids:
+                self.requests += 1
+
+                if org_id not in self._orgs:
+                    self.fetches += 1
+                    if self._executor is not None:
+                        self._orgs[org_id] = self._executor.submit(self._fetch_organization, org_id)
+                    else:
+                        self._orgs[org_id] = Future()
+                        fetch.append((org_id, self._orgs[org_id]))
+
+                future = self._orgs[org_id]
+
+        # Outside the lock, other threads asking for the same organizations wait on the future
+        for org_id, f in fetch:
+            f.set_result(self._fetch_organization(org_id))
+
+        return future
+
+    def _get_organization(self, org_id):
+        """Get an organization from NIF, each organization is only fetched once
+
+        :return: status and a copy of the organization
+        :rtype: (bool, dict)
+        """
+
+        status, org = self._prefetch([org_id]).result()
+
+        return status, copy.deepcopy(org)
+
     def _get_gren(self, club):
-        activities = []
-        main_activity = {}
-        # Now get all others
-        for group in club.get('_down', []):
-            if group.get('type', 0) == 6:  # gruppe
-                api_status, api_group = self.api_club.get_organization(group['id'], NLF_ORG_STRUCTURE)
-                if api_status is True:
-                    self._update_org(api_group.get('id', 0))
-                    for gren in api_group.get('_down', []):
-                        if gren.get('type', 0) == 14:  # Gren
-                            gren_status, gren_item = self.api_club.get_organization(gren['id'], NLF_ORG_STRUCTURE)
-                            if gren_status is True:
-                                self._update_org(gren_item.get('id', 0))
-                                if 'main_activity' in gren_item:
-                                    main_activity = gren_item.get('main_activity', {})
-                                if 'activities' in gren_item:
-                                    for a in gren_item.get('activities', []):
-                                        activities.append(a)
-
-        activities = list({v['id']: v for v in activities}.values())
-        return activities, main_activity
+        """Update the groups and grens of a club and get the activities of its grens
+
+        The structure is read from :py:data:`org_index.org_index`, which :py:meth:`_update_org` keeps current with each
+        organization fetched. All groups, then all grens, are fetched concurrently before they are updated.
+        """
+
+        org_index.update(club)
+
+        groups = org_index.children(club['id'], type_id=ORG_TYPE_GROUP)
+        self._prefetch(groups)
+
+        for group_id in groups:
+            self._update_org(group_id)
+
+        grens = [gren_id for group_id in groups for gren_id in org_index.children(group_id, type_id=ORG_TYPE_GREN)]
+        self._prefetch(grens)
+
+        for gren_id in grens:
+            self._update_org(gren_id)
+
+        return org_index.gren_activities(club['id'])
 
     def _update_org(self, club_id):
 
-        api_status, api_club = self.api_club.get_organization(club_id, NLF_ORG_STRUCTURE)
+        api_status, api_club = self._get_organization(club_id)
         if api_status is True:
 
+            org_index.update(api_club)
             api_club = add_organization_location(api_club)
 
-            if club_id not in list(NLF_ORG_STRUCTURE.keys()) and api_club.get('type_id', 0) == 5:
+            if club_id not in NLF_ORG_STRUCTURE and api_club.get('type_id', 0) == 5:
                 if api_club.get('main_activity', {}).get('id', 27) == 27:
                     activities, main_activity = self._get_gren(api_club)
                     if len(activities) > 0:
@@ -132,7 +365,7 @@ class NifRebuildResources:
                     if len(main_activity) > 0:
                         api_club['main_activity'] = main_activity
 
-            elif club_id not in [1] and club_id in list(NLF_ORG_STRUCTURE.keys()):
+            elif club_id not in [1] and club_id in NLF_ORG_STRUCTURE:
                 api_club['activities'] = [NLF_ORG_STRUCTURE.get(club_id)]
                 api_club['main_activity'] = NLF_ORG_STRUCTURE.get(club_id)
 
@@ -153,6 +386,12 @@ class NifRebuildResources:
         # for org in organizations:
         # update with logo= file api.get_org_logo(org_id)
 
+        # Each run fetches from NIF again
+        with self._orgs_lock:
+            self._orgs = {}
+            self.requests = 0
+            self.fetches = 0
+
         status, clubs = self._get_list(resource='ka/clubs')
 
         # Needs to have NLF
@@ -163,20 +402,31 @@ class NifRebuildResources:
             clubs.append({'Id': xtra, 'OrgTypeId': 5})
 
         if status is True:
-            for club in clubs:
-                if club['OrgTypeId'] == 5:
-                    self._update_org(club['Id'])
+            club_ids = list(dict.fromkeys(club['Id'] for club in clubs if club['OrgTypeId'] == 5))
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rebuild-fetch') as executor, \
+                    ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rebuild') as updaters:
+                self._executor = executor
+                try:
+                    self._prefetch(club_ids)
+                    for f in [updaters.submit(self._update_org, club_id) for club_id in club_ids]:
+                        f.result()
+                finally:
+                    self._executor = None
+
+            print('Organizations: {requests} requested, {nif_calls} NIF calls, {nif_calls_saved} saved'
+                  .format(**self.stats()))
 
     def organizations_logo(self):
         """
         status, logo = i.get_org_logo(376)
-        r = requests.get('{}/organizations/376'.format(API_URL), headers=API_HEADERS)
+        r = lungo.get('{}/organizations/376'.format(API_URL), headers=API_HEADERS)
 
         org = r.json()
         headers = API_HEADERS.copy()
         headers['If-Match']= org['_etag']
         headers.pop('Content-Type')
-        pr = requests.patch('{}/organizations/process/{}'.format(API_URL, org['_id']),
+        pr = lungo.patch('{}/organizations/process/{}'.format(API_URL, org['_id']),
                                    files=dict(logo=base64.b64encode(logo)),headers=hea
 
         :return:
@@ -184,18 +434,11 @@ class NifRebuildResources:
         # _get all orgs from api, patch logo
         raise NotImplementedError
 
-    def organizations_types(self):
-        resource = 'organizations/types'
-        if self._delete_resource(resource):
+    def organizations_types(self, diff=True):
+        status, result = self.api_club.get_organization_types()
 
-            status, result = self.api_club.get_organization_types()
-
-            if status is True and isinstance(result, list):
-                # for r in result:
-                status, resp = self._insert(result, resource)
-
-                if status is not True:
-                    print('Error inserting county', result, resp)
+        if status is True and isinstance(result, list):
+            self._sync_resource('organizations/types', result, diff=diff)
 
     def competence_types(self):
 
@@ -207,74 +450,38 @@ class NifRebuildResources:
             payload = self.api_competences.get_competece_type(competence['type_id'])
             _, _ = self._insert(payload, 'competences/types')
 
-    def counties(self):
-        resource = 'counties'
-        if self._delete_resource(resource):
-
-            status, result = self.api_club.get_counties()
-
-            if status is True and isinstance(result, list):
-                # for r in result:
-                status, resp = self._insert(result, resource)
-
-                if status is not True:
-                    print('Error inserting county', result, resp)
+    def counties(self, diff=True):
+        status, result = self.api_club.get_counties()
 
-    def countries(self):
-        resource = 'countries'
-        if self._delete_resource(resource):
+        if status is True and isinstance(result, list):
+            self._sync_resource('counties', result, diff=diff)
 
-            status, result = self.api_club.get_countries()
+    def countries(self, diff=True):
+        status, result = self.api_club.get_countries()
 
-            if status is True and isinstance(result, list):
-                # for r in result:
-                status, resp = self._insert(result, resource)
+        if status is True and isinstance(result, list):
+            self._sync_resource('countries', result, diff=diff)
 
-                if status is not True:
-                    print('Error inserting country', result, resp)
+    def function_types(self, diff=True):
+        status, result = self.api_club.get_function_types()
 
-    def function_types(self):
-        resource = 'functions/types'
-        if self._delete_resource(resource):
+        if status is True and isinstance(result, list):
+            self._sync_resource('functions/types', result, diff=diff)
 
-            status, result = self.api_club.get_function_types()
+    def license_status(self, diff=True):
+        status, result = self.api_club.get_licenses_status()
 
-            if status is True and isinstance(result, list):
-                # for r in result: # If each item
-                status, resp = self._insert(result, resource)
+        if status is True and isinstance(result, list):
+            self._sync_resource('licenses/status', result, diff=diff)
 
-                if status is not True:
-                    print('Error inserting', resource, result, resp)
+    def license_types(self, diff=True):
+        # @TODO filter in NLF org_id's?
+        status, result = self.api_club.get_licenses_types()
 
-    def license_status(self):
-        resource = 'licenses/status'
-        if self._delete_resource(resource):
+        if status is True and isinstance(result, list):
+            self._sync_resource('licenses/types', result, diff=diff)
 
-            status, result = self.api_club.get_licenses_status()
-
-            if status is True and isinstance(result, list):
-                # for r in result:
-                status, resp = self._insert(result, resource)
-
-                if status is not True:
-                    print('Error inserting', resource, result, resp)
-
-    def license_types(self):
-        resource = 'licenses/types'
-        if self._delete_resource(resource):
-
-            status, result = self.api_club.get_licenses_types()
-
-            if status is True and isinstance(result, list):
-                for r in result:  # Batch won't work due to Decimal and encoder?
-
-                    # @TODO filter in NLF org_id's?
-                    status, resp = self._insert(r, resource)
-
-                    if status is not True:
-                        print('Error inserting', resource, result, resp)
-
-    def activities(self):
+    def activities(self, diff=True):
 
         resource = 'activities'
 
@@ -297,27 +504,25 @@ class NifRebuildResources:
              'parent_activity_id': 27},
         ]
 
-        if self._delete_resource(resource) is True:
-
-            status, result = True, activities  # self.api_club.get_activities()
+        self._sync_resource(resource, activities, diff=diff)
 
-            if status is True and isinstance(result, list):
-                status, resp = self._insert(result, resource)
+    def rebuild(self, diff=True):
+        """Rebuild all resources
 
-                if status is not True:
-                    print('Error inserting', resource, result, resp)
-
-    def rebuild(self):
+        :param diff: If True only changes are written to the lookup resources, else they are deleted and reinserted.
+            See :py:meth:`_sync_resource`
+        :type diff: bool
+        """
 
         self.organizations()
-        self.organizations_types()
+        self.organizations_types(diff=diff)
         # self.competence_types()
-        self.counties()
-        self.countries()
-        self.function_types()
-        self.license_types()
-        self.license_status()
-        self.activities()
+        self.counties(diff=diff)
+        self.countries(diff=diff)
+        self.function_types(diff=diff)
+        self.license_types(diff=diff)
+        self.license_status(diff=diff)
+        self.activities(diff=diff)
 
     def run(self):
         self.rebuild()
@@ -1,9 +1,10 @@
-from settings import API_HEADERS, API_URL, STREAM_RESUME_TOKEN_FILE, SYNCDAEMON_PID_FILE
+from settings import API_HEADERS, API_URL, STREAM_RESUME_TOKEN_FILE, SYNCDAEMON_PID_FILE, SYNC_CHECKPOINT_FILE
 from termcolor import colored, cprint
 import requests
 import sys
 import os
 from pathlib import Path
+from checkpoints import SyncCheckpoints
 
 """
 @TODO needs to reset resume.token file else stream will barf
@@ -39,6 +40,7 @@ resources = [['persons/process', True, 0],
 
 resume_token_path = Path(STREAM_RESUME_TOKEN_FILE)
 syncdaemon_pid_path = Path(SYNCDAEMON_PID_FILE)
+sync_checkpoint_path = Path(SYNC_CHECKPOINT_FILE)
 
 if __name__ == "__main__":
     os.system("cls")
@@ -79,6 +81,8 @@ if __name__ == "__main__":
         print('[X] Syncdaemon pidfile {} exists\t\t\t[1 file]'.format(SYNCDAEMON_PID_FILE))
     if resume_token_path.exists() is True:
         print('[X] Stream resume token file {} exists\t\t\t[1 file]'.format(STREAM_RESUME_TOKEN_FILE))
+    if sync_checkpoint_path.exists() is True:
+        print('[X] Sync checkpoints file {} exists\t\t\t[1 file]'.format(SYNC_CHECKPOINT_FILE))
 
     # Delete all?
     if str(input("\n\nAre you sure? (yes/n):\t")).lower().strip() == "yes":
@@ -96,6 +100,14 @@ if __name__ == "__main__":
         except:
             pass
 
+        # Sync checkpoints, else workers resume and never populate integration/changes again
+        if sync_checkpoint_path.exists() is True:
+            try:
+                count = SyncCheckpoints().clear()
+                print('[D] Cleared checkpoints\t\t{}\t[{} rows]'.format(SYNC_CHECKPOINT_FILE, count))
+            except:
+                cprint('[!] Could not clear checkpoints in {}'.format(SYNC_CHECKPOINT_FILE), 'red')
+
         for r in resources:
             if r[1] is True:
 
@@ -35,6 +35,49 @@ NIF_POPULATE_INTERVAL = 30  # Days
 NIF_SYNC_INTERVAL = 10  # Minutes
 NIF_LICENSE_SYNC_INTERVAL = 10  # Minutes
 NIF_COMPETENCE_SYNC_INTERVAL = 10  # Minutes
+NIF_SYNC_BATCH_SIZE = 100  # Change messages per bulk insert to integration/changes
+
+#: Run all sync jobs in one shared scheduler instead of one scheduler and thread per worker
+NIF_SYNC_SHARED_SCHEDULER = True
+NIF_SYNC_SCHEDULER_WORKERS = 10  # Threads running sync jobs in the shared scheduler
+NIF_SYNC_JITTER = 60  # Max seconds of random delay added to each sync job run
+NIF_POPULATE_WORKERS = 1  # Windows fetched concurrently per worker in populate, 1 populates sequentially
+
+#: Adapt the GetChanges window to the number of changes and the time used for each window
+NIF_WINDOW_ADAPTIVE = True
+NIF_WINDOW_MIN_SIZE = 1  # Hours
+NIF_WINDOW_MAX_SIZE = 8760  # Hours
+NIF_WINDOW_TARGET_COUNT = 1000  # Change messages per window, larger windows are shrunk
+NIF_WINDOW_TARGET_LATENCY = 60  # Seconds to get and post a window, slower windows are shrunk
+
+#: Local store of sync progress, see checkpoints.py
+SYNC_CHECKPOINT_FILE = 'sync_checkpoints.db'
+
+#: Slots in the connection pool shared by all sync workers
+SYNC_CONNECTIONPOOL_SIZE = 10
+
+#: Startup of syncdaemon
+SYNC_STARTUP_WORKERS = 10  # Integration users resolved concurrently
+NIF_INTEGRATION_AUTH_DELAY = 180  # Max seconds for an integration user to authenticate in NIF
+NIF_AUTH_PROBE_WORKERS = 10  # Concurrent authentication tests
+NIF_AUTH_PROBE_DELAY = 10  # Seconds before the first authentication test of a created user, doubled for each retry
+NIF_AUTH_PROBE_MAX_DELAY = 60  # Max seconds between authentication tests
+
+#: Crawl of the organization graph, see organizations.py
+NIF_ORG_CRAWL_WORKERS = 10  # Organizations fetched concurrently
+NIF_ORG_CRAWL_STATE_FILE = 'org_crawl.json'  # Crawl state for resume
+NIF_ORG_SNAPSHOT_FILE = 'org_snapshot.json'  # Snapshot of the organization tree for incremental updates
+NIF_REBUILD_WORKERS = 10  # Clubs updated and organizations fetched concurrently in rebuild_api_resources.py
+ORG_INDEX_REFRESH_INTERVAL = 300  # Seconds between incremental refreshes of the organization index, see org_index.py
+
+#: Sync workers as threads ('thread') or as tasks in one event loop ('asyncio', requires aiohttp)
+SYNC_ENGINE = 'thread'
+
+#: Metrics as Prometheus text on http://host:port/metrics, 0 disables
+METRICS_HOST = '127.0.0.1'  # Interface to bind to, the endpoint has no auth. '' binds to all interfaces
+METRICS_PORT = 9101  # syncdaemon
+STREAM_METRICS_PORT = 9102  # streamdaemon
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]  # Seconds
 
 """
 .. topic::
@@ -94,3 +137,19 @@ ZEEP_EXCEPTIONS = ['Error', 'Fault', 'IncompleteMessage', 'IncompleteOperation',
     Stream
 """
 STREAM_RESUME_TOKEN_FILE = 'resume.token'
+STREAM_WORKERS = 1  # Concurrent change message workers
+STREAM_RECOVER_PAGE_SIZE = 500  # Change messages per page in recover
+STREAM_STATUS_BUFFER_SIZE = 0  # Buffer change message statuses and write in bulk, 0 writes each status directly
+STREAM_STATUS_BUFFER_INTERVAL = 5  # Seconds between writing buffered statuses
+STREAM_STATUS_BULK_WRITE = True  # Write buffered statuses directly to MongoDB instead of via the api
+STREAM_COALESCE_WINDOW = 0  # Seconds to hold changes for the same entity and only process the latest, 0 disables
+STREAM_CACHE_SIZE = 10000  # NIF objects kept in cache, 0 disables
+STREAM_CACHE_TTL = 300  # Seconds a cached NIF object is valid
+STREAM_HASH_CACHE_SIZE = 100000  # Content hashes of written documents kept to skip unchanged writes, 0 disables
+
+#: Process live changes before backfill from populate, see stream_dispatcher.py. Runs the dispatcher also with
+#: STREAM_WORKERS = 1 and holds at least 1000 changes pending
+STREAM_LANES = False
+STREAM_LIVE_AGE = 86400  # Seconds, changes with a newer sequence_ordinal go in the live lane
+STREAM_LANE_RATES = {'live': 0, 'backfill': 0}  # Max changes started per second in each lane, 0 is unlimited
+STREAM_ENTITY_PRIORITIES = {'License': 0, 'Competence': 1, 'Function': 2, 'Person': 3, 'Organization': 4}  # Lower first
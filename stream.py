@@ -1,12 +1,15 @@
 import sys
+import copy
+import threading
+import time
 import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
 import json
 import pymongo
-import requests
 from dateutil import tz
 
-from eve_api import EveJSONEncoder
-from eve_api import ChangeStreamItem
+from eve_api import EveJSONEncoder, lungo, content_hash
+from eve_api import ChangeStreamItem, ChangeStatusBuffer
 from nif_api import NifApiIntegration, NifApiCompetence
 from settings import (
     ACLUBU,
@@ -19,11 +22,24 @@ from settings import (
     STREAM_GEOCODE,
     NIF_REALM,
     NLF_ORG_STRUCTURE,
-    STREAM_LOG_FILE
+    STREAM_LOG_FILE,
+    STREAM_WORKERS,
+    STREAM_RECOVER_PAGE_SIZE,
+    STREAM_STATUS_BUFFER_SIZE,
+    STREAM_STATUS_BULK_WRITE,
+    STREAM_COALESCE_WINDOW,
+    STREAM_CACHE_SIZE,
+    STREAM_CACHE_TTL,
+    STREAM_HASH_CACHE_SIZE,
+    STREAM_LANES
 )
 
 from pathlib import Path
 from app_logger import AppLogger
+from stream_dispatcher import ChangeDispatcher
+from cache import TTLCache
+from metrics import NIF_CALL_SECONDS, STREAM_CHANGE_SECONDS, STREAM_WRITES, STREAM_WRITES_SKIPPED
+from org_index import org_index
 
 if STREAM_GEOCODE:
     from geocoding import add_person_location, add_organization_location
@@ -55,6 +71,23 @@ class NifStream:
         If :py:attr:`resume_token` is out of date or mismatches the oplog, it will be deleted and will not be able to
         resume.
 
+    With ``workers`` > 1 :py:meth:`.run` processes changes concurrently through a
+    :py:class:`stream_dispatcher.ChangeDispatcher`. Changes for the same entity are still processed in order and
+    the :py:attr:`.resume_token` only advances past changes that are finished. With a ``coalesce`` window changes for
+    the same entity arriving within the window are coalesced and only the latest is fetched from NIF. With
+    STREAM_LANES live changes are processed before backfill from populate, see :py:class:`stream_dispatcher.ChangeDispatcher`.
+
+    With STREAM_STATUS_BUFFER_SIZE > 0 status transitions are collected in a :py:class:`eve_api.ChangeStatusBuffer`
+    and written in bulk, directly to MongoDB if STREAM_STATUS_BULK_WRITE. The :py:attr:`.resume_token` is then
+    written after the statuses of the changes it covers.
+
+    Objects fetched from NIF are kept in :py:attr:`.cache`, a :py:class:`cache.TTLCache` of STREAM_CACHE_SIZE entries
+    valid for STREAM_CACHE_TTL seconds. An entry is only used for changes not modified after it was fetched.
+
+    :py:meth:`._process` keeps a :py:func:`eve_api.content_hash` of each payload written in :py:attr:`.hashes`. When
+    the payload from NIF is unchanged and the document in the api is still the one written, the write is skipped.
+    See :py:attr:`.write_skip_ratio` and the ``stream_writes_total`` and ``stream_writes_skipped_total`` metrics.
+
     .. note::
 
         To address errors like shutdowns or :py:attr:`.resume_token` out of date the class implements :py:meth:`.slow`
@@ -67,9 +100,13 @@ class NifStream:
         stream.recover(errors=False)  # fix remaining change messages
         stream.run()  # Blocks forever
 
+    :param workers: Number of concurrent change message workers. Defaults to STREAM_WORKERS
+    :type workers: int
+    :param coalesce: Seconds to hold changes for coalescing, 0 disables. Defaults to STREAM_COALESCE_WINDOW
+    :type coalesce: int
     """
 
-    def __init__(self):
+    def __init__(self, workers=STREAM_WORKERS, coalesce=STREAM_COALESCE_WINDOW):
 
         self.log = AppLogger(name='nif-stream', stdout=False, last_logs=0, restart=True)
 
@@ -81,6 +118,9 @@ class NifStream:
         self.resume_token_path = Path(STREAM_RESUME_TOKEN_FILE)
         self.resume_token_lock = False
 
+        self.workers = workers
+        self.coalesce = coalesce
+
         self.tz_local = tz.gettz("Europe/Oslo")
         self.tz_utc = tz.gettz('UTC')
 
@@ -94,22 +134,11 @@ class NifStream:
             'Changes': {'url': '{}/integration/changes'.format(API_URL), 'id': 'id'},
         }
 
-        # NIF Api
-        # Needs one of the clubs? Using platform user!
-        self.api_license = NifApiIntegration(username=NIF_FEDERATION_USERNAME,
-                                             password=NIF_FEDERATION_PASSWORD,
-                                             log_file=STREAM_LOG_FILE,
-                                             realm=NIF_REALM)
-
-        self.api_competence = NifApiCompetence(username=NIF_FEDERATION_USERNAME,
-                                               password=NIF_FEDERATION_PASSWORD,
-                                               log_file=STREAM_LOG_FILE,
-                                               realm=NIF_REALM)
-
-        self.api = NifApiIntegration(username=ACLUBU,
-                                     password=ACLUBP,
-                                     log_file=STREAM_LOG_FILE,
-                                     realm=NIF_REALM)
+        # NIF Api, the clients are not thread safe so each dispatcher worker gets its own, see _client
+        self._clients = threading.local()
+        self.api_license = self._client('api_license')
+        self.api_competence = self._client('api_competence')
+        self.api = self._client('api')
 
         status, hello = self.api._test()
         if status is not True:
@@ -120,6 +149,114 @@ class NifStream:
         client = pymongo.MongoClient()
         self.db = client.ka
 
+        # NIF objects
+        self.cache = None
+        if STREAM_CACHE_SIZE > 0:
+            self.cache = TTLCache(maxsize=STREAM_CACHE_SIZE, ttl=STREAM_CACHE_TTL, name='stream_nif')
+
+        # Content hash and _etag of written payloads
+        self.hashes = None
+        if STREAM_HASH_CACHE_SIZE > 0:
+            self.hashes = TTLCache(maxsize=STREAM_HASH_CACHE_SIZE, ttl=None, name='stream_hashes')
+
+        self.writes = 0
+        self.writes_skipped = 0
+        self._stats_lock = threading.Lock()
+
+        # Buffered change message statuses
+        self.status_buffer = None
+        if STREAM_STATUS_BUFFER_SIZE > 0:
+            self.status_buffer = ChangeStatusBuffer(db=self.db if STREAM_STATUS_BULK_WRITE is True else None,
+                                                    max_size=STREAM_STATUS_BUFFER_SIZE,
+                                                    log=self.log)
+
+    def _new_client(self, name):
+        """Create the NIF client ``name``"""
+
+        # Needs one of the clubs? Using platform user!
+        if name == 'api_license':
+            return NifApiIntegration(username=NIF_FEDERATION_USERNAME,
+                                     password=NIF_FEDERATION_PASSWORD,
+                                     log_file=STREAM_LOG_FILE,
+                                     realm=NIF_REALM)
+
+        elif name == 'api_competence':
+            return NifApiCompetence(username=NIF_FEDERATION_USERNAME,
+                                    password=NIF_FEDERATION_PASSWORD,
+                                    log_file=STREAM_LOG_FILE,
+                                    realm=NIF_REALM)
+
+        return NifApiIntegration(username=ACLUBU,
+                                 password=ACLUBP,
+                                 log_file=STREAM_LOG_FILE,
+                                 realm=NIF_REALM)
+
+    def _client(self, name='api'):
+        """The NIF client ``name`` for the current thread, 'api', 'api_license' or 'api_competence'"""
+
+        client = getattr(self._clients, name, None)
+
+        if client is None:
+            client = self._new_client(name)
+            setattr(self._clients, name, client)
+
+        return client
+
+    @property
+    def write_skip_ratio(self) -> float:
+        """Ratio of writes to the api skipped because the payload was unchanged"""
+
+        total = self.writes + self.writes_skipped
+
+        return self.writes_skipped / total if total > 0 else 0.0
+
+    def stats(self) -> dict:
+        """Get cache and write counters
+
+        :return: The counters
+        :rtype: dict
+        """
+
+        return {'cache': self.cache.stats() if self.cache is not None else {},
+                'writes': self.writes,
+                'writes_skipped': self.writes_skipped,
+                'write_skip_ratio': self.write_skip_ratio}
+
+    def _change_item(self, document) -> ChangeStreamItem:
+        """Create a change item, attached to :py:attr:`.status_buffer` if any
+
+        :param document: The change message
+        :type document: dict
+        :return: The change item
+        :rtype: ChangeStreamItem
+        """
+
+        return ChangeStreamItem(document, status_buffer=self.status_buffer)
+
+    def _get_dispatcher(self, on_advance=None):
+        """Create and start a :py:class:`stream_dispatcher.ChangeDispatcher` if :py:attr:`.workers` > 1,
+        :py:attr:`.coalesce` > 0 or STREAM_LANES
+
+        :param on_advance: Callable receiving the resume token when it advances
+        :type on_advance: callable
+        :return: The dispatcher or None if changes are processed one by one
+        :rtype: ChangeDispatcher
+        """
+
+        if self.workers > 1 or self.coalesce > 0 or STREAM_LANES is True:
+            dispatcher = ChangeDispatcher(process=self._process_change,
+                                          workers=self.workers,
+                                          on_advance=on_advance,
+                                          coalesce=self.coalesce,
+                                          log=self.log)
+            dispatcher.start()
+            self.log.debug('Dispatching to {} workers, coalesce {}s, lanes {}'.format(self.workers, self.coalesce,
+                                                                                      STREAM_LANES))
+
+            return dispatcher
+
+        return None
+
     def recover(self, errors=False, realm=NIF_REALM):
         """Get change messages with status:
 
@@ -132,35 +269,97 @@ class NifStream:
 
         via :py:mod:`eve_api` and process the messages in :py:meth:`._process_change`
 
+        The change messages are read page by page with :py:meth:`._get_changes`, so memory use is bounded by the page
+        size regardless of the number of change messages to recover.
+
         Sets the :py:attr:`.resume_token_lock` to avoid writing a :py:attr:`.resume_token` on updates.
         """
-        r = False
         self.resume_token_lock = True
+
         if errors is True:
-            try:
-                r = requests.get(
-                    '%s?where={"_status": {"$in": ["pending", "error"]},"_realm":"%s"}&max_results=100000' %
-                    (self.api_collections['Changes']['url'], realm),
-                    headers=API_HEADERS)
-            except Exception as e:
-                self.log.exception('Exception getting error and pending changes in recover')
+            where = {'_status': {'$in': ['pending', 'error']}, '_realm': realm}
         else:
-            try:
-                r = requests.get('%s?where={"_status": {"$in": ["ready"]},"_realm":"%s"}&max_results=100000' %
-                                 (self.api_collections['Changes']['url'], realm),
-                                 headers=API_HEADERS)
-            except Exception as e:
-                self.log.exception('Exception getting ready changes in recover')
+            where = {'_status': {'$in': ['ready']}, '_realm': realm}
 
-        if r and r.status_code == 200:
+        if self.status_buffer is not None:
+            self.status_buffer.start()
 
-            slow = r.json()
+        dispatcher = self._get_dispatcher()
 
-            for change in slow['_items']:
-                self._process_change(ChangeStreamItem(change))
+        try:
+            for change in self._get_changes(where):
+                if dispatcher is not None:
+                    dispatcher.submit(self._change_item(change))
+                else:
+                    self._process_change(self._change_item(change))
+        except Exception as e:
+            self.log.exception('Exception getting {} changes in recover'.format(', '.join(where['_status']['$in'])))
+        finally:
+            if dispatcher is not None:
+                dispatcher.stop()
+
+            if self.status_buffer is not None:
+                self.status_buffer.flush()
 
         self.resume_token_lock = False
 
+    def _get_changes(self, where, page_size=STREAM_RECOVER_PAGE_SIZE):
+        """Generator yielding all change messages matching ``where``
+
+        Pages are read in ``_id`` order and each page starts after the last ``_id`` of the previous page. Unlike
+        page numbers this is not affected by processed change messages leaving the result set. The next page is
+        fetched in the background while the current page is consumed.
+
+        :param where: The Eve where query
+        :type where: dict
+        :param page_size: Change messages per page. Defaults to STREAM_RECOVER_PAGE_SIZE
+        :type page_size: int
+        :return: Generator of change messages
+        :rtype: dict
+        """
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+
+            page = executor.submit(self._get_changes_page, where, None, page_size)
+
+            while page is not None:
+                items = page.result()
+
+                if len(items) == page_size:
+                    page = executor.submit(self._get_changes_page, where, items[-1]['_id'], page_size)
+                else:
+                    page = None
+
+                for item in items:
+                    yield item
+
+    def _get_changes_page(self, where, after, page_size) -> list:
+        """Get one page of change messages with ``_id`` greater than ``after``
+
+        :param where: The Eve where query
+        :type where: dict
+        :param after: The last ``_id`` of the previous page, None for the first page
+        :type after: str
+        :param page_size: Change messages per page
+        :type page_size: int
+        :return: The change messages
+        :rtype: list
+        """
+
+        if after is not None:
+            where = self._merge_dicts(where, {'_id': {'$gt': after}})
+
+        r = lungo.get(self.api_collections['Changes']['url'],
+                      params={'where': json.dumps(where),
+                              'sort': '[("_id", 1)]',
+                              'max_results': page_size},
+                      headers=API_HEADERS)
+
+        if r.status_code != 200:
+            raise Exception('Got http {} getting change messages'.format(r.status_code))
+
+        return r.json().get('_items', [])
+
     def _process_change(self, change) -> bool:
         """
         Process a change message. Will call the equivalent `_get_<entity_type>` method corresponding to the entity_type
@@ -174,51 +373,83 @@ class NifStream:
         :rtype: bool
         """
 
-        status = False
+        t = time.time()
 
-        if change.set_status('pending'):
-            try:
-                # Get object from nif_api
-                if change.entity_type == 'Person':
-                    status, result = self.api.get_person(change.get_id())
+        try:
+            status = False
+
+            if change.set_status('pending'):
+                try:
+                    # Get object from nif_api
+                    status, result = self._get_nif_object(change)
+
+                    # Insert into Lungo api
+                    if status is True:
+                        pstatus, pmessage = self._process(result, change)
+                        if pstatus is True:  # Sets the change message status
+                            change.set_status('finished')
+                            return True
+                        else:
+                            change.set_status('error', pmessage)
+
+                    else:
+                        self.log.error('NIF API error for {} ({}) change message: {}'.format(change.entity_type,
+                                                                                             change.id,
+                                                                                             change._id))
+                        change.set_status('error', 'Got http {} for {} {}'.format(status,
+                                                                                  change.entity_type,
+                                                                                  change.get_id()))  # Error in nif_api
+
+                except Exception as e:
+                    self.log.exception('Error in process change')
+                    change.set_status('error', {'exception': str(e)})
+            else:
+                self.log.error('Cant change Person status to pending')
+                raise Exception('Cant change Person status to pending')
 
-                elif change.entity_type == 'Function':
-                    status, result = self.api.get_function(change.get_id())
+            return False
+        finally:
+            STREAM_CHANGE_SECONDS.observe(time.time() - t, entity_type=change.entity_type)
 
-                elif change.entity_type == 'Organization':
-                    status, result = self.api.get_organization(change.get_id(), NLF_ORG_STRUCTURE)
+    def _get_nif_object(self, change) -> (bool, dict):
+        """Get the object for a change message from NIF, through :py:attr:`.cache` if enabled
 
-                elif change.entity_type == 'License':
-                    status, result = self.api_license.get_license(change.get_id())
+        :param change: the change message
+        :type change: ChangeStreamItem
+        :return: status and the object
+        :rtype: (bool, dict)
+        """
 
-                elif change.entity_type == 'Competence':
-                    status, result = self.api_competence.get_competence(change.get_id())
+        key = (change.entity_type, change.get_id())
+        modified = change.get_modified()
 
-                # Insert into Lungo api
-                if status is True:
-                    pstatus, pmessage = self._process(result, change)
-                    if pstatus is True:  # Sets the change message status
-                        change.set_status('finished')
-                        return True
-                    else:
-                        change.set_status('error', pmessage)
+        if self.cache is not None:
+            result = self.cache.get(key, modified=modified)
+            if result is not None:
+                return True, copy.deepcopy(result)
 
-                else:
-                    self.log.error('NIF API error for {} ({}) change message: {}'.format(change.entity_type,
-                                                                                         change.id,
-                                                                                         change._id))
-                    change.set_status('error', 'Got http {} for {} {}'.format(status,
-                                                                              change.entity_type,
-                                                                              change.get_id()))  # Error in nif_api
+        status, result = False, None
 
-            except Exception as e:
-                self.log.exception('Error in process change')
-                change.set_status('error', {'exception': str(e)})
-        else:
-            self.log.error('Cant change Person status to pending')
-            raise Exception('Cant change Person status to pending')
+        with NIF_CALL_SECONDS.time(call='get_{}'.format(change.entity_type.lower())):
+            if change.entity_type == 'Person':
+                status, result = self._client('api').get_person(change.get_id())
 
-        return False
+            elif change.entity_type == 'Function':
+                status, result = self._client('api').get_function(change.get_id())
+
+            elif change.entity_type == 'Organization':
+                status, result = self._client('api').get_organization(change.get_id(), NLF_ORG_STRUCTURE)
+
+            elif change.entity_type == 'License':
+                status, result = self._client('api_license').get_license(change.get_id())
+
+            elif change.entity_type == 'Competence':
+                status, result = self._client('api_competence').get_competence(change.get_id())
+
+        if status is True and self.cache is not None:
+            self.cache.set(key, copy.deepcopy(result), modified=modified)
+
+        return status, result
 
     def run(self):
         """Read the mongo change stream
@@ -242,6 +473,11 @@ class NifStream:
             resume_after = None
             self.log.debug('No resume token')
 
+        if self.status_buffer is not None:
+            self.status_buffer.start()
+
+        dispatcher = self._get_dispatcher(on_advance=self._advance_resume_token)
+
         try:
             # @TODO on upgrade to mongo 4.2 use startAfter instead
             self.log.debug('Change stream watch starting...')
@@ -253,16 +489,31 @@ class NifStream:
                         self.log.debug('Processing change message: {} {}'.format(change['fullDocument']['entity_type'],
                                                                                  change['fullDocument']['id']))
 
+                        if dispatcher is not None:
+                            dispatcher.submit(self._change_item(change['fullDocument']), change['_id']['_data'])
+                            continue
+
                         # Always set new resume token
                         self.resume_token = change['_id']['_data']
 
-                        if self._process_change(ChangeStreamItem(change['fullDocument'])) is True:
+                        if self._process_change(self._change_item(change['fullDocument'])) is True:
                             self.log.debug('Successfully processed')
                             self._write_resume_token()
 
+                if dispatcher is not None:
+                    dispatcher.stop()
+                    dispatcher = None
+
+                if self.status_buffer is not None:
+                    self.status_buffer.flush()
+
                 self.restarts = 0
 
         except pymongo.errors.PyMongoError as e:
+            if dispatcher is not None:
+                dispatcher.stop()
+            if self.status_buffer is not None:
+                self.status_buffer.flush()
             self.log.error('Unrecoverable PyMongoError, restarting')
             self.restarts += 1
             if self.restarts > self.max_restarts:
@@ -272,6 +523,10 @@ class NifStream:
                 self.run()
 
         except Exception as e:
+            if dispatcher is not None:
+                dispatcher.stop()
+            if self.status_buffer is not None:
+                self.status_buffer.flush()
             self.log.exception('Unknown error in change stream watch')
 
             self.restarts += 1
@@ -285,6 +540,24 @@ class NifStream:
             elif not self.token_reset:
                 self.run()
 
+    def _index_org(self, org) -> None:
+        """Apply an organization from NIF to :py:data:`org_index.org_index`"""
+
+        try:
+            org_index.update(org)
+        except Exception:
+            self.log.exception('Error indexing organization {}'.format(org.get('id', None)))
+
+    def _club_activities(self, club_id) -> (list, dict):
+        """Activities of the grens of a club from :py:data:`org_index.org_index`, ([], {}) if not known"""
+
+        try:
+            return org_index.gren_activities(club_id)
+        except Exception:
+            self.log.exception('Error getting activities for club {}'.format(club_id))
+
+        return [], {}
+
     def _merge_dicts(self, x, y):
         """Simple and safe merge dictionaries
 
@@ -319,37 +592,64 @@ class NifStream:
 
             for m in merged:
 
-                u = requests.get('%s/%s' % (self.api_collections['Person']['url'], m),
-                                 headers=API_HEADERS)
+                u = lungo.get('%s/%s' % (self.api_collections['Person']['url'], m),
+                              headers=API_HEADERS)
 
                 if u.status_code == 200:
                     u_json = u.json()
 
-                    u_u = requests.patch('%s/%s' % (self.api_collections['Person']['url'], u_json['_id']),
-                                         json={'_merged_to': id},
-                                         headers=self._merge_dicts(API_HEADERS, {'If-Match': u_json['_etag']}))
+                    u_u = lungo.patch('%s/%s' % (self.api_collections['Person']['url'], u_json['_id']),
+                                      json={'_merged_to': id},
+                                      headers=self._merge_dicts(API_HEADERS, {'If-Match': u_json['_etag']}))
 
                     if u_u.status_code == 200:
                         pass
                 elif u.status_code == 404:
                     """Not found, create a user!"""
-                    u_p = requests.post(self.api_collections['Person']['url'],
-                                        json={'id': m, '_merged_to': id},
-                                        headers=API_HEADERS)
+                    u_p = lungo.post(self.api_collections['Person']['url'],
+                                     json={'id': m, '_merged_to': id},
+                                     headers=API_HEADERS)
 
                     if u_p.status_code != 201:
                         self.log.error('Error merge to ', u_p.text)
 
     def _write_resume_token(self):
-        """Writes the current :py:attr:`resume_token` to :py:attr:`resume_token_path` file"""
+        """Writes the current :py:attr:`resume_token` to :py:attr:`resume_token_path` file
+
+        With a :py:attr:`status_buffer` the token is written after the buffered statuses are written.
+        """
 
         if self.resume_token_lock is not True:
 
-            try:
-                with open(STREAM_RESUME_TOKEN_FILE, 'wb+') as f:
-                    f.write(self.resume_token)
-            except Exception as e:
-                self.log.exception('Could not write resume token')
+            if self.status_buffer is not None:
+                token = self.resume_token
+                self.status_buffer.set_checkpoint(lambda: self._write_token_file(token))
+            else:
+                self._write_token_file(self.resume_token)
+
+    def _write_token_file(self, token):
+        """Writes ``token`` to :py:attr:`resume_token_path` file
+
+        :param token: The resume token
+        :type token: bytes
+        """
+
+        try:
+            with open(STREAM_RESUME_TOKEN_FILE, 'wb+') as f:
+                f.write(token)
+        except Exception as e:
+            self.log.exception('Could not write resume token')
+
+    def _advance_resume_token(self, token):
+        """Callback for :py:class:`stream_dispatcher.ChangeDispatcher`, writes ``token`` as the new
+        :py:attr:`resume_token`
+
+        :param token: The resume token of the last change where all earlier changes are finished
+        :type token: bytes
+        """
+
+        self.resume_token = token
+        self._write_resume_token()
 
     def _read_resume_token(self):
         """Reads the value of :py:attr:`resume_token_path` file into :py:attr:`resume_token`"""
@@ -394,11 +694,30 @@ class NifStream:
         :return: True on success
         :rtype: bool
         """
-        api_document = requests.get('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
-                                               payload[self.api_collections[change.get_value('entity_type')]['id']]),
-                                    headers=API_HEADERS)
+        api_document = lungo.get('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
+                                            payload[self.api_collections[change.get_value('entity_type')]['id']]),
+                                 headers=API_HEADERS)
         rapi = False
 
+        if change.get_value('entity_type') == 'Organization':
+            self._index_org(payload)
+
+        # Clubs with the general main activity get the activities of their grens
+        activities, main_activity = [], {}
+        if change.get_value('entity_type') == 'Organization' and payload.get('type_id', 0) == 5 \
+                and payload.get('main_activity', {}).get('id', 27) == 27:
+            activities, main_activity = self._club_activities(payload['id'])
+
+        if len(activities) > 0:
+            payload['activities'] = activities
+            if len(main_activity) > 0:
+                payload['main_activity'] = main_activity
+
+        # Hash with the gren activities, before geocoding and other changes to the payload
+        hash_key = (change.get_value('entity_type'),
+                    payload[self.api_collections[change.get_value('entity_type')]['id']])
+        payload_hash = content_hash(payload)
+
         # Does not exist, insert
         if api_document.status_code == 404:
 
@@ -408,9 +727,9 @@ class NifStream:
             elif change.get_value('entity_type') == 'Organization' and STREAM_GEOCODE is True:
                 payload = add_organization_location(payload)
 
-            rapi = requests.post(self.api_collections[change.get_value('entity_type')]['url'],
-                                 data=json.dumps(payload, cls=EveJSONEncoder),
-                                 headers=API_HEADERS)
+            rapi = lungo.post(self.api_collections[change.get_value('entity_type')]['url'],
+                              data=json.dumps(payload, cls=EveJSONEncoder),
+                              headers=API_HEADERS)
 
         # Do exist, replace
         elif api_document.status_code == 200:
@@ -421,39 +740,56 @@ class NifStream:
             if dateutil.parser.parse(api_existing_object['_updated']) < change.get_modified().replace(
                     tzinfo=self.tz_local):
 
+                # Unchanged payload and nobody else has written the document since we did
+                if self.hashes is not None and len(getattr(change, 'merged_from', None) or []) == 0 \
+                        and self.hashes.get(hash_key) == (payload_hash, api_existing_object['_etag']):
+                    with self._stats_lock:
+                        self.writes_skipped += 1
+                    STREAM_WRITES_SKIPPED.inc(entity_type=change.get_value('entity_type'))
+                    return True, None
+
                 # Geocode
                 if change.get_value('entity_type') == 'Person' and STREAM_GEOCODE is True:
                     payload = add_person_location(payload)
 
-                # Really need to preserve the activities for clubs type_id 5
+                # Really need to preserve the activities and Lungo only fields like location for clubs type_id 5
+                # Activities are only patched when computed from the grens
                 if change.get_value('entity_type') == 'Organization' and payload.get('type_id', 0) == 5:
-                    payload.pop('activities', None)
-                    payload.pop('main_activity', None)
-                    rapi = requests.patch('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
-                                                     api_existing_object['_id']),
-                                          data=json.dumps(payload, cls=EveJSONEncoder),
-                                          headers=self._merge_dicts(API_HEADERS,
-                                                                    {'If-Match': api_existing_object['_etag']})
-                                          )
+                    if len(activities) == 0:
+                        payload.pop('activities', None)
+                        payload.pop('main_activity', None)
+
+                    rapi = lungo.patch('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
+                                                  api_existing_object['_id']),
+                                       data=json.dumps(payload, cls=EveJSONEncoder),
+                                       headers=self._merge_dicts(API_HEADERS,
+                                                                 {'If-Match': api_existing_object['_etag']})
+                                       )
                 else:
-                    rapi = requests.put('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
-                                                   api_existing_object['_id']),
-                                        data=json.dumps(payload, cls=EveJSONEncoder),
-                                        headers=self._merge_dicts(API_HEADERS,
-                                                                  {'If-Match': api_existing_object['_etag']})
-                                        )
-
-            # If obsolete, just return
+                    rapi = lungo.put('%s/%s' % (self.api_collections[change.get_value('entity_type')]['url'],
+                                                api_existing_object['_id']),
+                                     data=json.dumps(payload, cls=EveJSONEncoder),
+                                     headers=self._merge_dicts(API_HEADERS,
+                                                               {'If-Match': api_existing_object['_etag']})
+                                     )
+
+            # If obsolete, just return. Status is set to finished by the caller
             else:
-                change.set_status('finished')
                 return True, None
 
         # If successful put or post
         if rapi.status_code in [200, 201]:
 
-            if change.get_value('entity_type') == 'Person':
+            rapi_json = rapi.json()
 
-                rapi_json = rapi.json()
+            with self._stats_lock:
+                self.writes += 1
+            STREAM_WRITES.inc(entity_type=change.get_value('entity_type'))
+
+            if self.hashes is not None and '_etag' in rapi_json:
+                self.hashes.set(hash_key, (payload_hash, rapi_json['_etag']))
+
+            if change.get_value('entity_type') == 'Person':
 
                 # Add merged to for all merged from
                 if len(change.merged_from) > 0:
@@ -0,0 +1,429 @@
+"""
+.. module:: Stream dispatcher
+    :platform: Unix
+    :synopsis: Concurrent processing of change messages with per entity ordering and priority lanes
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import dateutil.parser
+
+from settings import (
+    STREAM_WORKERS,
+    STREAM_COALESCE_WINDOW,
+    STREAM_LANES,
+    STREAM_LIVE_AGE,
+    STREAM_LANE_RATES,
+    STREAM_ENTITY_PRIORITIES
+)
+from metrics import STREAM_QUEUE_DEPTH, STREAM_LANE_DEPTH, STREAM_LANE_WAIT_SECONDS, STREAM_LANE_SECONDS
+
+#: Lanes in priority order, a change is only started from ``backfill`` when no change is ready in ``live``
+LANES = ('live', 'backfill')
+
+
+class _Entry:
+    """A queued change and the changes for the same entity it supersedes"""
+
+    def __init__(self, seq, change):
+        self.seqs = [seq]
+        self.change = change
+        self.superseded = []
+        self.submitted = time.time()
+
+    def supersede(self, seq, change) -> None:
+        """Coalesce ``change`` into this entry, keeping the change with the latest ``modified``"""
+
+        self.seqs.append(seq)
+
+        try:
+            newer = change.get_modified() >= self.change.get_modified()
+        except Exception:
+            newer = True  # Not comparable, use arrival order
+
+        if newer is True:
+            older, self.change = self.change, change
+        else:
+            older = change
+
+        # Merged persons are only known from the change message itself
+        merged = list(getattr(self.change, 'merged_from', []) or [])
+        for m in getattr(older, 'merged_from', []) or []:
+            if m not in merged:
+                merged.append(m)
+
+        if len(merged) > 0:
+            self.change.merged_from = merged
+
+        self.superseded.append(older)
+
+
+class _Lane:
+    """Ready entities in one lane, started at most ``rate`` per second"""
+
+    def __init__(self, name, rate=0):
+        self.name = name
+        self.rate = rate
+        self.ready = []  # Heap of (priority, seq, key)
+        self._next = 0.0
+
+    def delay(self, now) -> float:
+        """Seconds until the next change can be started, 0 if it can be started now"""
+
+        if self.rate <= 0:
+            return 0.0
+
+        return max(0.0, self._next - now)
+
+    def take(self, now) -> None:
+        """Count a started change against the rate"""
+
+        if self.rate > 0:
+            self._next = max(self._next, now) + 1.0 / self.rate
+
+
+class ChangeDispatcher:
+    """Process change messages in a pool of worker threads
+
+    Change messages for different entities are processed concurrently, while change messages for the same
+    ``(entity_type, id)`` are processed one at a time in the order they were submitted.
+
+    Each submitted change carries the resume token of the change stream event. When changes are finished, the
+    dispatcher advances to the token of the last change for which every earlier change is also finished and hands
+    it to ``on_advance``. A restart from that token will never skip an unprocessed change.
+
+    With a ``coalesce`` window a new entity is held for ``coalesce`` seconds before it is processed. Changes for an
+    entity that is waiting are coalesced, only the change with the latest ``modified`` is processed and the
+    superseded changes are set to ``finished`` after it.
+
+    With ``lanes`` an entity ready to be processed is routed to the ``live`` lane if the ``sequence_ordinal`` of its
+    change is less than ``live_age`` seconds old, else to the ``backfill`` lane. Workers always take from ``live``
+    first, so fresh changes from sync are not queued behind a populate of historical changes. Within a lane entity
+    types are taken by ``priorities``, lower first, then in submit order. ``rates`` caps the changes per second
+    started from each lane. Since reordering only happens among pending changes, ``max_pending`` is at least 1000
+    with lanes.
+
+    .. note::
+        A change counts as finished when ``process`` returns, regardless of the result. Failed changes are marked
+        ``error`` and unhandled ones are left ``ready``, both are picked up by :py:meth:`stream.NifStream.recover`.
+
+    :param process: Callable processing one :py:class:`eve_api.ChangeStreamItem`
+    :type process: callable
+    :param workers: Number of worker threads. Defaults to STREAM_WORKERS
+    :type workers: int
+    :param max_pending: Max number of submitted but unfinished changes before :py:meth:`submit` blocks
+    :type max_pending: int
+    :param on_advance: Callable receiving the resume token when it advances
+    :type on_advance: callable
+    :param coalesce: Seconds to hold changes for coalescing, 0 disables coalescing. Defaults to STREAM_COALESCE_WINDOW
+    :type coalesce: int
+    :param lanes: Route changes to the live and backfill lanes, else all changes go in ``live``. Defaults to
+        STREAM_LANES
+    :type lanes: bool
+    :param live_age: Max age in seconds of the ``sequence_ordinal`` of a live change. Defaults to STREAM_LIVE_AGE
+    :type live_age: int
+    :param rates: Max changes per second started from each lane, 0 or missing is unlimited. Defaults to
+        STREAM_LANE_RATES
+    :type rates: dict
+    :param priorities: Priority of each entity type within a lane, lower first, missing types last. Defaults to
+        STREAM_ENTITY_PRIORITIES
+    :type priorities: dict
+    :param log: The logger
+    :type log: app_logger.AppLogger
+
+    Usage::
+
+        dispatcher = ChangeDispatcher(process=stream._process_change, workers=8, on_advance=write_token)
+        dispatcher.start()
+        dispatcher.submit(ChangeStreamItem(document), token)
+        dispatcher.stop()
+    """
+
+    def __init__(self, process, workers=STREAM_WORKERS, max_pending=None, on_advance=None,
+                 coalesce=STREAM_COALESCE_WINDOW, lanes=STREAM_LANES, live_age=STREAM_LIVE_AGE,
+                 rates=STREAM_LANE_RATES, priorities=STREAM_ENTITY_PRIORITIES, log=None):
+
+        self.process = process
+        self.workers = max(1, workers)
+        self.coalesce = coalesce
+        self.lanes = lanes
+        self.live_age = live_age
+        self.priorities = priorities
+        self.max_pending = max_pending if max_pending is not None else self.workers * 10
+        if self.coalesce > 0 or self.lanes is True:
+            self.max_pending = max(self.max_pending, 1000)
+        self.on_advance = on_advance
+        self.log = log
+
+        self.processed = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._held = threading.Condition(self._lock)
+        self._ready = threading.Condition(self._lock)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+        self._seq = 0
+        self._keys = {}  # (entity_type, id) -> deque of _Entry
+        self._active = set()  # Keys being processed
+        self._delayed = []  # Heap of (due, key) held for coalescing
+        self._order = deque()  # (seq, token) in submit order
+        self._done = set()
+        self._lanes = [_Lane(name, rates.get(name, 0)) for name in LANES]  # Keys with a change ready to be processed
+        self._token_seq = -1
+
+        self._threads = []
+        self._stopping = False
+
+    @property
+    def pending(self) -> int:
+        """Number of submitted changes not yet finished"""
+
+        with self._lock:
+            return len(self._order)
+
+    def start(self) -> None:
+        """Start the worker threads"""
+
+        self._stopping = False
+
+        for i in range(0, self.workers):
+            t = threading.Thread(target=self._worker, name='stream-worker-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+        if self.coalesce > 0:
+            t = threading.Thread(target=self._release_held, name='stream-coalesce', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, change, token=None) -> None:
+        """Queue a change for processing. Blocks while :py:attr:`max_pending` changes are unfinished.
+
+        :param change: The change message
+        :type change: eve_api.ChangeStreamItem
+        :param token: The resume token for the change
+        :type token: bytes
+        """
+
+        self._slots.acquire()
+
+        with self._lock:
+            seq = self._seq
+            self._seq += 1
+            self._order.append((seq, token))
+            STREAM_QUEUE_DEPTH.set(len(self._order))
+
+            key = (change.entity_type, change.id)
+            entries = self._keys.get(key, None)
+
+            if entries is None:
+                self._keys[key] = deque([_Entry(seq, change)])
+                if self.coalesce > 0:
+                    heapq.heappush(self._delayed, (time.time() + self.coalesce, seq, key))
+                    self._held.notify()
+                else:
+                    self._put_ready(key)
+
+            elif self.coalesce > 0 and (key not in self._active or len(entries) > 1):
+                # Last entry is still waiting
+                entries[-1].supersede(seq, change)
+                self.coalesced += 1
+
+            else:
+                # Entity is being processed, wait for its turn
+                entries.append(_Entry(seq, change))
+
+    def join(self) -> None:
+        """Block until all submitted changes are finished"""
+
+        with self._idle:
+            while len(self._order) > 0:
+                self._idle.wait()
+
+    def stop(self, wait=True) -> None:
+        """Stop the worker threads
+
+        :param wait: If True finish all submitted changes before stopping
+        :type wait: bool
+        """
+
+        if wait is True:
+            with self._lock:
+                # Release all held entities right away
+                while len(self._delayed) > 0:
+                    self._put_ready(heapq.heappop(self._delayed)[2])
+
+            self.join()
+
+        with self._lock:
+            self._stopping = True
+            self._held.notify_all()
+            self._ready.notify_all()
+
+        for t in self._threads:
+            t.join()
+
+        self._threads = []
+
+    def _release_held(self) -> None:
+        """Move held entities to the ready queue when their coalesce window is over"""
+
+        with self._lock:
+            while self._stopping is False:
+                if len(self._delayed) == 0:
+                    self._held.wait()
+                    continue
+
+                wait = self._delayed[0][0] - time.time()
+                if wait > 0:
+                    self._held.wait(wait)
+                    continue
+
+                self._put_ready(heapq.heappop(self._delayed)[2])
+
+    def _lane(self, change) -> _Lane:
+        """The lane for ``change`` by the age of its ``sequence_ordinal``, changes of unknown age are live"""
+
+        if self.lanes is not True:
+            return self._lanes[0]
+
+        try:
+            ordinal = change.get_value('sequence_ordinal')
+            if not isinstance(ordinal, datetime):
+                ordinal = dateutil.parser.parse(ordinal)
+            if ordinal.tzinfo is None:
+                ordinal = ordinal.replace(tzinfo=timezone.utc)
+
+            if (datetime.now(timezone.utc) - ordinal).total_seconds() > self.live_age:
+                return self._lanes[1]
+        except Exception:
+            pass
+
+        return self._lanes[0]
+
+    def _put_ready(self, key) -> None:
+        """Route the first change of ``key`` to its lane, call with the lock held"""
+
+        entry = self._keys[key][0]
+        lane = self._lane(entry.change)
+
+        heapq.heappush(lane.ready, (self.priorities.get(entry.change.entity_type, len(self.priorities)),
+                                    entry.seqs[0], key))
+        STREAM_LANE_DEPTH.set(len(lane.ready), lane=lane.name)
+
+        self._ready.notify()
+
+    def _take_ready(self):
+        """Block until a key is ready in a lane within its rate, call with the lock held
+
+        :return: (key, lane) or (None, None) when stopping
+        """
+
+        while True:
+            now = time.time()
+            wait = None
+
+            for lane in self._lanes:
+                if len(lane.ready) == 0:
+                    continue
+
+                delay = 0.0 if self._stopping is True else lane.delay(now)
+
+                if delay <= 0:
+                    lane.take(now)
+                    key = heapq.heappop(lane.ready)[2]
+                    STREAM_LANE_DEPTH.set(len(lane.ready), lane=lane.name)
+
+                    return key, lane
+
+                wait = delay if wait is None else min(wait, delay)
+
+            if self._stopping is True:
+                return None, None
+
+            self._ready.wait(wait)
+
+    def _worker(self) -> None:
+
+        while True:
+            with self._lock:
+                key, lane = self._take_ready()
+
+                if key is None:
+                    break
+
+                entry = self._keys[key][0]
+                self._active.add(key)
+
+            STREAM_LANE_WAIT_SECONDS.observe(time.time() - entry.submitted, lane=lane.name)
+
+            try:
+                self.process(entry.change)
+            except Exception:
+                if self.log is not None:
+                    self.log.exception('Error processing change {} {}'.format(*key))
+
+            for change in entry.superseded:
+                try:
+                    change.set_status('finished')
+                except Exception:
+                    if self.log is not None:
+                        self.log.exception('Error finishing superseded change {} {}'.format(*key))
+
+            with self._lock:
+                self._active.discard(key)
+                self._keys[key].popleft()
+                if len(self._keys[key]) > 0:
+                    self._put_ready(key)
+                else:
+                    del self._keys[key]
+
+                self._done.update(entry.seqs)
+                self.processed += 1
+                token_seq, token = self._advance()
+                STREAM_QUEUE_DEPTH.set(len(self._order))
+
+                if len(self._order) == 0:
+                    self._idle.notify_all()
+
+            STREAM_LANE_SECONDS.observe(time.time() - entry.submitted, lane=lane.name)
+
+            for seq in entry.seqs:
+                self._slots.release()
+
+            if token_seq is not None:
+                self._set_token(token_seq, token)
+
+    def _advance(self) -> (int, bytes):
+        """Pop finished changes from the head of the submit order
+
+        :returns: (seq, token) of the last popped change or (None, None)
+        """
+
+        seq, token = None, None
+
+        while len(self._order) > 0 and self._order[0][0] in self._done:
+            seq, token = self._order.popleft()
+            self._done.discard(seq)
+
+        return seq, token
+
+    def _set_token(self, seq, token) -> None:
+        """Hand the token to :py:attr:`on_advance`, never going backwards"""
+
+        with self._token_lock:
+            if seq > self._token_seq:
+                self._token_seq = seq
+                if self.on_advance is not None and token is not None:
+                    try:
+                        self.on_advance(token)
+                    except Exception:
+                        if self.log is not None:
+                            self.log.exception('Error advancing resume token')
@@ -8,7 +8,8 @@ import sys
 import os
 from stream import NifStream
 from app_logger import AppLogger
-from settings import STREAMDAEMON_PID_FILE
+from metrics import MetricsServer
+from settings import STREAMDAEMON_PID_FILE, METRICS_HOST, STREAM_METRICS_PORT
 
 # Stoppers
 workers_stop = threading.Event()
@@ -50,6 +51,11 @@ if __name__ == '__main__':
                        working_directory='{}/'.format(os.getcwd())
                        ):
 
+        if STREAM_METRICS_PORT > 0:
+            metrics_server = MetricsServer(port=STREAM_METRICS_PORT)
+            metrics_server.start()
+            log.info('Serving metrics on {}:{}'.format(METRICS_HOST, STREAM_METRICS_PORT))
+
         stream = NifStream()
         log.info('Running stream run')
         try:
@@ -7,21 +7,33 @@
 import sys
 import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import dateutil.parser
 import hashlib
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_MISSED, EVENT_JOB_ERROR
 from dateutil import tz
 
-from eve_api import EveJSONEncoder
+from eve_api import EveJSONEncoder, lungo
 
 from nif_api import NifApiSynchronization
 from app_logger import AppLogger
+from checkpoints import SyncCheckpoints
+from pool import InstrumentedPool
+from metrics import (
+    NIF_CALL_SECONDS,
+    SYNC_WINDOW_SECONDS,
+    SYNC_CHANGES,
+    SYNC_CHANGES_PER_SECOND,
+    POOL_WAIT_SECONDS,
+    POOL_WAITING
+)
 from settings import (
     API_HEADERS, API_URL,
     STREAM_RESUME_TOKEN_FILE,
@@ -34,10 +46,95 @@ from settings import (
     NIF_REALM,
     SYNC_LOG_FILE,
     NIF_SYNC_DELAY,
-    NIF_SYNC_MAX_ERRORS
+    NIF_SYNC_MAX_ERRORS,
+    NIF_SYNC_BATCH_SIZE,
+    NIF_SYNC_JITTER,
+    NIF_POPULATE_WORKERS,
+    NIF_WINDOW_ADAPTIVE,
+    NIF_WINDOW_MIN_SIZE,
+    NIF_WINDOW_MAX_SIZE,
+    NIF_WINDOW_TARGET_COUNT,
+    NIF_WINDOW_TARGET_LATENCY
 )
 
 
+def prepare_changes(changes, org_id, log=None) -> list:
+    """Prepare change messages from NIF for insert into the api
+
+    Creates a custom unique '_ordinal' for each change message. The purpose is to let it gracefully fail with a http
+    422 if the change message already exists in the api::
+
+        sha224(bytearray(entity_type, id, sequence_ordinal, org_id))
+
+    Change messages with the same '_ordinal' are only included once since a duplicate would fail a bulk insert.
+
+    :param changes: list of change messages
+    :type changes: :py:class:`typings.changes.Changes`
+    :param org_id: The integration user organization id
+    :type org_id: int
+    :param log: The logger
+    :type log: app_logger.AppLogger
+    :return: The change messages to insert
+    :rtype: list[dict]
+    """
+
+    prepared = []
+    ordinals = set()
+
+    for v in changes:
+        v['_ordinal'] = hashlib.sha224(bytearray("%s%s%s%s" % (v['entity_type'],
+                                                               v['id'],
+                                                               v['sequence_ordinal'],
+                                                               org_id),
+                                                 'utf-8')).hexdigest()
+        # bytearray("%s%s%s%s" % (self.org_id, v['EntityType'], v['Id'], v['sequence_ordinal']), 'utf-8')).hexdigest()
+
+        v['_status'] = 'ready'  # ready -> running -> finished
+        v['_org_id'] = org_id
+        v['_realm'] = NIF_REALM
+
+        if v['_ordinal'] in ordinals:
+            if log is not None:
+                log.debug('Skipping duplicate {0} with id {1} in response'.format(v['entity_type'], v['id']))
+            continue
+
+        ordinals.add(v['_ordinal'])
+        prepared.append(v)
+
+    return prepared
+
+
+def bulk_insert_retries(batch, items, log) -> list:
+    """Find the change messages to post again after a bulk insert was rejected with a http 422
+
+    Eve validates every item in a bulk insert and returns a status for each. Items with a duplicate '_ordinal'
+    already exists and are dropped, other failed items are logged as errors.
+
+    :param batch: list of change messages posted
+    :type batch: list[dict]
+    :param items: the '_items' of the response, one for each change message
+    :type items: list[dict]
+    :param log: The logger
+    :type log: app_logger.AppLogger
+    :return: The change messages that passed validation
+    :rtype: list[dict]
+    """
+
+    retry = []
+    for v, item in zip(batch, items):
+        if item.get('_status', 'ERR') == 'OK':
+            retry.append(v)
+        elif '_ordinal' in item.get('_issues', {}):
+            log.debug('422 {0} with id {1} already exists'.format(v['entity_type'],
+                                                                  v['id']))
+        else:
+            log.error('Could not create change message for {0} with id {1}'.format(v['entity_type'],
+                                                                                   v['id']))
+            log.error(item.get('_issues', 'Unknown error'))
+
+    return retry
+
+
 class FakeSemaphore(object):
     """A semaphore context to be able to run :py:class:`NifSync` without a specifying a semaphore
     """
@@ -79,6 +176,87 @@ class SyncState(object):
         return {'state': self.state, 'mode': self.mode, 'reason': self.reason}
 
 
+class AdaptiveWindow(object):
+    """Size of the GetChanges window in hours, adapted to the responses
+
+    The window is halved when a response has more than ``target_count`` change messages or took longer than
+    ``target_latency`` seconds, and doubled when both are below a quarter of the targets. Only a window of the full
+    size can grow it, a window cut short by the end of the interval says little about the size. With windows fetched
+    concurrently responses arrive out of order, a window starting before the last window that shrunk the size will
+    not grow it.
+
+    :param size: Initial size in hours
+    :type size: float
+    :param adaptive: If False the size never changes. Defaults to NIF_WINDOW_ADAPTIVE
+    :type adaptive: bool
+    :param min_size: Min size in hours. Defaults to NIF_WINDOW_MIN_SIZE
+    :type min_size: float
+    :param max_size: Max size in hours. Defaults to NIF_WINDOW_MAX_SIZE
+    :type max_size: float
+    :param target_count: Max change messages in a window. Defaults to NIF_WINDOW_TARGET_COUNT
+    :type target_count: int
+    :param target_latency: Max seconds for a window. Defaults to NIF_WINDOW_TARGET_LATENCY
+    :type target_latency: float
+    """
+
+    def __init__(self,
+                 size,
+                 adaptive=NIF_WINDOW_ADAPTIVE,
+                 min_size=NIF_WINDOW_MIN_SIZE,
+                 max_size=NIF_WINDOW_MAX_SIZE,
+                 target_count=NIF_WINDOW_TARGET_COUNT,
+                 target_latency=NIF_WINDOW_TARGET_LATENCY):
+
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_count = target_count
+        self.target_latency = target_latency
+        self.size = min(max(size, min_size), max_size) if adaptive else size
+
+        self._shrunk_at = None  # Start of the last window that shrunk the size
+        self._lock = threading.Lock()
+
+    @property
+    def timedelta(self) -> timedelta:
+        return timedelta(hours=self.size)
+
+    def update(self, count, latency, start=None, span=None) -> bool:
+        """Adapt the size to a response
+
+        :param count: Number of change messages in the response
+        :type count: int
+        :param latency: Seconds used to get and post the window
+        :type latency: float
+        :param start: Start of the window
+        :type start: datetime.datetime
+        :param span: Length of the window, a window shorter than the size does not grow it
+        :type span: timedelta
+        :return: True if the size changed
+        :rtype: bool
+        """
+
+        if self.adaptive is not True:
+            return False
+
+        with self._lock:
+            size = self.size
+
+            if count > self.target_count or latency > self.target_latency:
+                size = max(self.min_size, size / 2)
+                if start is not None and (self._shrunk_at is None or start > self._shrunk_at):
+                    self._shrunk_at = start
+            elif count < self.target_count / 4 and latency < self.target_latency / 4 \
+                    and (span is None or span >= self.timedelta):
+                if start is None or self._shrunk_at is None or start >= self._shrunk_at:
+                    size = min(self.max_size, size * 2)
+
+            changed = size != self.size
+            self.size = size
+
+        return changed
+
+
 class NifSync(threading.Thread):
     """Populate and sync change messages from NIF api
 
@@ -101,8 +279,9 @@ class NifSync(threading.Thread):
     The class will automatically handle when to :py:meth:`populate` and :py:meth:`sync`.
 
     .. note::
-        :py:meth:`_check` is called on init and checks with the api to find last change message for
-        :py:attr:`org_id` and the last message is then used as the initial starting point.
+        :py:meth:`_check` is called on init and reads the last checkpoint for :py:attr:`org_id` from
+        :py:attr:`checkpoints`, if missing it checks with the api to find last change message. This is then used as
+        the initial starting point.
 
 
     :param org_id: The integration user organization id, required
@@ -123,14 +302,24 @@ class NifSync(threading.Thread):
     :type initial_timedelta: int
     :param overlap_timedelta: A optional timedelta for overlap functions in hours
     :type overlap_timedelta: int
-    :param lock: The semaphore object, if None uses :py:class:`.FakeSemaphore`
-    :type lock: threading.BoundedSemaphore
+    :param lock: The connection pool, a :py:class:`pool.InstrumentedPool` or a semaphore. If None uses
+        :py:class:`.FakeSemaphore`
+    :type lock: pool.InstrumentedPool
     :param sync_type: The sync type for this user, allowed ``changes``, ``competence`` and ``license``. Defaults to ``changes``.
     :type sync_type: str
     :param sync_interval: The interval for the sync scheduler in minutes. Defaults to NIF_SYNC_INTERVAL
     :type sync_interval: int
     :param populate_interval: The interval for populating in days. Defaults to NIF_POPULATE_INTERVAL
     :type populate_interval: int
+    :param batch_size: Number of change messages in each bulk insert to the api. Defaults to NIF_SYNC_BATCH_SIZE
+    :type batch_size: int
+    :param scheduler: A shared and running scheduler. If given the sync job is added to it instead of creating a
+        scheduler for this worker, and the thread exits once the job is scheduled
+    :type scheduler: apscheduler.schedulers.base.BaseScheduler
+    :param populate_workers: Number of populate windows fetched concurrently. Defaults to NIF_POPULATE_WORKERS
+    :type populate_workers: int
+    :param checkpoints: The checkpoint store, if None creates a :py:class:`checkpoints.SyncCheckpoints`
+    :type checkpoints: checkpoints.SyncCheckpoints
 
     Usage - threading::
 
@@ -144,13 +333,22 @@ class NifSync(threading.Thread):
         sync = NifSync(org_id, username, password)
         sync.run()  # sync starts without thread running
 
-    Usage - with semaphore::
+    Usage - with shared scheduler::
+
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from sync import NifSync
+        scheduler = BackgroundScheduler()
+        scheduler.start()
+        sync = NifSync(org_id, username, password, scheduler=scheduler)
+        sync.start()  # thread exits after populate, sync job runs in scheduler
+
+    Usage - with connection pool::
 
-        import threading
+        from pool import InstrumentedPool
         from sync import NifSync
-        bound_semaphore = threading.BoundedSemaphore(value=10)
-        sync = NifSync(org_id, username, password, lock=bounding_semaphore)
-        sync.start()  # sync is of threading.Thread, semaphore has 10 slots
+        pool = InstrumentedPool(size=10)
+        sync = NifSync(org_id, username, password, lock=pool)
+        sync.start()  # sync is of threading.Thread, pool has 10 slots
 
     .. note::
         The usernames and passwords for integration users on club level is stored in integration/users and accessible
@@ -170,7 +368,11 @@ class NifSync(threading.Thread):
                  lock=None,
                  sync_type='changes',
                  sync_interval=NIF_CHANGES_SYNC_INTERVAL,
-                 populate_interval=NIF_POPULATE_INTERVAL):
+                 populate_interval=NIF_POPULATE_INTERVAL,
+                 batch_size=NIF_SYNC_BATCH_SIZE,
+                 scheduler=None,
+                 populate_workers=NIF_POPULATE_WORKERS,
+                 checkpoints=None):
 
         self.state = SyncState()
 
@@ -184,6 +386,7 @@ class NifSync(threading.Thread):
 
         self.id = org_id
         self.username = username
+        self._password = password
 
         self.started = datetime.now()
         self.sync_errors = 0
@@ -191,6 +394,8 @@ class NifSync(threading.Thread):
 
         self.sync_interval = sync_interval  # minutes
         self.populate_interval = populate_interval  # days
+        self.batch_size = max(1, batch_size)  # change messages per bulk insert
+        self.populate_workers = max(1, populate_workers)  # concurrent populate windows
 
         self.initial_timedelta = initial_timedelta
         self.overlap_timedelta = overlap_timedelta
@@ -219,11 +424,20 @@ class NifSync(threading.Thread):
                 self.log.warning('No resume token at {}'.format(STREAM_RESUME_TOKEN_FILE))
                 self.log.warning('Requires stream to have or be running and a valid token file')
 
-        if lock is not None and (isinstance(lock, threading.BoundedSemaphore) or isinstance(lock, threading.Semaphore)):
+        if lock is not None and isinstance(lock, (InstrumentedPool, threading.BoundedSemaphore, threading.Semaphore)):
             self.lock = lock
         else:
             self.lock = FakeSemaphore()  # Be able to run singlethreaded as well
 
+        self.checkpoints = checkpoints if checkpoints is not None else SyncCheckpoints()
+
+        # GetChanges window, starts from the size learned in earlier runs
+        window_size = self.checkpoints.get_window_size(org_id, self.sync_type)
+        self.window = AdaptiveWindow(window_size if window_size is not None else populate_interval)
+        self._populate_lock = threading.Lock()  # Also guards the counters updated by the populate threads
+        self._populate_retry = []  # Windows to fetch before the cursor
+        self._populate_cursor = None
+
         # Lungo REST API
         self.api_integration_url = '%s/integration/changes' % API_URL
 
@@ -236,6 +450,9 @@ class NifSync(threading.Thread):
         self.log.debug('Skew:       {0} seconds'.format(self.initial_timedelta))
         self.log.debug('Sync:       {0} minutes'.format(self.sync_interval))
         self.log.debug('Populate:   {0} hours'.format(self.populate_interval))
+        self.log.debug('Batch size: {0}'.format(self.batch_size))
+        self.log.debug('Populate workers: {0}'.format(self.populate_workers))
+        self.log.debug('Window:     {0} hours'.format(self.window.size))
         self.log.debug('Api url:    {0}'.format(self.api_integration_url))
 
         # Created
@@ -253,8 +470,15 @@ class NifSync(threading.Thread):
             # sys.exit(0)
             raise Exception('Could not create sync client')
 
+        # The clients are not thread safe, populate threads get their own, see _client
+        self._clients = threading.local()
+
         # Setup job scheduler
-        if self.background:
+        self.shared_scheduler = scheduler is not None
+        if self.shared_scheduler:
+            self.scheduler = scheduler
+            self.log.info('Scheduler:  shared')
+        elif self.background:
             self.scheduler = BackgroundScheduler()
             self.log.info('Scheduler:  BackgroundScheduler')
         else:
@@ -265,10 +489,22 @@ class NifSync(threading.Thread):
         self.scheduler.add_listener(self._job_fire, EVENT_JOB_EXECUTED)
         self.scheduler.add_listener(self._job_misfire, EVENT_JOB_MISSED)
 
-        self.job = self.scheduler.add_job(self.sync, 'interval', minutes=self.sync_interval, max_instances=1)
+        self.job = None
+        self._add_job()
 
         self.state.set_state(state='finished')
 
+    def _add_job(self) -> None:
+        """Add the sync job to :py:attr:`scheduler`, in a shared scheduler also after :py:meth:`_shutdown` removed it"""
+
+        if self.shared_scheduler:
+            # Paused until populated, jitter spreads the calls to NIF
+            self.job = self.scheduler.add_job(self.sync, 'interval', minutes=self.sync_interval, max_instances=1,
+                                              jitter=NIF_SYNC_JITTER, next_run_time=None,
+                                              id='{}-{}'.format(self.name, self.sync_type))
+        else:
+            self.job = self.scheduler.add_job(self.sync, 'interval', minutes=self.sync_interval, max_instances=1)
+
     def __del__(self):
         """Destructor, shutdown the scheduler on exit"""
 
@@ -278,7 +514,7 @@ class NifSync(threading.Thread):
             pass
 
         try:
-            if self.scheduler.running is True:
+            if self.shared_scheduler is False and self.scheduler.running is True:
                 self.scheduler.shutdown(wait=False)
                 self.log.debug('Shutting down scheduler')
         except:
@@ -295,22 +531,31 @@ class NifSync(threading.Thread):
         t = datetime.now() - self.started
         return t.days, t.seconds
 
+    @property
+    def running(self) -> bool:
+        """True while the thread is alive or the sync job is scheduled in a shared scheduler"""
+
+        if self.is_alive():
+            return True
+
+        return self.shared_scheduler and self.job_next_run_time is not None
+
     @property
     def job_next_run_time(self):
 
-        if self.scheduler.state == 1:
+        if self.scheduler.state == 1 and self.job is not None:
             return self.job.next_run_time
 
         return None
 
     def job_pause(self):
 
-        if self.scheduler.state == 1:
+        if self.scheduler.state == 1 and self.job is not None:
             self.job.pause()
 
     def job_resume(self):
 
-        if self.scheduler.state == 1:
+        if self.scheduler.state == 1 and self.job is not None:
             self.job.resume()
 
     @property
@@ -323,6 +568,9 @@ class NifSync(threading.Thread):
 
         :param event: apcscheduler.Event
         """
+        if self.job is None or event.job_id != self.job.id:
+            return
+
         self.job_misfires += 1
 
     def _job_fire(self, event) -> None:
@@ -330,6 +578,9 @@ class NifSync(threading.Thread):
 
         :param event: apcscheduler.Event
         """
+        if self.job is None or event.job_id != self.job.id:
+            return
+
         if self.job_misfires > 0:
             self.job_misfires -= 1
 
@@ -337,9 +588,15 @@ class NifSync(threading.Thread):
         """Start the thread, conforms to threading.Thread.start()
 
         Calls :py:meth:`._check` which determines wether to run :py:meth:`populate` or start a job with target
-        :py:meth:`sync`
+        :py:meth:`sync`. In a shared scheduler a job removed by :py:meth:`_shutdown` is added again, which restarts the
+        worker, see :py:meth:`syncdaemon.PyroService.restart_worker`.
         """
         self.log.debug('[Starting thread]')
+
+        if self.job is None:
+            self.sync_errors = 0
+            self._add_job()
+
         self._check()
 
     def _stopper(self, force=False) -> None:
@@ -363,7 +620,17 @@ class NifSync(threading.Thread):
     def _shutdown(self) -> None:
         """Shutdown in an orderly fashion"""
 
-        if self.scheduler.state > 0:
+        if self.shared_scheduler:
+            try:
+                self.log.debug('Removing job from shared scheduler')
+                self.job.remove()
+            except Exception as e:
+                self.log.debug('Job already removed')
+
+            # The removed job keeps its next_run_time, see running
+            self.job = None
+
+        elif self.scheduler.state > 0:
             try:
                 self.log.debug('Shutting down scheduler')
                 if self.scheduler.running is True:
@@ -379,15 +646,31 @@ class NifSync(threading.Thread):
     def _check(self) -> None:
         """Checks to decide to populate or sync on startup
 
+        The end of the last window fetched is read from :py:attr:`checkpoints`, only if missing the last change
+        message is queried from the api.
+
         .. danger::
             On errors from the api, calls :py:meth:`_stopper(force=True)` which will terminate thread.
         """
 
         self.state.set_state(mode='checking', state='running')
+
+        if self.checkpoints.get_plan(self.org_id, self.sync_type) is not None:
+            self.log.debug('Unfinished populate plan, resuming populate')
+            self.populate()
+            return
+
+        checkpoint = self.checkpoints.get_checkpoint(self.org_id, self.sync_type)
+
+        if checkpoint is not None:
+            self.log.debug('Last checkpoint {0}'.format(checkpoint.astimezone(self.tz_local).isoformat()))
+            self._resume(checkpoint)
+            return
+
         # @TODO: check if in changes/stream - get last, then use last date retrieved as start_date (-1microsecond)
-        changes = requests.get('%s?where={"_org_id":%s, "_realm":"%s"}&sort=[("sequence_ordinal", -1)]&max_results=1' %
-                               (self.api_integration_url, self.org_id, NIF_REALM),
-                               headers=API_HEADERS)
+        changes = lungo.get('%s?where={"_org_id":%s, "_realm":"%s"}&sort=[("sequence_ordinal", -1)]&max_results=1' %
+                            (self.api_integration_url, self.org_id, NIF_REALM),
+                            headers=API_HEADERS)
 
         if changes.status_code == 404:
             # populate, should not happen!
@@ -413,29 +696,45 @@ class NifSync(threading.Thread):
                 self.log.debug(
                     'Last change message recorded {0}'.format(sequential_ordinal.astimezone(self.tz_local).isoformat()))
 
-                self.initial_start = sequential_ordinal + timedelta(seconds=self.initial_timedelta) - timedelta(hours=self.overlap_timedelta)
-
-                if self.initial_start.tzinfo is None or self.initial_start.tzinfo.utcoffset(self.initial_start) is None:
-                    self.initial_start = self.initial_start.replace(self.tz_local)
-
-                if self.initial_start < datetime.utcnow().replace(tzinfo=self.tz_utc) - timedelta(
-                        hours=self.populate_interval):
-                    """More than 30 days!"""
-                    self.log.debug('More than {} days, populating'.format(self.populate_interval))
-                    self.populate()
-                    self.state.set_state(mode='populate', state='initialized')
-                else:
-                    self.log.debug('Less than {} hours, syncing'.format(self.populate_interval))
-                    self.job.modify(next_run_time=datetime.now())
-                    self.log.debug('Told job to start immediately')
-                    self.log.debug('Starting sync scheduler')
-                    self.scheduler.start()
-                    self.state.set_state(mode='sync', state='started')
+                self._resume(sequential_ordinal)
 
         else:
             self.log.error('{0} from {1}, terminating'.format(changes.status_code, self.api_integration_url))
             sys.exit()
 
+    def _resume(self, last) -> None:
+        """Populate or sync from the last change message or checkpoint
+
+        :param last: Time of the last change message or checkpoint
+        :type last: datetime.datetime
+        """
+
+        self.initial_start = last + timedelta(seconds=self.initial_timedelta) - timedelta(hours=self.overlap_timedelta)
+
+        if self.initial_start.tzinfo is None or self.initial_start.tzinfo.utcoffset(self.initial_start) is None:
+            self.initial_start = self.initial_start.replace(self.tz_local)
+
+        if self.initial_start < datetime.utcnow().replace(tzinfo=self.tz_utc) - timedelta(
+                hours=self.populate_interval):
+            """More than 30 days!"""
+            self.log.debug('More than {} days, populating'.format(self.populate_interval))
+            self.populate()
+            self.state.set_state(mode='populate', state='initialized')
+        else:
+            self.log.debug('Less than {} hours, syncing'.format(self.populate_interval))
+            self.state.set_state(mode='sync', state='started')
+            self.job.modify(next_run_time=datetime.now())
+            self.log.debug('Told job to start immediately')
+            self._start_scheduler()
+
+    def _set_checkpoint(self, end_date) -> None:
+        """Store the end of the last window fetched in :py:attr:`checkpoints`, see :py:meth:`_check`"""
+
+        try:
+            self.checkpoints.set_checkpoint(self.org_id, self.sync_type, end_date)
+        except Exception:
+            self.log.exception('Could not store checkpoint')
+
     def _eve_fix_sync(self, o) -> dict:
         """Just make soap response simpler
 
@@ -469,62 +768,119 @@ class NifSync(threading.Thread):
 
                 sha224(bytearray(entity_type, id, sequence_ordinal, org_id))
 
+        Change messages are posted as list payloads (Eve bulk inserts) in chunks of :py:attr:`batch_size`, see
+        :py:meth:`_post_changes`.
+
         :param changes: list of change messages
         :type changes: :py:class:`typings.changes.Changes`
         """
 
-        for v in changes:
-            v['_ordinal'] = hashlib.sha224(bytearray("%s%s%s%s" % (v['entity_type'],
-                                                                   v['id'],
-                                                                   v['sequence_ordinal'],
-                                                                   self.org_id),
-                                                     'utf-8')).hexdigest()
-            # bytearray("%s%s%s%s" % (self.org_id, v['EntityType'], v['Id'], v['sequence_ordinal']), 'utf-8')).hexdigest()
+        changes = prepare_changes(changes, self.org_id, self.log)
 
-            v['_status'] = 'ready'  # ready -> running -> finished
-            v['_org_id'] = self.org_id
-            v['_realm'] = NIF_REALM
+        for i in range(0, len(changes), self.batch_size):
+            self._post_changes(changes[i:i + self.batch_size])
 
-            r = requests.post(self.api_integration_url,
-                              data=json.dumps(v, cls=EveJSONEncoder),
-                              headers=API_HEADERS)
+    def _post_changes(self, batch) -> None:
+        """Bulk insert a list of change messages
 
-            if r.status_code == 201:
-                self.log.debug('Created change message for {0} with id {1}'.format(v['entity_type'],
-                                                                                   v['id']))
+        Eve validates every item in a bulk insert and rejects the whole request with a http 422 if one of them fails,
+        typically on a duplicate '_ordinal'. The items marked as failed are then dropped and the remaining items are
+        posted again.
+
+        :param batch: list of change messages
+        :type batch: list[dict]
+        """
+
+        if len(batch) == 1:
+            self._post_change(batch[0])
+            return
+
+        r = lungo.post(self.api_integration_url,
+                       data=json.dumps(batch, cls=EveJSONEncoder),
+                       headers=API_HEADERS)
+
+        if r.status_code == 201:
+            self.log.debug('Created {0} change messages'.format(len(batch)))
+            with self._populate_lock:
+                self.messages += len(batch)
+
+        elif r.status_code == 422:
+
+            try:
+                items = r.json().get('_items', [])
+            except ValueError:
+                items = []
+
+            if len(items) != len(batch):
+                # Can not tell which items failed, fall back to one by one
+                self.log.debug('422 on bulk insert without item status, posting one by one')
+                for v in batch:
+                    self._post_change(v)
+                return
+
+            retry = bulk_insert_retries(batch, items, self.log)
+
+            if len(retry) > 0:
+                self._post_changes(retry)
+
+        else:
+            self.log.error('{0} - Could not create {1} change messages'.format(r.status_code, len(batch)))
+            self.log.error(r.text)
+
+    def _post_change(self, v) -> None:
+        """Insert a single change message
+
+        :param v: change message
+        :type v: dict
+        """
+
+        r = lungo.post(self.api_integration_url,
+                       data=json.dumps(v, cls=EveJSONEncoder),
+                       headers=API_HEADERS)
+
+        if r.status_code == 201:
+            self.log.debug('Created change message for {0} with id {1}'.format(v['entity_type'],
+                                                                               v['id']))
+            with self._populate_lock:
                 self.messages += 1
 
-            elif r.status_code == 422:
-                self.log.debug('422 {0} with id {1} already exists'.format(v['entity_type'],
-                                                                           v['id']))
-            else:
-                self.log.error(
-                    '{0} - Could not create change message for {1} with id {2}'.format(r.status_code,
-                                                                                       v['entity_type'],
-                                                                                       v['id']))
-                self.log.error(r.text)
+        elif r.status_code == 422:
+            self.log.debug('422 {0} with id {1} already exists'.format(v['entity_type'],
+                                                                       v['id']))
+        else:
+            self.log.error(
+                '{0} - Could not create change message for {1} with id {2}'.format(r.status_code,
+                                                                                   v['entity_type'],
+                                                                                   v['id']))
+            self.log.error(r.text)
+
+    def _get_change_messages(self, start_date, end_date, resource) -> int:
+        """Use NIF GetChanges3
 
-    def _get_change_messages(self, start_date, end_date, resource) -> None:
-        """Use NIF GetChanges3"""
+        :return: Number of change messages in the window
+        :rtype: int
+        """
 
         # To avoid future date?
         time.sleep(NIF_SYNC_DELAY)
 
+        nif = self._client()
+
         if resource == 'changes':
-            status, changes = self.nif.get_changes(start_date.astimezone(self.tz_local),
-                                                   end_date.astimezone(self.tz_local))
+            get_changes = nif.get_changes
         elif resource == 'competence':
-            status, changes = self.nif.get_changes_competence(start_date.astimezone(self.tz_local),
-                                                              end_date.astimezone(self.tz_local))
+            get_changes = nif.get_changes_competence
         elif resource == 'license':
-            status, changes = self.nif.get_changes_license(start_date.astimezone(self.tz_local),
-                                                           end_date.astimezone(self.tz_local))
+            get_changes = nif.get_changes_license
         elif resource == 'federation':
-            status, changes = self.nif.get_changes_federation(start_date.astimezone(self.tz_local),
-                                                              end_date.astimezone(self.tz_local))
+            get_changes = nif.get_changes_federation
         else:
             raise Exception('Resource gone bad, {}'.format(resource))
 
+        with NIF_CALL_SECONDS.time(call=getattr(get_changes, '__name__', resource)):
+            status, changes = get_changes(start_date.astimezone(self.tz_local),
+                                          end_date.astimezone(self.tz_local))
+
         if status is True:
 
             self.log.debug('Got {} changes for {}'.format(len(changes), resource))
@@ -543,26 +899,39 @@ class NifSync(threading.Thread):
                 self.log.exception('Unknown exception (_get_changes3)')
             """
 
+            return len(changes)
+
         else:
             self.log.error('GetChanges returned error: {0} - {1}'.format(changes.get('code', 0),
                                                                          changes.get('error', 'Unknown error')))
             raise Exception('_get_changes_messages returned an error')
 
-    def _get_changes(self, start_date, end_date) -> None:
-        """Get change messages based on :py:attr:`.sync_type`"""
+    def _get_changes(self, start_date, end_date) -> bool:
+        """Get change messages based on :py:attr:`.sync_type` and adapt :py:attr:`window` to the response"""
 
-        self.from_to = [start_date, end_date]  # Adding extra info
+        with self._populate_lock:
+            self.from_to = [start_date, end_date]  # Adding extra info
 
         try:
-            self._get_change_messages(start_date, end_date, self.sync_type)
+            t = time.time()
+            count = self._get_change_messages(start_date, end_date, self.sync_type)
+            latency = time.time() - t - NIF_SYNC_DELAY
 
-            if self.sync_errors > 0:
-                self.sync_errors -= 1
+            SYNC_WINDOW_SECONDS.observe(latency, mode=self.state.mode, sync_type=self.sync_type)
+            SYNC_CHANGES.inc(count, sync_type=self.sync_type)
+            SYNC_CHANGES_PER_SECOND.set(count / latency if latency > 0 else 0.0, worker=self.name)
+
+            self._adapt_window(count, latency, start_date, end_date - start_date)
+
+            with self._populate_lock:
+                if self.sync_errors > 0:
+                    self.sync_errors -= 1
 
             return True
 
         except requests.exceptions.ConnectionError:
-            self.sync_errors += 1
+            with self._populate_lock:
+                self.sync_errors += 1
             self.log.error('Connection error in _get_changes')
 
             # Retry @TODO see if retry should be in populate and sync
@@ -572,16 +941,30 @@ class NifSync(threading.Thread):
         except TypeError:
             self.log.debug('TypeError: Empty change messages list ({})'.format(self.sync_type))
         except Exception as e:
-            self.sync_errors += 1
+            with self._populate_lock:
+                self.sync_errors += 1
             self.log.exception('Exception in _get_changes')
             # @TODO Need to verify if this is reason to warn somehow??
 
         return False
 
+    def _adapt_window(self, count, latency, start_date=None, span=None) -> None:
+        """Adapt :py:attr:`window` to a response and store the new size in :py:attr:`checkpoints`"""
+
+        if self.window.update(count, latency, start_date, span) is True:
+            self.log.debug('Window size {0} hours after {1} changes in {2:.1f} seconds'.format(self.window.size,
+                                                                                              count,
+                                                                                              latency))
+            self.checkpoints.set_window_size(self.org_id, self.sync_type, self.window.size)
+
     def sync(self) -> None:
         """This method is the job run by the scheduler when last change message is < NIF_POPULATE_INTERVAL.
 
-        If a job misfires, then on next run the interval to sync will be twice.
+        If a job misfires, then on next run the interval to sync will be twice. Intervals longer than :py:attr:`window`
+        are fetched in several windows.
+
+        Each window acquires a slot in :py:attr:`lock`, with a :py:class:`pool.InstrumentedPool` sync jobs are granted
+        slots before populate windows.
 
         .. note::
             Checks if :py:attr:`.sync_errors` > :py:attr:`.sync_errors_max` and if so it will set :py:attr:`._stopper`
@@ -596,30 +979,31 @@ class NifSync(threading.Thread):
 
         self.log.debug('Getting sync messages')
 
+        end = datetime.utcnow().replace(tzinfo=self.tz_utc)
+
         if self.initial_start is not None:
-            end = datetime.utcnow().replace(tzinfo=self.tz_utc)
             start = self.initial_start + timedelta(seconds=self.initial_timedelta)
+        else:
+            start = end - timedelta(minutes=self.sync_interval)
+            self.initial_start = start
 
-            self.log.debug('From:   {0}'.format(start.astimezone(self.tz_local).isoformat()))
-            self.log.debug('To:     {0}'.format(end.astimezone(self.tz_local).isoformat()))
+        self.log.debug('From:   {0}'.format(start.astimezone(self.tz_local).isoformat()))
+        self.log.debug('To:     {0}'.format(end.astimezone(self.tz_local).isoformat()))
 
-            if end > start:
-                if self._get_changes(start, end):
-                    self.initial_start = end
-            else:
-                self.log.error('Inconsistence between dates')
-        else:
-            end = datetime.utcnow().replace(tzinfo=self.tz_utc)
-            self.initial_start = end - timedelta(minutes=self.sync_interval)
+        if end > start:
+            # Split in windows of at most window size, e.g. after a long pause
+            while start < end:
+                stop = min(start + self.window.timedelta, end)
 
-            self.log.debug('From:   {0}'.format(self.initial_start.astimezone(self.tz_local).isoformat()))
-            self.log.debug('To:     {0}'.format(end.astimezone(self.tz_local).isoformat()))
+                with self._slot():
+                    if self._get_changes(start, stop) is not True:
+                        break
 
-            if end > self.initial_start:
-                if self._get_changes(self.initial_start, end):
-                    self.initial_start = end
-            else:
-                self.log.error('Inconsistence between dates')
+                self.initial_start = stop
+                self._set_checkpoint(stop)
+                start = stop + timedelta(seconds=self.initial_timedelta)
+        else:
+            self.log.error('Inconsistence between dates')
 
         self.state.set_state(mode='sync', state='sleeping')
 
@@ -627,13 +1011,38 @@ class NifSync(threading.Thread):
         """Populates change messages from :py:attr:`.org_created` until last change message timedelta is less than
         :py:attr:`.populate_interval` from which it will exit and start :py:attr:`scheduler`.
 
+        With :py:attr:`populate_workers` > 1 the windows are fetched concurrently, see :py:meth:`_populate_parallel`.
+
         .. attention::
             :py:meth:`populate` requires a slot in the connectionpool. Getting a slot requires acquiring
-            :py:attr:`lock`. Number of slots available is set in :py:mod:`syncdaemon` on startup.
+            :py:attr:`lock`. Number of slots available is set in :py:mod:`syncdaemon` on startup. Slots are granted
+            round-robin between workers and after waiting sync jobs, see :py:class:`pool.InstrumentedPool`.
         """
         self.state.set_state(mode='populate', state='initializing')
         self.log.debug('Populate, interval of {0} hours...'.format(self.populate_interval))
 
+        if self.populate_workers > 1 or self.checkpoints.get_plan(self.org_id, self.sync_type) is not None:
+            start_date = self._populate_parallel()
+        else:
+            start_date = self._populate_sequential()
+
+        # Since last assignment do not work, use last end_date = start_date for last iteration
+        self.initial_start = start_date
+        self.state.set_state(mode='populate', state='finished', reason='ended populate')
+
+        if sync_after is True:
+            self.state.set_state(mode='sync', state='started', reason='starting after populate')
+            if self.shared_scheduler:
+                self.job.resume()
+            self._start_scheduler()
+
+    def _populate_sequential(self) -> datetime:
+        """Populate one window at a time
+
+        :return: Start of the last window
+        :rtype: datetime.datetime
+        """
+
         # Initial
         if self.initial_start is None:
             end_date = self.org_created
@@ -642,8 +1051,8 @@ class NifSync(threading.Thread):
 
         start_date = end_date - timedelta(hours=self.populate_interval)
 
-        # Populate loop
-        while end_date < datetime.utcnow().replace(tzinfo=self.tz_utc) + timedelta(hours=self.populate_interval):
+        # Populate loop, ends with the window overlapping now
+        while True:
 
             # Check stopper
             self._stopper()
@@ -652,7 +1061,7 @@ class NifSync(threading.Thread):
             self.log.debug('Waiting for slot in connectionpool...')
             self.state.set_state(state='waiting', reason='connection pool')
 
-            with self.lock:  # .acquire(blocking=True):
+            with self._slot():  # .acquire(blocking=True):
                 self.state.set_state(state='running')
                 # Check stopper, might have waited long time
                 self._stopper()
@@ -667,6 +1076,7 @@ class NifSync(threading.Thread):
 
                     if self._get_changes(start_date, end_date) is True:
                         # Last populate
+                        self._set_checkpoint(end_date)
                         break  # Break while
 
                 else:
@@ -675,20 +1085,202 @@ class NifSync(threading.Thread):
                                            end_date.astimezone(self.tz_local).isoformat()))
 
                     if self._get_changes(start_date, end_date) is True:
+                        self._set_checkpoint(end_date)
                         # Next iteration
                         start_date = end_date
-                        end_date = end_date + timedelta(hours=self.populate_interval)
+                        end_date = end_date + self.window.timedelta
 
-                    time.sleep(0.1)  # Grace before we release lock
+            time.sleep(0.1)  # Grace after releasing the slot
 
-        # Since last assignment do not work, use last end_date = start_date for last iteration
-        self.initial_start = start_date
-        self.state.set_state(mode='populate', state='finished', reason='ended populate')
+        return start_date
 
-        if sync_after is True:
-            self.log.debug('Starting sync scheduler...')
+    def _populate_parallel(self) -> datetime:
+        """Populate with :py:attr:`populate_workers` windows fetched concurrently
+
+        The plan, the start of the history, is stored in :py:attr:`checkpoints` together with each completed window.
+        Workers take the next window of :py:attr:`window` size from a shared cursor, so on restart an unfinished plan
+        is resumed and only the gaps between completed windows and the rest of the history are fetched. Each window acquires
+        :py:attr:`lock`, so the number of concurrent calls stays within the connection pool. Each thread has its own NIF
+        client, see :py:meth:`_client`.
+
+        The last window ends now and is always fetched after the others, then the plan is cleared.
+
+        :return: Start of the last window
+        :rtype: datetime.datetime
+        """
+
+        plan = self.checkpoints.get_plan(self.org_id, self.sync_type)
+
+        if plan is None:
+            anchor = (self.initial_start or self.org_created) - timedelta(hours=self.populate_interval)
+            self.checkpoints.set_plan(self.org_id, self.sync_type, anchor, self.window.size)
+        else:
+            anchor = plan[0]
+            self.log.debug('Resuming populate plan from {0}'.format(anchor.astimezone(self.tz_local).isoformat()))
+
+        # Gaps are windows in flight when stopped
+        cursor = anchor
+        self._populate_retry = []
+        for start, end in self.checkpoints.get_windows(self.org_id, self.sync_type):
+            if start > cursor:
+                self._populate_retry.append((cursor, start))
+            cursor = max(cursor, end)
+
+        self._populate_cursor = cursor
+
+        self.log.debug('Populating from {0} with {1} gaps'.format(cursor.astimezone(self.tz_local).isoformat(),
+                                                                  len(self._populate_retry)))
+
+        with ThreadPoolExecutor(max_workers=self.populate_workers,
+                                thread_name_prefix='{}-populate'.format(self.name)) as executor:
+            # A failed window is put back, run again until only the last window is left
+            while self._next_window(peek=True) is not None:
+                self._stopper()
+                for f in [executor.submit(self._populate_worker) for i in range(0, self.populate_workers)]:
+                    f.result()
+
+        # Last window
+        start_date = self._populate_cursor
+
+        while True:
+            self._stopper()
+            self.state.set_state(state='waiting', reason='connection pool')
+
+            with self._slot():
+                self.state.set_state(state='running')
+                end_date = datetime.utcnow().replace(tzinfo=self.tz_utc)
+
+                self.log.debug('Getting last changes between {0} and {1}'
+                               .format(start_date.astimezone(self.tz_local).isoformat(),
+                                       end_date.astimezone(self.tz_local).isoformat()))
+
+                if self._get_changes(start_date, end_date) is True:
+                    break
+
+            time.sleep(0.1)
+
+        # Windows complete out of order, only the last window is a checkpoint
+        self._set_checkpoint(end_date)
+        self.checkpoints.clear_plan(self.org_id, self.sync_type)
+
+        return start_date
+
+    def _next_window(self, peek=False):
+        """Take the next window, windows to retry first and then the next window from the cursor
+
+        :param peek: If True the window is not taken
+        :type peek: bool
+        :return: (start, end) or None if only the last window is left
+        :rtype: (datetime.datetime, datetime.datetime)
+        """
+
+        with self._populate_lock:
+            if len(self._populate_retry) > 0:
+                return self._populate_retry[0] if peek is True else self._populate_retry.pop(0)
+
+            stop = self._populate_cursor + self.window.timedelta
+
+            if stop > datetime.utcnow().replace(tzinfo=self.tz_utc):
+                return None
+
+            window = (self._populate_cursor, stop)
+
+            if peek is False:
+                self._populate_cursor = stop
+
+            return window
+
+    def _populate_worker(self) -> None:
+        """Fetch windows until only the last window is left, failed windows are put back"""
+
+        if getattr(self._clients, 'nif', None) is None:
+            try:
+                self._clients.nif = NifApiSynchronization(self.username, self._password, realm=NIF_REALM,
+                                                          log_file=SYNC_LOG_FILE, test_login=False)
+            except Exception:
+                self.log.exception('Sync client creation for populate thread failed')
+                with self._populate_lock:
+                    self.sync_errors += 1
+                return
+
+        while True:
+            window = self._next_window()
+
+            if window is None:
+                break
+
+            if self._populate_window(*window) is not True:
+                with self._populate_lock:
+                    self._populate_retry.append(window)
+                break
+
+    def _populate_window(self, start_date, end_date) -> bool:
+        """Fetch one window in the populate plan and checkpoint it on success
+
+        :return: True if the window was completed
+        :rtype: bool
+        """
+
+        self._stopper()
+
+        with self._slot():
+            self.state.set_state(state='running')
+            self._stopper()
+
+            self.log.debug('Getting changes between {0} and {1}'
+                           .format(start_date.astimezone(self.tz_local).isoformat(),
+                                   end_date.astimezone(self.tz_local).isoformat()))
+
+            if self._get_changes(start_date, end_date) is True:
+                self.checkpoints.add_window(self.org_id, self.sync_type, start_date, end_date)
+                return True
+
+        time.sleep(0.1)  # Grace after releasing the slot
+
+        return False
+
+    def _client(self) -> NifApiSynchronization:
+        """The NIF client for the current thread, :py:attr:`nif` except in populate threads"""
+
+        return getattr(self._clients, 'nif', None) or self.nif
+
+    @contextmanager
+    def _slot(self):
+        """Acquire a slot in the connection pool :py:attr:`lock`, the time waiting is observed in
+        :py:data:`metrics.POOL_WAIT_SECONDS`"""
+
+        if isinstance(self.lock, InstrumentedPool):
+            with self.lock.slot(self.name, mode=self.state.mode):
+                yield
+            return
+
+        t = time.time()
+        waiting = True
+        POOL_WAITING.inc()
+
+        try:
+            with self.lock:
+                waiting = False
+                POOL_WAITING.dec()
+                POOL_WAIT_SECONDS.observe(time.time() - t, mode=self.state.mode)
+
+                yield
+        finally:
+            if waiting is True:
+                POOL_WAITING.dec()
+
+    def _start_scheduler(self) -> None:
+        """Start the scheduler. A BlockingScheduler blocks here, a shared scheduler is already running."""
+
+        if self.shared_scheduler:
+            if self.job is None:
+                self._add_job()
+                self.job.resume()
+
+            self.log.debug('Sync job scheduled in shared scheduler, next run {}'.format(self.job.next_run_time))
+        else:
+            self.log.debug('Starting sync scheduler')
             self.scheduler.start()
-            self.state.set_state(mode='sync', state='started', reason='starting after populate')
 
 
 if __name__ == "__main__":
@@ -5,11 +5,18 @@ import signal
 import argparse
 import time
 import threading
+import queue
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor as StartupExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
 
 from sync import NifSync
-from integration import NifIntegration, NifIntegrationUser, NifIntegrationUserError
+from checkpoints import SyncCheckpoints
+from pool import InstrumentedPool
+from async_sync import AsyncSyncEngine, AsyncNifSync
+from integration import NifIntegration, NifIntegrationUser, NifIntegrationUserError, AuthenticationProber
 from organizations import NifOrganization
 from settings import (
     NIF_FEDERATION_USERNAME,
@@ -24,9 +31,17 @@ from settings import (
     RPC_SERVICE_HOST,
     RPC_SERVICE_PORT,
     NIF_TEST_MAX_CLUBS,
-    NIF_INTEGERATION_CLUBS_EXCLUDE
+    NIF_INTEGERATION_CLUBS_EXCLUDE,
+    NIF_SYNC_SHARED_SCHEDULER,
+    NIF_SYNC_SCHEDULER_WORKERS,
+    SYNC_ENGINE,
+    SYNC_STARTUP_WORKERS,
+    NIF_AUTH_PROBE_DELAY,
+    METRICS_HOST,
+    METRICS_PORT
 )
 from app_logger import AppLogger
+from metrics import registry, MetricsServer
 
 Pyro4.config.COMMTIMEOUT = 10
 
@@ -137,7 +152,7 @@ class PyroService:
         """
         return {'name': self.work.workers[index].name,
                 'id': self.work.workers[index].id,
-                'status': self.work.workers[index].is_alive(),
+                'status': self.work.workers[index].running,
                 'state': self.work.workers[index].state.get_state().get('state', 'error'),
                 'mode': self.work.workers[index].state.get_state().get('mode', 'Unknown'),
                 'reason': self.work.workers[index].state.get_state().get('reason', 'Unknown'),
@@ -162,10 +177,10 @@ class PyroService:
         :type index: int
         """
 
-        if self.work.workers[index].is_alive() is False:
+        if self.work.workers[index].running is False:
             self.work.workers[index].run()  # start()
 
-        return self.work.workers[index].is_alive()
+        return self.work.workers[index].running
 
     def get_logs(self) -> [dict]:
         """Get the logs retained by the logger for all :py:attr:`.work.workers`"""
@@ -189,6 +204,35 @@ class PyroService:
 
         return self.work.failed_clubs
 
+    def get_pool_stats(self) -> dict:
+        """Get connection pool stats, see :py:meth:`pool.InstrumentedPool.stats`"""
+
+        return self.work.pool.stats()
+
+    def resize_pool(self, size) -> int:
+        """Set the number of slots in the connection pool shared by the thread workers
+
+        :param size: Number of slots, at least 1
+        :type size: int
+        :return: The new size
+        :rtype: int
+        """
+
+        self.work.pool.resize(int(size))
+        self.log.info('Resized connection pool to {} slots'.format(self.work.pool.size))
+
+        return self.work.pool.size
+
+    def get_metrics(self) -> dict:
+        """Get all metrics, see :py:mod:`metrics`"""
+
+        return registry.snapshot()
+
+    def get_metrics_text(self) -> str:
+        """Get all metrics in the Prometheus text format"""
+
+        return registry.render()
+
 
 class PyroWrapper(threading.Thread):
     def __init__(self, workers_stop, pyro_stop, workers_started):  # , work):
@@ -220,6 +264,22 @@ class PyroWrapper(threading.Thread):
 
 
 class SyncWrapper:
+    """Sets up and starts a :py:class:`sync.NifSync` worker for each club and the federation workers
+
+    With NIF_SYNC_SHARED_SCHEDULER all workers add their sync job to one :py:attr:`scheduler` running the jobs in a
+    pool of NIF_SYNC_SCHEDULER_WORKERS threads, instead of each worker running its own scheduler in its own thread.
+
+    With SYNC_ENGINE = 'asyncio' the workers are :py:class:`async_sync.AsyncNifSync` tasks in one
+    :py:class:`async_sync.AsyncSyncEngine` event loop instead of threads.
+
+    :param stopper: The stopper for all worker threads
+    :type stopper: threading.Event
+    :param workers_started: A flag for signalling if workers are started
+    :type workers_started: threading.Event
+    :param restart: On True will reset all AppLogger handlers
+    :type restart: bool
+    """
+
     def __init__(self, stopper, workers_started, restart=False):
 
         self.log = AppLogger(name='syncdaemon')
@@ -231,10 +291,26 @@ class SyncWrapper:
         self.club_list = []
 
         self.integration = NifIntegration()
-        self.bound_semaphore = threading.BoundedSemaphore(value=SYNC_CONNECTIONPOOL_SIZE)
+        self.pool = InstrumentedPool(size=SYNC_CONNECTIONPOOL_SIZE)
+        self.checkpoints = SyncCheckpoints()
 
         self.restart = restart
 
+        self.engine = None
+        self.scheduler = None
+        self.starter = None
+        self.prober = None
+        self.started = None
+        self._start_queue = queue.Queue()
+        self._workers_lock = threading.Lock()
+        self._expected_workers = 0
+        self._probing = 0
+        if SYNC_ENGINE == 'asyncio':
+            self.engine = AsyncSyncEngine(stopper=self.stopper)
+        elif NIF_SYNC_SHARED_SCHEDULER is True:
+            self.scheduler = BackgroundScheduler(executors={'default': ThreadPoolExecutor(NIF_SYNC_SCHEDULER_WORKERS)},
+                                                 job_defaults={'coalesce': True})
+
         # Build list of workers
         # for i in range(0, 10):
         #    self.workers.append(ProducerThread(i, workers_stop, restart))
@@ -242,126 +318,263 @@ class SyncWrapper:
         # time.sleep(1)
 
     def start(self, start=False):
+        """Resolve the integration users and start all workers
+
+        Integration users are resolved concurrently and their authentication is tested by an
+        :py:class:`integration.AuthenticationProber`. A worker is started as soon as its user authenticates, so
+        workers for existing users start right away while users created now are still propagating in NIF. The
+        workers are started spread over the sync interval, see :py:meth:`_start_workers`.
+        """
 
         self.log.info('Starting workers')
         self.workers_started.set()
+        self.started = time.time()
+        t = time.time()
 
-        integration_users = []
+        if self.scheduler is not None and self.scheduler.running is False:
+            self.scheduler.start()
+            self.log.info('Started shared scheduler with {} threads'.format(NIF_SYNC_SCHEDULER_WORKERS))
 
         # clubs = self.integration.get_clubs()
 
         # Only a list of integers!
         clubs = self.integration.get_active_clubs_from_ka()
 
-        self.log.info('Got {} integration users'.format(len(clubs)))
+        self.log.info('Got {} integration users in {:.1f}s'.format(len(clubs), time.time() - t))
 
-        # Setup each integration user from list of integers
+        club_ids = []
         for club_id in clubs:
-
-            if club_id in self.club_list:
+            if club_id in self.club_list or club_id in NIF_INTEGERATION_CLUBS_EXCLUDE:
                 continue
-            elif club_id not in NIF_INTEGERATION_CLUBS_EXCLUDE:
-                self.club_list.append(club_id)
 
-            try:
-                if club_id not in NIF_INTEGERATION_CLUBS_EXCLUDE:
-                    integration_users.append(NifIntegrationUser(club_id=club_id,
-                                                                create_delay=0))
-                    time.sleep(0.2)
-
-            except NifIntegrationUserError as e:
-                self.log.exception('Problems creating user for club_id {}: {}'.format(club_id, e))
-                self.failed_clubs.append({'name': 'From list', 'club_id': club_id})
-            except Exception as e:
-                self.log.exception('Problems with club id {}: {}'.format(club_id, e))
-                self.failed_clubs.append({'name': 'From list', 'club_id': club_id})
-
-        # Sleep because last created user!
-        time.sleep(180)
-        # Add each integration user to workers
-        for club_user in integration_users:
+            self.club_list.append(club_id)
+            club_ids.append(club_id)
 
-            try:
+        # Bulk load existing users and club details, None falls back to one lookup for each club
+        t = time.time()
+        api_users = self.integration.get_integration_users()
+        club_details = self.integration.get_club_details(club_ids) if api_users is not None else None
 
-                if club_user.test_login():
-
-                    self.workers.append(NifSync(org_id=club_user.club_id,
-                                                username=club_user.username,
-                                                password=club_user.password,
-                                                created=club_user.club_created,
-                                                stopper=self.stopper,
-                                                restart=self.restart,
-                                                background=False,
-                                                initial_timedelta=0,
-                                                overlap_timedelta=5,
-                                                lock=self.bound_semaphore,
-                                                sync_type='changes',
-                                                sync_interval=NIF_CHANGES_SYNC_INTERVAL))
-
-                    self.log.info('Added {}'.format(club_user.username))
-                else:
-                    self.log.error('Failed login for {} with password {}'.format(club_user.club_id, club_user.password))
-                    self.failed_clubs.append({'name': club_user.club_name, 'club_id': club_user.club_id})
-
-            except Exception as e:
-                self.failed_clubs.append({'name': club_user.club_name, 'club_id': club_user.club_id})
-                self.log.exception('Problems for {} ({})'.format(club_user.club_name, club_user.club_id))
+        if api_users is None or club_details is None:
+            self.log.warning('Could not bulk load integration users, getting each user')
+            api_users, club_details = None, {}
+        else:
+            self.log.info('Bulk loaded {} integration users and {} clubs in {:.1f}s'.format(len(api_users),
+                                                                                            len(club_details),
+                                                                                            time.time() - t))
 
-        # Add license-sync
+        # Setup each integration user from list of integers
+        t = time.time()
+        with StartupExecutor(max_workers=SYNC_STARTUP_WORKERS) as executor:
+            integration_users = [u for u in executor.map(lambda c: self._get_integration_user(
+                c,
+                api_users=api_users.get(c, []) if api_users is not None else None,
+                club=club_details.get(c, None)), club_ids) if u is not None]
+
+        created = [u for u in integration_users if u.created is True]
+        self.log.info('Resolved {} integration users, {} created, in {:.1f}s'.format(len(integration_users),
+                                                                                     len(created),
+                                                                                     time.time() - t))
+
+        # Federation workers do not need probing
+        federation_workers = []
         try:
             self.log.info('Adding competences and license sync')
             org = NifOrganization(376)
-            self.workers.append(NifSync(org_id=900001,
-                                        username=NIF_FEDERATION_USERNAME,
-                                        password=NIF_FEDERATION_PASSWORD,
-                                        created=org.created,
-                                        stopper=self.stopper,
-                                        restart=self.restart,
-                                        background=False,
-                                        initial_timedelta=0,
-                                        overlap_timedelta=5,
-                                        lock=self.bound_semaphore,
-                                        sync_type='license',
-                                        sync_interval=NIF_LICENSE_SYNC_INTERVAL))
-
-            self.workers.append(NifSync(org_id=900002,
-                                        username=NIF_FEDERATION_USERNAME,
-                                        password=NIF_FEDERATION_PASSWORD,
-                                        created=org.created,
-                                        stopper=self.stopper,
-                                        restart=self.restart,
-                                        background=False,
-                                        initial_timedelta=0,
-                                        overlap_timedelta=5,
-                                        lock=self.bound_semaphore,
-                                        sync_type='competence',
-                                        sync_interval=NIF_COMPETENCE_SYNC_INTERVAL))
-
-            self.workers.append(NifSync(org_id=376,
-                                        username=NIF_FEDERATION_USERNAME,
-                                        password=NIF_FEDERATION_PASSWORD,
-                                        created=org.created,
-                                        stopper=self.stopper,
-                                        restart=self.restart,
-                                        background=False,
-                                        initial_timedelta=0,
-                                        overlap_timedelta=5,
-                                        lock=self.bound_semaphore,
-                                        sync_type='federation',
-                                        sync_interval=NIF_COMPETENCE_SYNC_INTERVAL))
+            federation_workers.append(self._create_worker(org_id=900001,
+                                                          username=NIF_FEDERATION_USERNAME,
+                                                          password=NIF_FEDERATION_PASSWORD,
+                                                          created=org.created,
+                                                          sync_type='license',
+                                                          sync_interval=NIF_LICENSE_SYNC_INTERVAL))
+
+            federation_workers.append(self._create_worker(org_id=900002,
+                                                          username=NIF_FEDERATION_USERNAME,
+                                                          password=NIF_FEDERATION_PASSWORD,
+                                                          created=org.created,
+                                                          sync_type='competence',
+                                                          sync_interval=NIF_COMPETENCE_SYNC_INTERVAL))
+
+            federation_workers.append(self._create_worker(org_id=376,
+                                                          username=NIF_FEDERATION_USERNAME,
+                                                          password=NIF_FEDERATION_PASSWORD,
+                                                          created=org.created,
+                                                          sync_type='federation',
+                                                          sync_interval=NIF_COMPETENCE_SYNC_INTERVAL))
         except Exception as e:
             self.log.exception('Error initiating licenses and competences')
 
-        # Start all workers
+        # Start workers as they are ready
         self.log.info('Starting all workers')
-        for worker in self.workers:
+        self._expected_workers = len(integration_users) + len(federation_workers)
+        self._probing = len(integration_users)
+
+        if self.engine is not None:
+            self.engine.start()
+        else:
+            self.starter = threading.Thread(target=self._start_workers, name='worker-starter', daemon=True)
+            self.starter.start()
+
+        for worker in federation_workers:
+            self._add_worker(worker)
+
+        if len(integration_users) == 0:
+            self.log.info('No integration users to authenticate')
+            self._add_worker(None)
+            return
+
+        # Created users need time before they can authenticate
+        self.prober = AuthenticationProber(stopper=self.stopper)
+        for club_user in integration_users:
+            future = self.prober.probe(club_user, delay=NIF_AUTH_PROBE_DELAY if club_user.created is True else 0)
+            future.add_done_callback(lambda f, u=club_user: self._authenticated(u, f))
+
+    def _authenticated(self, club_user, future) -> None:
+        """Callback from the :py:class:`integration.AuthenticationProber`, adds a worker if authenticated"""
+
+        try:
+
+            if future.result() is True:
+
+                self._add_worker(self._create_worker(org_id=club_user.club_id,
+                                                     username=club_user.username,
+                                                     password=club_user.password,
+                                                     created=club_user.club_created,
+                                                     sync_type='changes',
+                                                     sync_interval=NIF_CHANGES_SYNC_INTERVAL))
+
+                self.log.info('Added {}'.format(club_user.username))
+            else:
+                self.log.error('Failed login for {} with password {}'.format(club_user.club_id, club_user.password))
+                self.failed_clubs.append({'name': club_user.club_name, 'club_id': club_user.club_id})
+
+        except Exception as e:
+            self.failed_clubs.append({'name': club_user.club_name, 'club_id': club_user.club_id})
+            self.log.exception('Problems for {} ({})'.format(club_user.club_name, club_user.club_id))
+
+        with self._workers_lock:
+            self._probing -= 1
+            done = self._probing == 0
+
+        if done is True:
+            self.log.info('Tested authentication of all integration users in {:.1f}s, {} failed clubs'.format(
+                time.time() - self.started, len(self.failed_clubs)))
+            self._add_worker(None)
+
+    def _add_worker(self, worker) -> None:
+        """Add a worker and queue it for start, None when all workers are added"""
+
+        if worker is not None:
+            with self._workers_lock:
+                self.workers.append(worker)
+
+        if self.engine is not None:
+            if worker is not None:
+                self.engine.add_worker(worker)
+        else:
+            self._start_queue.put(worker)
+
+    def _get_integration_user(self, club_id, api_users=None, club=None):
+        """Get or create the integration user for a club
+
+        :param api_users: Bulk loaded integration users for the club, see :py:class:`integration.NifIntegrationUser`
+        :type api_users: list[dict]
+        :param club: Bulk loaded (created, name) for the club
+        :type club: tuple
+        :return: The integration user or None on errors
+        :rtype: NifIntegrationUser
+        """
+
+        try:
+            return NifIntegrationUser(club_id=club_id, create_delay=0, api_users=api_users, club=club)
+
+        except NifIntegrationUserError as e:
+            self.log.exception('Problems creating user for club_id {}: {}'.format(club_id, e))
+            self.failed_clubs.append({'name': 'From list', 'club_id': club_id})
+        except Exception as e:
+            self.log.exception('Problems with club id {}: {}'.format(club_id, e))
+            self.failed_clubs.append({'name': 'From list', 'club_id': club_id})
+
+        return None
+
+    def _start_workers(self) -> None:
+        """Start the workers as they are added, evenly spread over the sync interval so the syncs are spread as well"""
+
+        t = time.time()
+        spacing = NIF_CHANGES_SYNC_INTERVAL * 60 / max(1, self._expected_workers)
+        self.log.info('Starting up to {} workers {:.2f}s apart'.format(self._expected_workers, spacing))
+
+        while not self.stopper.is_set():
+            try:
+                worker = self._start_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if worker is None:
+                break
+
             worker.start()
-            time.sleep(1)  # Spread each worker accordingly
+
+            if self.stopper.wait(spacing) is True:
+                break
+
+        self.log.info('Started workers in {:.1f}s'.format(time.time() - t))
+
+    def _create_worker(self, org_id, username, password, created, sync_type, sync_interval):
+        """Create a worker for the selected SYNC_ENGINE
+
+        :return: The worker
+        :rtype: sync.NifSync or async_sync.AsyncNifSync
+        """
+
+        if self.engine is not None:
+            return AsyncNifSync(org_id=org_id,
+                                username=username,
+                                password=password,
+                                created=created,
+                                restart=self.restart,
+                                initial_timedelta=0,
+                                overlap_timedelta=5,
+                                sync_type=sync_type,
+                                sync_interval=sync_interval,
+                                checkpoints=self.checkpoints)
+
+        return NifSync(org_id=org_id,
+                       username=username,
+                       password=password,
+                       created=created,
+                       stopper=self.stopper,
+                       restart=self.restart,
+                       background=False,
+                       initial_timedelta=0,
+                       overlap_timedelta=5,
+                       lock=self.pool,
+                       sync_type=sync_type,
+                       sync_interval=sync_interval,
+                       scheduler=self.scheduler,
+                       checkpoints=self.checkpoints)
 
     def shutdown(self):
         self.log.info('Shutdown workers called')
         self.stopper.set()
+
+        if self.engine is not None:
+            self.log.info('Joining {}'.format(self.engine.name))
+            if self.engine.is_alive():
+                self.engine.join()
+            self.workers_started.clear()
+            return
+
+        if self.scheduler is not None and self.scheduler.running is True:
+            self.log.info('Shutting down shared scheduler')
+            self.scheduler.shutdown(wait=True)
+        if self.prober is not None:
+            self.prober.shutdown()
+        if self.starter is not None:
+            self.starter.join()
         for worker in self.workers:
+            if worker.ident is None:
+                continue  # Never started
             self.log.info('Joining {}'.format(worker.name))
             worker.join()
         self.workers_started.clear()
@@ -415,6 +628,11 @@ if __name__ == '__main__':
                        working_directory='{}/'.format(os.getcwd())
                        ):
 
+        if METRICS_PORT > 0:
+            metrics_server = MetricsServer(port=METRICS_PORT)
+            metrics_server.start()
+            log.info('Serving metrics on {}:{}'.format(METRICS_HOST, METRICS_PORT))
+
         pyro = PyroWrapper(workers_stop=workers_stop,
                            pyro_stop=pyro_stop,
                            workers_started=workers_started